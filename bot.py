@@ -38,17 +38,32 @@ install_deps()
 # ======================== ИМПОРТЫ ========================
 import asyncio
 import aiohttp
+from aiohttp import web
 import aiosqlite
+import sqlite3
 import random
 import json
 import time
 import logging
 import os
 import math
+import bisect
+import contextvars
+import functools
+import heapq
+import hmac
+import secrets
+from collections import OrderedDict, deque
+from contextlib import asynccontextmanager
+from dataclasses import dataclass, field
 from datetime import datetime, timedelta
-from typing import Optional
+from typing import Optional, Protocol
 
 from dotenv import load_dotenv
+try:
+    import numpy as np  # нужен только для пакетной симуляции боёв
+except ImportError:
+    np = None
 from aiogram import Bot, Dispatcher, Router, F, BaseMiddleware
 from aiogram.types import (
     Message, CallbackQuery, InlineKeyboardButton, InlineKeyboardMarkup,
@@ -57,6 +72,9 @@ from aiogram.types import (
 from aiogram.filters import Command, CommandStart
 from aiogram.enums import ParseMode
 from aiogram.client.default import DefaultBotProperties
+from aiogram.client.session.aiohttp import AiohttpSession
+from aiogram.client.telegram import TelegramAPIServer
+from aiogram.exceptions import TelegramRetryAfter, TelegramForbiddenError, TelegramBadRequest
 
 # ======================== НАСТРОЙКИ ЧЕРЕЗ .ENV ========================
 # Ищем .env рядом с bot.py
@@ -77,6 +95,51 @@ else:
 BOT_TOKEN = os.getenv("BOT_TOKEN", "")
 CRYPTO_PAY_TOKEN = os.getenv("CRYPTO_PAY_TOKEN", "")
 DB_PATH = os.getenv("DB_PATH", os.path.join(_SCRIPT_DIR, "dungeon_master.db"))
+# Пул соединений SQLite: один писатель + несколько читателей (WAL)
+DB_READERS = int(os.getenv("DB_READERS", "4"))
+DB_BUSY_TIMEOUT_MS = int(os.getenv("DB_BUSY_TIMEOUT_MS", "5000"))
+DB_STATEMENT_CACHE = int(os.getenv("DB_STATEMENT_CACHE", "256"))
+# Шардирование: данные игроков раскладываются по DB_SHARDS файлам SQLite
+# (user_id % N), у каждого свой писатель. Менять число шардов — только через reshard.py
+DB_SHARDS = int(os.getenv("DB_SHARDS", "1"))
+# Хранилище: sqlite (рабочее) или memory — словари в памяти процесса для бенчмарков
+# и прогонов, после остановки всё теряется
+STORAGE = os.getenv("STORAGE", "sqlite").lower()
+# Write-behind кэш игроков: размер (LRU), время жизни и период сброса в БД
+USER_CACHE_SIZE = int(os.getenv("USER_CACHE_SIZE", "10000"))
+USER_CACHE_TTL = int(os.getenv("USER_CACHE_TTL", "600"))
+USER_FLUSH_INTERVAL_MS = int(os.getenv("USER_FLUSH_INTERVAL_MS", "500"))
+# Сколько лидеров держим в памяти на каждую категорию рейтинга (с запасом над показом)
+LEADERBOARD_SIZE = int(os.getenv("LEADERBOARD_SIZE", "100"))
+# Сколько секунд живёт кэш «Статистики мира»
+WORLD_STATS_TTL = int(os.getenv("WORLD_STATS_TTL", "30"))
+# Рассылки: общий лимит сообщений в секунду, размер пачки получателей и параллельность
+BROADCAST_RATE = float(os.getenv("BROADCAST_RATE", "30"))
+BROADCAST_CHUNK = int(os.getenv("BROADCAST_CHUNK", "500"))
+BROADCAST_CONCURRENCY = int(os.getenv("BROADCAST_CONCURRENCY", "20"))
+# Таймеры событий игроков: какие push-уведомления слать (expedition, energy, vip),
+# лимит уведомлений в секунду и размер очереди на отправку
+NOTIFY_EVENTS = frozenset(e.strip() for e in os.getenv("NOTIFY_EVENTS", "expedition,energy,vip").split(",")
+                          if e.strip())
+NOTIFY_RATE = float(os.getenv("NOTIFY_RATE", "10"))
+NOTIFY_QUEUE_SIZE = int(os.getenv("NOTIFY_QUEUE_SIZE", "10000"))
+# Метрики в формате Prometheus: адрес эндпоинта /metrics (порт 0 — не поднимать)
+METRICS_HOST = os.getenv("METRICS_HOST", "127.0.0.1")
+METRICS_PORT = int(os.getenv("METRICS_PORT", "9108"))
+# Профиль апдейтов: пороги «медленного» апдейта (мс и SQL-операторов), сколько
+# операторов хранить для лога и сколько хендлеров показывать в админке
+SLOW_UPDATE_MS = float(os.getenv("SLOW_UPDATE_MS", "500"))
+SLOW_UPDATE_STATEMENTS = int(os.getenv("SLOW_UPDATE_STATEMENTS", "15"))
+PROFILE_LOG_STATEMENTS = int(os.getenv("PROFILE_LOG_STATEMENTS", "100"))
+PROFILE_TOP_N = int(os.getenv("PROFILE_TOP_N", "10"))
+# Антифлуд кнопок: лимит по умолчанию (нажатий в секунду и запас) и отдельные
+# лимиты по префиксам callback_data в формате "префикс=скорость/запас,..."
+THROTTLE_RATE = float(os.getenv("THROTTLE_RATE", "4"))
+THROTTLE_BURST = float(os.getenv("THROTTLE_BURST", "8"))
+THROTTLE_LIMITS = os.getenv(
+    "THROTTLE_LIMITS",
+    "fight_=1/3,pvp_fight=1/3,game_=1/3,dice_=1/3,roul_=1/3,spin_=1/2,"
+    "buy_=2/4,gbuy_=2/4,chest_=1/3,docraft_=1/3,heal=2/4")
 
 # Парсим ADMIN_IDS безопасно
 _admin_ids_raw = os.getenv("ADMIN_IDS", "")
@@ -93,6 +156,31 @@ if not ADMIN_IDS:
 # Получи API ключ на https://hiviews.net или у @hiviews_bot
 HIVIEWS_API_KEY = os.getenv("HIVIEWS_API_KEY", "")
 HIVIEWS_API_URL = os.getenv("HIVIEWS_API_URL", "https://hiviews.net/sendMessage")
+# Очередь доставки HiViews: размер, число воркеров и окно склейки кликов одного игрока
+HIVIEWS_QUEUE_SIZE = int(os.getenv("HIVIEWS_QUEUE_SIZE", "1000"))
+HIVIEWS_WORKERS = int(os.getenv("HIVIEWS_WORKERS", "4"))
+HIVIEWS_COALESCE_MS = int(os.getenv("HIVIEWS_COALESCE_MS", "1000"))
+# Общая HTTP-сессия для внешних API (HiViews, Crypto Pay)
+HTTP_POOL_SIZE = int(os.getenv("HTTP_POOL_SIZE", "20"))
+HTTP_TIMEOUT = float(os.getenv("HTTP_TIMEOUT", "10"))
+# Crypto Pay: адрес API (можно подменить локальным стендом), сверка платежей в фоне
+CRYPTO_PAY_API = os.getenv("CRYPTO_PAY_API", "https://pay.crypt.bot/api").rstrip("/")
+PAYMENT_POLL_INTERVAL = int(os.getenv("PAYMENT_POLL_INTERVAL", "30"))
+PAYMENT_BATCH_SIZE = int(os.getenv("PAYMENT_BATCH_SIZE", "100"))
+PAYMENT_EXPIRE_HOURS = int(os.getenv("PAYMENT_EXPIRE_HOURS", "24"))
+# Адрес Bot API: пусто — api.telegram.org; можно указать локальный telegram-bot-api
+# или стенд fake_telegram.py, например http://127.0.0.1:8081
+TELEGRAM_API_URL = os.getenv("TELEGRAM_API_URL", "").rstrip("/")
+# Режим получения апдейтов: polling (по умолчанию) или webhook
+BOT_MODE = os.getenv("BOT_MODE", "polling").strip().lower()
+WEBHOOK_URL = os.getenv("WEBHOOK_URL", "").rstrip("/")  # публичный адрес, например https://bot.example.com
+WEBHOOK_PATH = os.getenv("WEBHOOK_PATH", "/webhook")
+WEBHOOK_SECRET = os.getenv("WEBHOOK_SECRET", "") or secrets.token_urlsafe(32)
+WEBHOOK_HOST = os.getenv("WEBHOOK_HOST", "0.0.0.0")
+WEBHOOK_PORT = int(os.getenv("WEBHOOK_PORT", "8080"))
+# Сколько апдейтов webhook обрабатывается одновременно; сверх этого Telegram
+# получает 503 и присылает апдейт повторно позже
+WEBHOOK_MAX_UPDATES = int(os.getenv("WEBHOOK_MAX_UPDATES", "500"))
 
 logging.basicConfig(level=logging.INFO, format="%(asctime)s [%(levelname)s] %(message)s")
 logger = logging.getLogger(__name__)
@@ -127,23 +215,418 @@ print(f"👑 ADMIN_IDS: {ADMIN_IDS}")
 print(f"🗄️ DB_PATH: {DB_PATH}")
 print(f"📢 HIVIEWS: {'✅ задан' if HIVIEWS_API_KEY else '❌ не задан'}")
 
-bot = Bot(token=BOT_TOKEN, default=DefaultBotProperties(parse_mode=ParseMode.HTML))
+if TELEGRAM_API_URL:
+    print(f"🌍 Bot API: {TELEGRAM_API_URL}")
+bot = Bot(token=BOT_TOKEN, default=DefaultBotProperties(parse_mode=ParseMode.HTML),
+          session=AiohttpSession(api=TelegramAPIServer.from_base(TELEGRAM_API_URL))
+          if TELEGRAM_API_URL else None)
 dp = Dispatcher()
 router = Router()
 
 
-# ======================== HIVIEWS — ПРЯМОЙ ВЫЗОВ ========================
+# ======================== HTTP-СЕССИЯ ========================
+_http_session: Optional[aiohttp.ClientSession] = None
+
+
+def get_http_session() -> aiohttp.ClientSession:
+    """Одна пулированная сессия на весь процесс: keep-alive и без лишних TLS-рукопожатий."""
+    global _http_session
+    if _http_session is None or _http_session.closed:
+        _http_session = aiohttp.ClientSession(
+            connector=aiohttp.TCPConnector(limit=HTTP_POOL_SIZE),
+            timeout=aiohttp.ClientTimeout(total=HTTP_TIMEOUT),
+        )
+    return _http_session
+
+
+async def close_http_session():
+    global _http_session
+    if _http_session is not None and not _http_session.closed:
+        await _http_session.close()
+    _http_session = None
+
+
+# ======================== МЕТРИКИ ========================
+# Небольшой реестр в текстовом формате Prometheus (0.0.4) без внешних
+# зависимостей. Отдаётся локальным HTTP-эндпоинтом /metrics (см. MetricsServer).
+def _labels_text(names: tuple, values: tuple, le: Optional[str] = None) -> str:
+    pairs = list(zip(names, values))
+    if le is not None:
+        pairs.append(("le", le))
+    if not pairs:
+        return ""
+    escaped = (str(v).replace("\\", "\\\\").replace('"', '\\"').replace("\n", "\\n") for _, v in pairs)
+    return "{" + ",".join(f'{n}="{v}"' for (n, _), v in zip(pairs, escaped)) + "}"
+
+
+class Counter:
+    """
+    Значения по набору меток. Вместо inc() можно передать fn() — тогда
+    значение (или словарь {метки: значение}) берётся из объекта при опросе.
+    """
+    kind = "counter"
+
+    def __init__(self, name: str, doc: str, labels: tuple = (), fn=None):
+        self.name, self.doc, self.labels = name, doc, labels
+        self.fn = fn
+        self._values: dict = {}
+
+    def inc(self, value: float = 1, *label_values):
+        self._values[label_values] = self._values.get(label_values, 0) + value
+
+    def samples(self):
+        if self.fn is not None:
+            result = self.fn()
+            self._values = result if isinstance(result, dict) else {(): result}
+        for values, v in self._values.items():
+            yield f"{self.name}{_labels_text(self.labels, values)} {v}"
+
+
+class Gauge(Counter):
+    kind = "gauge"
+
+    def set(self, value: float, *label_values):
+        self._values[label_values] = value
+
+
+class Histogram:
+    kind = "histogram"
+    LATENCY = (0.001, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10)
+
+    def __init__(self, name: str, doc: str, labels: tuple = (), buckets: tuple = LATENCY):
+        self.name, self.doc, self.labels = name, doc, labels
+        self.buckets = tuple(sorted(buckets))
+        self._series: dict = {}   # значения меток -> [счётчики по корзинам, сумма, количество]
+
+    def observe(self, value: float, *label_values):
+        series = self._series.get(label_values)
+        if series is None:
+            series = self._series[label_values] = [[0] * len(self.buckets), 0.0, 0]
+        i = bisect.bisect_left(self.buckets, value)
+        if i < len(self.buckets):
+            series[0][i] += 1
+        series[1] += value
+        series[2] += 1
+
+    def samples(self):
+        for values, (counts, total, count) in self._series.items():
+            acc = 0
+            for bound, c in zip(self.buckets, counts):
+                acc += c
+                yield f"{self.name}_bucket{_labels_text(self.labels, values, str(bound))} {acc}"
+            yield f"{self.name}_bucket{_labels_text(self.labels, values, '+Inf')} {count}"
+            yield f"{self.name}_sum{_labels_text(self.labels, values)} {total}"
+            yield f"{self.name}_count{_labels_text(self.labels, values)} {count}"
+
+
+class MetricsRegistry:
+    def __init__(self, prefix: str = "dmbot_"):
+        self.prefix = prefix
+        self._metrics: list = []
+
+    def _add(self, metric):
+        metric.name = self.prefix + metric.name
+        self._metrics.append(metric)
+        return metric
+
+    def counter(self, name: str, doc: str, labels: tuple = (), fn=None) -> Counter:
+        return self._add(Counter(name, doc, labels, fn))
+
+    def gauge(self, name: str, doc: str, labels: tuple = (), fn=None) -> Gauge:
+        return self._add(Gauge(name, doc, labels, fn))
+
+    def histogram(self, name: str, doc: str, labels: tuple = (), buckets: tuple = Histogram.LATENCY) -> Histogram:
+        return self._add(Histogram(name, doc, labels, buckets))
+
+    def render(self) -> str:
+        lines = []
+        for m in self._metrics:
+            lines.append(f"# HELP {m.name} {m.doc}")
+            lines.append(f"# TYPE {m.name} {m.kind}")
+            try:
+                lines.extend(m.samples())
+            except Exception as e:
+                logger.warning(f"[Metrics] {m.name}: {e}")
+        return "\n".join(lines) + "\n"
+
+
+metrics = MetricsRegistry()
+M_HANDLER_SECONDS = metrics.histogram("handler_seconds", "Время обработки апдейта по хендлерам", ("handler",))
+M_HANDLER_ERRORS = metrics.counter("handler_errors_total", "Исключения в хендлерах", ("handler",))
+M_DB_QUERIES = metrics.counter("db_queries_total", "Запросы к SQLite", ("kind",))
+M_DB_SECONDS = metrics.histogram("db_query_seconds", "Время запроса к SQLite (с ожиданием соединения)", ("kind",))
+M_DB_PER_UPDATE = metrics.histogram("db_queries_per_update", "Запросов к SQLite на один апдейт",
+                                    buckets=(0, 1, 2, 3, 5, 8, 13, 21, 34, 55))
+M_DB_SECONDS_PER_UPDATE = metrics.histogram("db_seconds_per_update", "Время в SQLite на один апдейт")
+M_EXT_SECONDS = metrics.histogram("external_request_seconds", "Запросы к внешним API", ("service",))
+M_EXT_ERRORS = metrics.counter("external_request_errors_total", "Ошибки внешних API", ("service",))
+M_LOOP_LAG = metrics.histogram("event_loop_lag_seconds", "Задержка event loop",
+                               buckets=(0.001, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1))
+
+
+class UpdateStats:
+    """
+    Счётчики одного апдейта; текущий экземпляр лежит в contextvar _update_stats.
+    queries — обращения к Database, statements — SQL-операторы (включая
+    выполненные внутри transaction()), log — первые PROFILE_LOG_STATEMENTS
+    операторов с временем для отчёта о медленном апдейте.
+    """
+    __slots__ = ("handler", "queries", "statements", "rows", "commits", "db_time", "log")
+
+    def __init__(self):
+        self.handler = "unhandled"
+        self.queries = 0
+        self.statements = 0
+        self.rows = 0
+        self.commits = 0
+        self.db_time = 0.0
+        self.log: list = []
+
+    def note(self, sql: str, seconds: Optional[float] = None, rows: int = 0):
+        self.statements += 1
+        self.rows += rows
+        if len(self.log) < PROFILE_LOG_STATEMENTS:
+            self.log.append((seconds, " ".join(sql.split())))
+
+
+_update_stats: contextvars.ContextVar = contextvars.ContextVar("update_stats", default=None)
+
+
+def observe_query(kind: str, seconds: float, sql: str = "", rows: int = 0):
+    M_DB_QUERIES.inc(1, kind)
+    M_DB_SECONDS.observe(seconds, kind)
+    stats = _update_stats.get()
+    if stats is not None:
+        stats.queries += 1
+        stats.db_time += seconds
+        if kind != "read":
+            stats.commits += 1
+        if kind == "transaction":
+            stats.log.append((seconds, "COMMIT"))
+        else:
+            stats.note(sql, seconds, rows)
+
+
+class TracedConnection:
+    """Соединение писателя внутри transaction(): операторы попадают в профиль апдейта."""
+
+    def __init__(self, conn: aiosqlite.Connection, stats: UpdateStats):
+        self._conn = conn
+        self._stats = stats
+
+    def execute(self, sql: str, params=()):
+        self._stats.note(sql)
+        return self._conn.execute(sql, params)
+
+    def executemany(self, sql: str, seq_of_params):
+        self._stats.note(sql)
+        return self._conn.executemany(sql, seq_of_params)
+
+    def __getattr__(self, name):
+        return getattr(self._conn, name)
+
+
+class RequestTimer:
+    """with RequestTimer("cryptopay") as req: ...; req.ok = False — учёт латентности и ошибок."""
+
+    def __init__(self, service: str):
+        self.service = service
+        self.ok = True
+
+    def __enter__(self):
+        self._started = time.perf_counter()
+        return self
+
+    def __exit__(self, exc_type, exc, tb):
+        M_EXT_SECONDS.observe(time.perf_counter() - self._started, self.service)
+        if exc_type is not None or not self.ok:
+            M_EXT_ERRORS.inc(1, self.service)
+        return False
+
+
+class UpdateProfile:
+    """
+    Агрегаты по хендлерам за последний час: поминутные корзины
+    {handler: [апдейтов, секунд, операторов, строк, коммитов, макс. секунд]},
+    устаревшие минуты выпадают из deque сами.
+    """
+
+    WINDOW_MINUTES = 60
+
+    def __init__(self):
+        self._buckets: deque = deque()
+        self.slow = 0
+
+    def record(self, stats: UpdateStats, seconds: float):
+        minute = int(time.time() // 60)
+        if not self._buckets or self._buckets[-1][0] != minute:
+            self._buckets.append((minute, {}))
+            while self._buckets[0][0] <= minute - self.WINDOW_MINUTES:
+                self._buckets.popleft()
+        agg = self._buckets[-1][1].get(stats.handler)
+        if agg is None:
+            agg = self._buckets[-1][1][stats.handler] = [0, 0.0, 0, 0, 0, 0.0]
+        agg[0] += 1
+        agg[1] += seconds
+        agg[2] += stats.statements
+        agg[3] += stats.rows
+        agg[4] += stats.commits
+        agg[5] = max(agg[5], seconds)
+        if seconds * 1000 >= SLOW_UPDATE_MS or stats.statements >= SLOW_UPDATE_STATEMENTS:
+            self.slow += 1
+            self._log_slow(stats, seconds)
+
+    @staticmethod
+    def _log_slow(stats: UpdateStats, seconds: float):
+        lines = [f"  {'—' if t is None else f'{t * 1000:.1f}мс'} {sql[:200]}" for t, sql in stats.log]
+        if stats.statements > len(stats.log):
+            lines.append(f"  ... ещё {stats.statements - len(stats.log)}")
+        logger.warning(f"🐢 Медленный апдейт {stats.handler}: {seconds * 1000:.0f}мс, "
+                       f"SQL {stats.statements} (БД {stats.db_time * 1000:.0f}мс), "
+                       f"строк {stats.rows}, коммитов {stats.commits}"
+                       + "".join("\n" + line for line in lines))
+
+    def top(self, n: int = PROFILE_TOP_N) -> list[tuple]:
+        """[(handler, апдейтов, секунд, операторов, строк, коммитов, макс)] по убыванию времени."""
+        since = int(time.time() // 60) - self.WINDOW_MINUTES
+        total: dict[str, list] = {}
+        for minute, handlers in self._buckets:
+            if minute <= since:
+                continue
+            for name, agg in handlers.items():
+                acc = total.setdefault(name, [0, 0.0, 0, 0, 0, 0.0])
+                for i in range(5):
+                    acc[i] += agg[i]
+                acc[5] = max(acc[5], agg[5])
+        ranked = sorted(total.items(), key=lambda kv: kv[1][1], reverse=True)[:n]
+        return [(name, *agg) for name, agg in ranked]
+
+
+update_profile = UpdateProfile()
+
+
+class MetricsMiddleware(BaseMiddleware):
+    """
+    Внешний middleware на весь апдейт: время обработки по хендлерам,
+    число и время запросов к БД за апдейт. Имя хендлера проставляет
+    HandlerLabelMiddleware уже после того, как роутер выбрал хендлер.
+    """
+
+    async def __call__(self, handler, event: Update, data: dict):
+        stats = UpdateStats()
+        token = _update_stats.set(stats)
+        started = time.perf_counter()
+        try:
+            return await handler(event, data)
+        except Exception:
+            M_HANDLER_ERRORS.inc(1, stats.handler)
+            raise
+        finally:
+            _update_stats.reset(token)
+            elapsed = time.perf_counter() - started
+            M_HANDLER_SECONDS.observe(elapsed, stats.handler)
+            M_DB_PER_UPDATE.observe(stats.queries)
+            M_DB_SECONDS_PER_UPDATE.observe(stats.db_time)
+            update_profile.record(stats, elapsed)
+
+
+class HandlerLabelMiddleware(BaseMiddleware):
+    async def __call__(self, handler, event, data: dict):
+        stats = _update_stats.get()
+        if stats is not None:
+            stats.handler = data["handler"].callback.__name__
+        return await handler(event, data)
+
+
+dp.update.outer_middleware(MetricsMiddleware())
+router.message.middleware(HandlerLabelMiddleware())
+router.callback_query.middleware(HandlerLabelMiddleware())
+
+
+class MetricsServer:
+    """Локальный HTTP-эндпоинт /metrics и замер задержки event loop."""
+
+    LAG_INTERVAL = 0.5
+
+    def __init__(self, host: str = METRICS_HOST, port: int = METRICS_PORT):
+        self.host, self.port = host, port
+        self._runner: Optional[web.AppRunner] = None
+        self._lag_task: Optional[asyncio.Task] = None
+        self.lag = 0.0
+
+    async def _handle(self, request: web.Request) -> web.Response:
+        return web.Response(text=metrics.render(), content_type="text/plain", charset="utf-8",
+                            headers={"X-Content-Type-Options": "nosniff"})
+
+    async def _measure_lag(self):
+        while True:
+            started = time.perf_counter()
+            await asyncio.sleep(self.LAG_INTERVAL)
+            self.lag = max(0.0, time.perf_counter() - started - self.LAG_INTERVAL)
+            M_LOOP_LAG.observe(self.lag)
+
+    async def start(self):
+        self._lag_task = asyncio.create_task(self._measure_lag())
+        if not self.port:
+            return
+        app = web.Application()
+        app.router.add_get("/metrics", self._handle)
+        runner = web.AppRunner(app, access_log=None)
+        await runner.setup()
+        try:
+            await web.TCPSite(runner, self.host, self.port).start()
+        except OSError as e:
+            logger.warning(f"⚠️ Метрики: не удалось занять {self.host}:{self.port}: {e}")
+            await runner.cleanup()
+            return
+        self._runner = runner
+        logger.info(f"📈 Метрики: http://{self.host}:{self.port}/metrics")
+
+    async def stop(self):
+        if self._lag_task is not None:
+            self._lag_task.cancel()
+            await asyncio.gather(self._lag_task, return_exceptions=True)
+            self._lag_task = None
+        if self._runner is not None:
+            await self._runner.cleanup()
+            self._runner = None
+
+
+metrics_server = MetricsServer()
+metrics.gauge("event_loop_lag_last_seconds", "Последний замер задержки event loop", fn=lambda: metrics_server.lag)
+metrics.gauge("queue_depth", "Глубина очередей и буферов", ("queue",), fn=lambda: {
+    ("hiviews",): hiviews.queue_size,
+    ("notify",): timers.queue_size,
+    ("webhook_updates",): len(_webhook_tasks),
+    ("user_cache_dirty",): user_cache.dirty_count,
+})
+metrics.gauge("timers_pending", "Запланированные таймеры событий", fn=lambda: timers.pending)
+metrics.gauge("db_idle_readers", "Свободные соединения-читатели SQLite", fn=lambda: shards.idle_readers)
+metrics.gauge("user_cache_size", "Игроков в кэше", fn=lambda: len(user_cache))
+metrics.counter("hiviews_events_total", "События HiViews по исходу", ("result",), fn=lambda: {
+    ("sent",): hiviews.sent, ("failed",): hiviews.failed,
+    ("dropped",): hiviews.dropped, ("coalesced",): hiviews.coalesced,
+})
+metrics.counter("throttled_total", "Отклонённые антифлудом нажатия", fn=lambda: throttle.throttled)
+metrics.counter("webhook_rejected_total", "Апдейты webhook, отклонённые из-за перегрузки (503)",
+                fn=lambda: _webhook_rejected)
+metrics.counter("notifications_total", "Уведомления таймеров по исходу", ("result",), fn=lambda: {
+    ("sent",): timers.sent, ("dropped",): timers.dropped,
+})
+
+
+# ======================== HIVIEWS — ОЧЕРЕДЬ ДОСТАВКИ ========================
 async def send_hiviews(user_id: int, message_id: int, user_first_name: str,
-                       language_code: str, is_start: bool):
+                       language_code: str, is_start: bool) -> bool:
     """
     Отправляет данные на HiViews API для автоматического показа рекламы.
-    Вызывается напрямую из хендлеров (не через middleware).
+    Вызывается воркерами HiViewsDispatcher, хендлеры ставят событие в очередь.
     Основано на официальном примере интеграции:
       URL: https://hiviews.net/sendMessage
       Auth: заголовок Authorization с API ключом
     """
     if not HIVIEWS_API_KEY:
-        return
+        return False
     try:
         headers = {
             'Authorization': HIVIEWS_API_KEY,
@@ -156,25 +639,123 @@ async def send_hiviews(user_id: int, message_id: int, user_first_name: str,
             'LanguageCode': language_code or 'ru',
             'StartPlace': is_start,
         }
-        async with aiohttp.ClientSession() as session:
-            async with session.post(HIVIEWS_API_URL, headers=headers, json=payload) as response:
+        with RequestTimer("hiviews") as req:
+            async with get_http_session().post(HIVIEWS_API_URL, headers=headers, json=payload) as response:
                 resp_text = await response.text('utf-8')
-                logger.info(f'[HiViews] status={response.status} user={user_id} '
-                            f'start={is_start} response={resp_text}')
+                req.ok = response.status < 400
+        logger.info(f'[HiViews] status={response.status} user={user_id} '
+                    f'start={is_start} response={resp_text}')
+        return req.ok
     except Exception as e:
         logger.warning(f'[HiViews] Error sending for user={user_id}: {e}')
+        return False
+
+
+class HiViewsDispatcher:
+    """
+    Ограниченная очередь доставки HiViews с фиксированным числом воркеров.
+    Пока событие игрока ждёт в очереди, новые клики лишь обновляют его
+    (склейка); после отправки клики того же игрока в течение окна
+    coalesce_ms тоже склеиваются. Переполненная очередь отбрасывает новые
+    события — реклама не должна тормозить игру.
+    """
+
+    def __init__(self, queue_size: int = HIVIEWS_QUEUE_SIZE, workers: int = HIVIEWS_WORKERS,
+                 coalesce_ms: int = HIVIEWS_COALESCE_MS):
+        self.workers = max(1, workers)
+        self.window = coalesce_ms / 1000
+        self._queue: asyncio.Queue = asyncio.Queue(maxsize=max(1, queue_size))
+        self._pending: dict = {}
+        self._last_sent: dict = {}
+        self._tasks: list = []
+        self.sent = 0
+        self.dropped = 0
+        self.failed = 0
+        self.coalesced = 0
+
+    @property
+    def queue_size(self) -> int:
+        return self._queue.qsize()
+
+    def submit(self, event: dict):
+        """Ставит событие в очередь без ожидания (вызывается из хендлеров)."""
+        if not HIVIEWS_API_KEY or not self._tasks:
+            return
+        uid = event["user_id"]
+        if uid in self._pending:
+            # Start-событие важнее обычного клика — его не перетираем
+            if not self._pending[uid]["is_start"]:
+                self._pending[uid] = event
+            self.coalesced += 1
+            return
+        last = self._last_sent.get(uid)
+        if last is not None and time.monotonic() - last < self.window and not event["is_start"]:
+            self.coalesced += 1
+            return
+        try:
+            self._queue.put_nowait(uid)
+        except asyncio.QueueFull:
+            self.dropped += 1
+            return
+        self._pending[uid] = event
+
+    def _prune(self):
+        if len(self._last_sent) < 10_000:
+            return
+        deadline = time.monotonic() - self.window
+        self._last_sent = {u: t for u, t in self._last_sent.items() if t >= deadline}
+
+    async def _worker(self):
+        while True:
+            uid = await self._queue.get()
+            try:
+                event = self._pending.pop(uid, None)
+                if event is None:
+                    continue
+                self._last_sent[uid] = time.monotonic()
+                if await send_hiviews(**event):
+                    self.sent += 1
+                else:
+                    self.failed += 1
+                self._prune()
+            finally:
+                self._queue.task_done()
+
+    def start(self):
+        if not self._tasks:
+            self._tasks = [asyncio.create_task(self._worker()) for _ in range(self.workers)]
+
+    async def stop(self, timeout: float = 5):
+        """Дожидается отправки очереди (не дольше timeout) и останавливает воркеров."""
+        if not self._tasks:
+            return
+        try:
+            await asyncio.wait_for(self._queue.join(), timeout)
+        except asyncio.TimeoutError:
+            self.dropped += self._queue.qsize()
+        for task in self._tasks:
+            task.cancel()
+        await asyncio.gather(*self._tasks, return_exceptions=True)
+        self._tasks = []
+
+    def stats(self) -> dict:
+        return {"sent": self.sent, "dropped": self.dropped, "failed": self.failed,
+                "coalesced": self.coalesced, "queued": self.queue_size}
+
+
+hiviews = HiViewsDispatcher()
 
 
 def fire_hiviews(user_id: int, message_id: int, user_first_name: str,
                  language_code: str, is_start: bool = False):
-    """Запускает send_hiviews как фоновую задачу (fire-and-forget)."""
-    asyncio.create_task(send_hiviews(
-        user_id=user_id,
-        message_id=message_id,
-        user_first_name=user_first_name,
-        language_code=language_code,
-        is_start=is_start,
-    ))
+    """Ставит событие HiViews в очередь доставки (fire-and-forget)."""
+    hiviews.submit({
+        "user_id": user_id,
+        "message_id": message_id,
+        "user_first_name": user_first_name,
+        "language_code": language_code,
+        "is_start": is_start,
+    })
 
 
 def fire_hiviews_message(message: Message, is_start: bool = False):
@@ -362,6 +943,49 @@ CRAFT_RECIPES = {
     },
 }
 
+# ===================== КАТАЛОГ ПРЕДМЕТОВ =====================
+# Магазин, гем-магазин и крафт сведены в один индекс при старте. Эффект
+# каждого предмета заранее разложен в вектор по STAT_FIELDS, так что статы
+# игрока — это сложение нескольких кортежей, а не обход словарей эффектов.
+STAT_FIELDS = ("atk", "def", "crit", "hp", "max_hp")
+
+
+@dataclass(frozen=True)
+class CatalogItem:
+    key: str
+    name: str
+    type: str
+    slot: Optional[str]
+    stats: tuple        # прибавки по STAT_FIELDS
+    xp_mult: float      # множители действуют только у баффов
+    gold_mult: float
+    gem_luck: int
+
+
+def compile_item_catalog() -> dict:
+    catalog = {}
+    # Порядок источников — как в прежних цепочках SHOP or GEM_SHOP or CRAFT
+    for source in (SHOP_ITEMS, GEM_SHOP_ITEMS, CRAFT_RECIPES):
+        for key, item in source.items():
+            if key in catalog:
+                continue
+            effect = item.get("effect", {})
+            catalog[key] = CatalogItem(
+                key=key, name=item["name"], type=item.get("type") or item.get("result_type"),
+                slot=item.get("slot"), stats=tuple(effect.get(f, 0) for f in STAT_FIELDS),
+                xp_mult=effect.get("xp_mult", 1.0), gold_mult=effect.get("gold_mult", 1.0),
+                gem_luck=effect.get("gem_luck", 0),
+            )
+    return catalog
+
+
+ITEM_CATALOG = compile_item_catalog()
+
+
+def item_name(key: str) -> str:
+    item = ITEM_CATALOG.get(key)
+    return item.name if item else key
+
 ACHIEVEMENTS = {
     "first_blood": {"name": "🩸 Первая кровь", "desc": "Убей первого монстра", "check": "dungeon_wins",
                     "value": 1, "reward_gold": 20, "reward_gems": 1},
@@ -458,68 +1082,1780 @@ SLOT_PAYOUTS = {
 
 
 # ======================== БАЗА ДАННЫХ ========================
-async def init_db():
-    async with aiosqlite.connect(DB_PATH) as db:
-        await db.executescript("""
-            CREATE TABLE IF NOT EXISTS users (
-                user_id INTEGER PRIMARY KEY, username TEXT DEFAULT '', class TEXT DEFAULT '',
-                level INTEGER DEFAULT 1, xp INTEGER DEFAULT 0, xp_needed INTEGER DEFAULT 100,
-                hp INTEGER DEFAULT 100, max_hp INTEGER DEFAULT 100, atk INTEGER DEFAULT 10,
-                def INTEGER DEFAULT 5, crit INTEGER DEFAULT 5, gold INTEGER DEFAULT 50,
-                gems INTEGER DEFAULT 0, wins INTEGER DEFAULT 0, losses INTEGER DEFAULT 0,
-                dungeon_wins INTEGER DEFAULT 0, boss_kills INTEGER DEFAULT 0,
-                elite_kills INTEGER DEFAULT 0, total_gold_earned INTEGER DEFAULT 0,
-                total_gems_earned INTEGER DEFAULT 0, total_spent_usd REAL DEFAULT 0,
-                inventory TEXT DEFAULT '{}', equipment TEXT DEFAULT '{}',
-                buffs TEXT DEFAULT '[]', achievements TEXT DEFAULT '[]',
-                daily_claimed TEXT DEFAULT '', streak INTEGER DEFAULT 0,
-                energy INTEGER DEFAULT 10, max_energy INTEGER DEFAULT 10,
-                last_energy TEXT DEFAULT '', vip_until TEXT DEFAULT '',
-                expedition TEXT DEFAULT '', expedition_start TEXT DEFAULT '',
-                wheel_spins INTEGER DEFAULT 0, last_wheel TEXT DEFAULT '',
-                crafts_done INTEGER DEFAULT 0, chests_opened INTEGER DEFAULT 0,
-                referrer_id INTEGER DEFAULT 0, referral_count INTEGER DEFAULT 0,
-                created_at TEXT DEFAULT '', is_banned INTEGER DEFAULT 0
-            );
-            CREATE TABLE IF NOT EXISTS payments (
-                id INTEGER PRIMARY KEY AUTOINCREMENT, user_id INTEGER, invoice_id INTEGER,
-                item_key TEXT, amount_usd REAL, status TEXT DEFAULT 'pending',
-                created_at TEXT DEFAULT '', paid_at TEXT DEFAULT ''
-            );
-            CREATE TABLE IF NOT EXISTS promo_codes (
-                code TEXT PRIMARY KEY, gold INTEGER DEFAULT 0, gems INTEGER DEFAULT 0,
-                max_uses INTEGER DEFAULT 1, used_count INTEGER DEFAULT 0, created_at TEXT DEFAULT ''
-            );
-            CREATE TABLE IF NOT EXISTS promo_uses (user_id INTEGER, code TEXT, PRIMARY KEY (user_id, code));
-        """)
-        await db.commit()
+class Database:
+    """
+    Долгоживущие соединения с SQLite вместо connect() на каждый запрос.
+    Один писатель (все записи сериализуются через write-lock) и пул читателей.
+    Открывается в main() и закрывается при остановке бота.
+    """
 
+    def __init__(self, path: str, readers: int = DB_READERS):
+        self.path = path
+        self.readers_count = max(1, readers)
+        self._writer: Optional[aiosqlite.Connection] = None
+        self._readers: asyncio.Queue = asyncio.Queue()
+        self._connections: list = []
+        self._write_lock = asyncio.Lock()
+
+    async def _connect(self, readonly: bool = False) -> aiosqlite.Connection:
+        conn = await aiosqlite.connect(self.path, cached_statements=DB_STATEMENT_CACHE)
+        conn.row_factory = aiosqlite.Row
+        await conn.execute_fetchall(f"PRAGMA busy_timeout = {DB_BUSY_TIMEOUT_MS}")
+        await conn.execute_fetchall("PRAGMA synchronous = NORMAL")
+        if readonly:
+            await conn.execute_fetchall("PRAGMA query_only = 1")
+        self._connections.append(conn)
+        return conn
+
+    async def start(self):
+        if self._writer is not None:
+            return
+        try:
+            self._writer = await self._connect()
+            await self._writer.execute_fetchall("PRAGMA journal_mode = WAL")
+            for _ in range(self.readers_count):
+                self._readers.put_nowait(await self._connect(readonly=True))
+        except Exception:
+            await self.close()
+            raise
+        logger.info(f"🗄️ SQLite: WAL, 1 писатель + {self.readers_count} читателей")
+
+    async def close(self):
+        for conn in self._connections:
+            try:
+                await conn.close()
+            except Exception as e:
+                logger.warning(f"[DB] Ошибка закрытия соединения: {e}")
+        self._connections.clear()
+        self._writer = None
+        self._readers = asyncio.Queue()
+
+    # ----- чтение (пул читателей) -----
+    # Время каждого вызова (вместе с ожиданием соединения или write-lock)
+    # уходит в метрики и в профиль текущего апдейта — см. observe_query.
+    async def fetchall(self, sql: str, params: tuple = ()) -> list[dict]:
+        started, rows = time.perf_counter(), []
+        conn = await self._readers.get()
+        try:
+            rows = [dict(r) for r in await conn.execute_fetchall(sql, params)]
+            return rows
+        finally:
+            self._readers.put_nowait(conn)
+            observe_query("read", time.perf_counter() - started, sql, len(rows))
+
+    async def fetchone(self, sql: str, params: tuple = ()) -> Optional[dict]:
+        started, row = time.perf_counter(), None
+        conn = await self._readers.get()
+        try:
+            async with conn.execute(sql, params) as cur:
+                row = await cur.fetchone()
+                return dict(row) if row else None
+        finally:
+            self._readers.put_nowait(conn)
+            observe_query("read", time.perf_counter() - started, sql, 1 if row else 0)
+
+    async def fetchval(self, sql: str, params: tuple = (), default=None):
+        started, row = time.perf_counter(), None
+        conn = await self._readers.get()
+        try:
+            async with conn.execute(sql, params) as cur:
+                row = await cur.fetchone()
+                return row[0] if row and row[0] is not None else default
+        finally:
+            self._readers.put_nowait(conn)
+            observe_query("read", time.perf_counter() - started, sql, 1 if row else 0)
+
+    @property
+    def idle_readers(self) -> int:
+        return self._readers.qsize()
+
+    # ----- запись (единственный писатель) -----
+    async def execute(self, sql: str, params: tuple = ()) -> int:
+        """Одна запись в отдельной транзакции. Возвращает rowcount."""
+        started, rowcount = time.perf_counter(), 0
+        async with self._write_lock:
+            try:
+                async with self._writer.execute(sql, params) as cur:
+                    rowcount = cur.rowcount
+                await self._writer.commit()
+                return rowcount
+            except Exception:
+                await self._writer.rollback()
+                raise
+            finally:
+                observe_query("write", time.perf_counter() - started, sql, max(rowcount, 0))
+
+    async def executemany(self, sql: str, seq_of_params: list) -> None:
+        started = time.perf_counter()
+        async with self._write_lock:
+            try:
+                await self._writer.executemany(sql, seq_of_params)
+                await self._writer.commit()
+            except Exception:
+                await self._writer.rollback()
+                raise
+            finally:
+                observe_query("write", time.perf_counter() - started, sql, len(seq_of_params))
+
+    async def executescript(self, script: str):
+        async with self._write_lock:
+            await self._writer.executescript(script)
+            await self._writer.commit()
+
+    @asynccontextmanager
+    async def transaction(self):
+        """
+        Несколько записей одной транзакцией на соединении писателя.
+        Внутри блока не должно быть сетевых вызовов — лок держит всех писателей.
+        """
+        started = time.perf_counter()
+        stats = _update_stats.get()
+        async with self._write_lock:
+            try:
+                yield self._writer if stats is None else TracedConnection(self._writer, stats)
+                await self._writer.commit()
+            except BaseException:
+                await self._writer.rollback()
+                raise
+            finally:
+                observe_query("transaction", time.perf_counter() - started)
+
+
+database = Database(DB_PATH)
+
+# Таблицы с данными игроков (ключ — user_id) — живут в шардах. Остальные
+# (промокоды, рассылки, справочник предметов, настройки) — только в основной базе.
+SHARDED_TABLES = ("users", "user_items", "user_equipment", "user_buffs", "user_achievements", "payments")
+
+
+def shard_path(path: str, index: int, count: int) -> str:
+    """dungeon_master.db -> dungeon_master.shard0of4.db; при count=1 — сама основная база."""
+    if count <= 1:
+        return path
+    root, ext = os.path.splitext(path)
+    return f"{root}.shard{index}of{count}{ext}"
+
+
+class ShardSet:
+    """
+    Данные игроков по DB_SHARDS файлам SQLite: игрок живёт в шарде user_id % N,
+    у каждого шарда свой писатель и пул читателей, так что записи разных
+    шардов не ждут друг друга. Глобальные выборки (рейтинги, статистика,
+    рассылки) опрашивают все шарды параллельно, объединяет их вызывающий.
+    При DB_SHARDS=1 единственный шард — основная база, всё как раньше.
+    Схема во всех файлах одинаковая, общие таблицы в шардах просто пустуют.
+    """
 
-async def get_user(user_id: int) -> Optional[dict]:
-    async with aiosqlite.connect(DB_PATH) as db:
-        db.row_factory = aiosqlite.Row
-        async with db.execute("SELECT * FROM users WHERE user_id = ?", (user_id,)) as cur:
-            row = await cur.fetchone()
-            return dict(row) if row else None
+    def __init__(self, main: Database, count: int = DB_SHARDS):
+        self.main = main
+        self.count = max(1, count)
+        self.all = [main] if self.count == 1 else [
+            Database(shard_path(main.path, i, self.count)) for i in range(self.count)]
+
+    def for_user(self, user_id: int) -> Database:
+        return self.all[user_id % self.count]
+
+    def group(self, user_ids) -> dict:
+        """{шард: [user_id, ...]} — чтобы писать пачками по шардам."""
+        groups: dict = {}
+        for uid in user_ids:
+            groups.setdefault(self.for_user(uid), []).append(uid)
+        return groups
+
+    @property
+    def paths(self) -> list:
+        return [db.path for db in self.all]
+
+    @property
+    def idle_readers(self) -> int:
+        return sum(db.idle_readers for db in self.all)
+
+    async def start(self):
+        for db in self.all:
+            if db is not self.main:
+                await db.start()
+
+    async def close(self):
+        for db in self.all:
+            if db is not self.main:
+                await db.close()
+
+    async def fetchall(self, sql: str, params: tuple = ()) -> list[dict]:
+        """Строки со всех шардов подряд; сортировку и LIMIT после слияния делает вызывающий."""
+        if self.count == 1:
+            return await self.main.fetchall(sql, params)
+        parts = await asyncio.gather(*(db.fetchall(sql, params) for db in self.all))
+        return [row for part in parts for row in part]
+
+    async def fetchval_sum(self, sql: str, params: tuple = (), default=0):
+        """Сумма скалярного агрегата (COUNT/SUM) по всем шардам."""
+        if self.count == 1:
+            return await self.main.fetchval(sql, params, default=default)
+        values = await asyncio.gather(*(db.fetchval(sql, params, default=default) for db in self.all))
+        return sum(values)
+
+
+shards = ShardSet(database)
+
+
+# Инвентарь, экипировка, баффы и достижения живут в отдельных таблицах
+# (user_items, user_equipment, user_buffs, user_achievements). В словаре
+# игрока это обычные структуры: {ключ: кол-во}, {слот: ключ},
+# [{"key", "name", "effect"}], [ключ достижения].
+COLLECTIONS = ("inventory", "equipment", "buffs", "achievements")
+COLLECTIONS_SET = frozenset(COLLECTIONS)
+
+# Целочисленные id предметов (таблица items), загружаются при старте
+ITEM_IDS: dict = {}
+ITEM_KEYS: dict = {}
+
+
+def clone_collections(data: dict) -> dict:
+    """Копии коллекций игрока, чтобы изменения хендлера не задели кэш."""
+    return {
+        "inventory": dict(data["inventory"]),
+        "equipment": dict(data["equipment"]),
+        "buffs": [dict(b, effect=dict(b["effect"])) for b in data["buffs"]],
+        "achievements": list(data["achievements"]),
+    }
 
 
-async def create_user(user_id: int, username: str):
-    now = datetime.now().isoformat()
-    async with aiosqlite.connect(DB_PATH) as db:
-        await db.execute(
+def make_buff(key: str, fights_left: Optional[int] = None) -> dict:
+    item = SHOP_ITEMS.get(key) or GEM_SHOP_ITEMS.get(key)
+    effect = dict(item["effect"])
+    if fights_left is not None:
+        effect["duration"] = fights_left
+    return {"key": key, "name": item["name"], "effect": effect}
+
+
+def collections_from_rows(rows) -> dict:
+    """Собирает коллекции из строк вида (kind, item_id, n, tag) — см. UserCache._load."""
+    data = {"inventory": {}, "equipment": {}, "buffs": [], "achievements": []}
+    buffs = []
+    for kind, item_id, n, tag in rows:
+        key = ITEM_KEYS.get(item_id)
+        if kind == "i" and key:
+            data["inventory"][key] = n
+        elif kind == "e" and key:
+            data["equipment"][tag] = key
+        elif kind == "b" and key:
+            buffs.append((int(tag), make_buff(key, n)))
+        elif kind == "a":
+            data["achievements"].append(tag)
+    data["buffs"] = [b for _, b in sorted(buffs, key=lambda x: x[0])]
+    return data
+
+
+def collection_ops(uid: int, field: str, old, new) -> dict:
+    """Построчная разница коллекции: {sql: [params, ...]} для executemany."""
+    ops: dict = {}
+
+    def add(sql, params):
+        ops.setdefault(sql, []).append(params)
+
+    if field == "inventory":
+        for key, cnt in new.items():
+            if cnt > 0 and old.get(key) != cnt:
+                add("INSERT INTO user_items (user_id, item_id, count) VALUES (?, ?, ?) "
+                    "ON CONFLICT(user_id, item_id) DO UPDATE SET count = excluded.count",
+                    (uid, ITEM_IDS[key], cnt))
+        for key in old:
+            if new.get(key, 0) <= 0:
+                add("DELETE FROM user_items WHERE user_id = ? AND item_id = ?", (uid, ITEM_IDS[key]))
+    elif field == "equipment":
+        for slot, key in new.items():
+            if old.get(slot) != key:
+                add("INSERT INTO user_equipment (user_id, slot, item_id) VALUES (?, ?, ?) "
+                    "ON CONFLICT(user_id, slot) DO UPDATE SET item_id = excluded.item_id",
+                    (uid, slot, ITEM_IDS[key]))
+        for slot in old:
+            if slot not in new:
+                add("DELETE FROM user_equipment WHERE user_id = ? AND slot = ?", (uid, slot))
+    elif field == "buffs":
+        for no, buff in enumerate(new):
+            if no >= len(old) or old[no] != buff:
+                add("INSERT INTO user_buffs (user_id, buff_no, item_id, fights_left) VALUES (?, ?, ?, ?) "
+                    "ON CONFLICT(user_id, buff_no) DO UPDATE SET item_id = excluded.item_id, "
+                    "fights_left = excluded.fights_left",
+                    (uid, no, ITEM_IDS[buff["key"]], buff["effect"].get("duration", 0)))
+        if len(old) > len(new):
+            add("DELETE FROM user_buffs WHERE user_id = ? AND buff_no >= ?", (uid, len(new)))
+    elif field == "achievements":
+        old_set, new_set = set(old), set(new)
+        for key in new_set - old_set:
+            add("INSERT OR IGNORE INTO user_achievements (user_id, achievement) VALUES (?, ?)", (uid, key))
+        for key in old_set - new_set:
+            add("DELETE FROM user_achievements WHERE user_id = ? AND achievement = ?", (uid, key))
+    return ops
+
+
+# ===================== ХРАНИЛИЩЕ =====================
+class Storage(Protocol):
+    """
+    Всё постоянное состояние игры: игроки, платежи, промокоды, рассылки и
+    агрегаты для админки. Хендлеры и фоновые службы ходят только сюда —
+    SQL живёт в реализациях: SQLiteStorage (рабочая, с шардами) и
+    MemoryStorage (словари в памяти). Выбирается переменной STORAGE.
+    Строки — обычные словари с колонками таблиц; коллекции игрока
+    (inventory, equipment, buffs, achievements) — как в UserCache.
+    """
+
+    async def start(self): ...
+
+    async def close(self): ...
+
+    def describe(self) -> str:
+        """Одна строка для экрана «Система» в админке."""
+
+    # --- игроки ---
+    async def register_items(self, keys: list) -> dict:
+        """Регистрирует ключи предметов и возвращает всю карту {ключ: id}."""
+
+    async def load_user(self, user_id: int) -> Optional[dict]: ...
+
+    async def create_user(self, user_id: int, username: str, now: str): ...
+
+    def write_groups(self, user_ids) -> list:
+        """Делит игроков на группы, каждая из которых пишется save_users атомарно."""
+
+    async def save_users(self, batch: dict, old: dict, new: dict):
+        """
+        batch — {user_id: {поле: значение}} одной группы write_groups;
+        old/new — сохранённые и текущие коллекции игроков (для построчной разницы).
+        """
+
+    async def top_users(self, order_by: str, limit: int, fields: Optional[tuple] = None) -> list:
+        """
+        Активные незабаненные по (order_by DESC, xp DESC, user_id). order_by — проверенная
+        колонка; fields (None — все колонки) должны включать order_by, xp и user_id.
+        """
+
+    async def pvp_candidates(self) -> list:
+        """Активные незабаненные со статами, экипировкой и баффами — для MatchmakingPool."""
+
+    async def timer_candidates(self, now: str) -> list:
+        """Игроки, у которых может сработать таймер события (см. EventTimers.timers_for)."""
+
+    async def count_recipients(self) -> int: ...
+
+    async def broadcast_recipients(self, after: int, limit: int) -> list:
+        """Следующие limit получателей рассылки с user_id > after, по возрастанию."""
+
+    # --- платежи ---
+    async def add_payment(self, user_id: int, invoice_id: int, item_key: str, amount_usd: float,
+                          created_at: str): ...
+
+    async def get_payment(self, user_id: int, invoice_id: int) -> Optional[dict]: ...
+
+    async def pending_payments(self) -> list:
+        """Все pending-платежи по возрастанию created_at."""
+
+    async def mark_paid(self, payment: dict, paid_at: str, add: dict, assign: dict) -> Optional[dict]:
+        """
+        Переводит pending-платёж в paid и начисляет игроку награду (add —
+        прибавки к колонкам, assign — новые значения) атомарно. Возвращает
+        записанные значения этих колонок ({} — игрока нет); None — платёж
+        уже не pending, ничего не изменено.
+        """
+
+    async def expire_payment(self, payment: dict) -> bool: ...
+
+    # --- промокоды ---
+    async def add_promo(self, code: str, gold: int, gems: int, max_uses: int, created_at: str): ...
+
+    async def redeem_promo(self, code: str, user_id: int) -> tuple:
+        """
+        Проверяет и списывает использование атомарно. Возвращает (статус, промокод),
+        статус — "ok", "not_found", "exhausted" или "used".
+        """
+
+    async def recent_promos(self, limit: int) -> list: ...
+
+    # --- рассылки ---
+    async def create_broadcast(self, text: str, total: int, created_by: int, created_at: str) -> dict: ...
+
+    async def running_broadcasts(self) -> list: ...
+
+    async def save_broadcast(self, job: dict):
+        """Курсор и счётчики идущей рассылки."""
+
+    async def finish_broadcast(self, job_id: int, status: str, finished_at: str): ...
+
+    async def recent_broadcasts(self, limit: int) -> list: ...
+
+    # --- агрегаты ---
+    async def count_users(self, created_since: Optional[str] = None) -> int: ...
+
+    async def world_stats(self, active_since: str) -> dict:
+        """Суммы по игрокам для статистики мира и админки (avg_level считает вызывающий)."""
+
+    async def payment_totals(self) -> dict:
+        """{"payments": число оплаченных, "revenue": сумма в USD}."""
+
+    async def revenue_by_day(self, since: str) -> list:
+        """[{"day", "total", "cnt"}] оплаченных с paid_at >= since, по возрастанию дня."""
+
+    async def top_donors(self, limit: int) -> list: ...
+
+    async def donor_stats(self, now: str) -> dict:
+        """{"revenue", "paying", "vip"} по колонкам users."""
+
+    async def item_stats(self, item_id: int) -> dict:
+        """{"owners", "in_inventory", "equipped"} для предмета."""
+
+
+class SQLiteStorage:
+    """
+    Рабочее хранилище: SQLite с пулом соединений (Database). Данные игроков —
+    по шардам ShardSet, глобальные таблицы (items, promo_codes, broadcasts,
+    settings) — в основной базе. Глобальные выборки опрашивают все шарды
+    параллельно и сливают результат здесь же.
+    """
+
+    # Вся статистика мира — один проход по users вместо ~14 агрегатов
+    WORLD_STATS_SQL = (
+        "SELECT "
+        "COALESCE(SUM(class != ''), 0) AS total_players, "
+        "COALESCE(SUM(CASE WHEN class != '' THEN level END), 0) AS level_sum, "
+        "COALESCE(MAX(CASE WHEN class != '' THEN level END), 0) AS max_level, "
+        "COALESCE(SUM(dungeon_wins), 0) AS total_fights, "
+        "COALESCE(SUM(boss_kills), 0) AS total_bosses, "
+        "COALESCE(SUM(wins), 0) AS total_pvp, "
+        "COALESCE(SUM(elite_kills), 0) AS total_elites, "
+        "COALESCE(SUM(total_gold_earned), 0) AS total_gold, "
+        "COALESCE(SUM(total_gems_earned), 0) AS total_gems, "
+        "COALESCE(SUM(chests_opened), 0) AS total_chests, "
+        "COALESCE(SUM(crafts_done), 0) AS total_crafts, "
+        "COALESCE(SUM(last_energy >= ?), 0) AS active_24h, "
+        + ", ".join(f"COALESCE(SUM(class = '{cls}'), 0) AS class_{cls}" for cls in CLASSES)
+        + " FROM users"
+    )
+
+    def __init__(self, db: ShardSet):
+        self.db = db
+        self.main = db.main
+
+    async def start(self):
+        await self.main.start()
+        await self.db.start()
+        await init_db(self.db)
+
+    async def close(self):
+        await self.db.close()
+        await self.main.close()
+
+    def describe(self) -> str:
+        paths = set(self.db.paths) | {self.main.path}
+        size = sum(os.path.getsize(p) for p in paths if os.path.exists(p))
+        return (f"{size / 1024:.1f} KB (WAL, шардов: {self.db.count}, "
+                f"читателей на шард: {self.main.readers_count})")
+
+    # --- игроки ---
+    async def register_items(self, keys: list) -> dict:
+        await self.main.executemany("INSERT OR IGNORE INTO items (key) VALUES (?)", [(k,) for k in keys])
+        return {row["key"]: row["item_id"] for row in await self.main.fetchall("SELECT item_id, key FROM items")}
+
+    async def load_user(self, user_id: int) -> Optional[dict]:
+        db = self.db.for_user(user_id)
+        row = await db.fetchone("SELECT * FROM users WHERE user_id = ?", (user_id,))
+        if row is None:
+            return None
+        # Все коллекции игрока — одним запросом
+        items = await db.fetchall(
+            "SELECT 'i' AS kind, item_id, count AS n, NULL AS tag FROM user_items WHERE user_id = ? "
+            "UNION ALL SELECT 'e', item_id, NULL, slot FROM user_equipment WHERE user_id = ? "
+            "UNION ALL SELECT 'b', item_id, fights_left, buff_no FROM user_buffs WHERE user_id = ? "
+            "UNION ALL SELECT 'a', NULL, NULL, achievement FROM user_achievements WHERE user_id = ?",
+            (user_id,) * 4)
+        row.update(collections_from_rows((r["kind"], r["item_id"], r["n"], r["tag"]) for r in items))
+        return row
+
+    async def create_user(self, user_id: int, username: str, now: str):
+        await self.db.for_user(user_id).execute(
             "INSERT OR IGNORE INTO users (user_id, username, created_at, last_energy) VALUES (?, ?, ?, ?)",
             (user_id, username, now, now))
-        await db.commit()
+
+    def write_groups(self, user_ids) -> list:
+        # Одна транзакция на шард, шарды пишутся параллельно
+        return list(self.db.group(user_ids).values())
+
+    async def save_users(self, batch: dict, old: dict, new: dict):
+        # Колонки users группируем по набору полей (один executemany на группу),
+        # коллекции — построчными upsert/delete в свои таблицы
+        groups: dict = {}
+        coll_ops: dict = {}
+        for uid, fields in batch.items():
+            cols = tuple(sorted(f for f in fields if f not in COLLECTIONS_SET))
+            if cols:
+                groups.setdefault(cols, []).append(tuple(fields[c] for c in cols) + (uid,))
+            for f in COLLECTIONS_SET.intersection(fields):
+                for sql, params in collection_ops(uid, f, old[uid][f], new[uid][f]).items():
+                    coll_ops.setdefault(sql, []).extend(params)
+        async with self.db.for_user(next(iter(batch))).transaction() as conn:
+            for cols, rows in groups.items():
+                sets = ", ".join(f'"{c}" = ?' for c in cols)
+                await conn.executemany(f"UPDATE users SET {sets} WHERE user_id = ?", rows)
+            for sql, rows in coll_ops.items():
+                await conn.executemany(sql, rows)
+
+    async def top_users(self, order_by: str, limit: int, fields: Optional[tuple] = None) -> list:
+        cols = ", ".join(f'"{f}"' for f in fields) if fields else "*"
+        # Топ каждого шарда, затем общий топ из их объединения
+        rows = await self.db.fetchall(
+            f"SELECT {cols} FROM users WHERE class != '' AND is_banned = 0 "
+            f'ORDER BY "{order_by}" DESC, xp DESC LIMIT ?', (limit,))
+        return sorted(rows, key=lambda r: (-r[order_by], -r["xp"], r["user_id"]))[:limit]
+
+    async def pvp_candidates(self) -> list:
+        rows = await self.db.fetchall(
+            "SELECT user_id, username, class, level, atk, def, crit, hp, max_hp "
+            "FROM users WHERE class != '' AND is_banned = 0")
+        extra: dict = {}
+        for r in await self.db.fetchall("SELECT 'e' AS kind, user_id, item_id, NULL AS n, slot AS tag "
+                                        "FROM user_equipment UNION ALL "
+                                        "SELECT 'b', user_id, item_id, fights_left, buff_no FROM user_buffs"):
+            extra.setdefault(r["user_id"], []).append((r["kind"], r["item_id"], r["n"], r["tag"]))
+        for row in rows:
+            row.update(collections_from_rows(extra.get(row["user_id"], ())))
+        return rows
+
+    async def timer_candidates(self, now: str) -> list:
+        return await self.db.fetchall(
+            "SELECT user_id, class, is_banned, bot_blocked, expedition, expedition_start, "
+            "energy, max_energy, last_energy, vip_until FROM users "
+            "WHERE class != '' AND is_banned = 0 AND bot_blocked = 0 "
+            "AND (expedition != '' OR energy < max_energy OR vip_until > ?)", (now,))
+
+    async def count_recipients(self) -> int:
+        return await self.db.fetchval_sum("SELECT COUNT(*) FROM users WHERE is_banned = 0 AND bot_blocked = 0")
+
+    async def broadcast_recipients(self, after: int, limit: int) -> list:
+        # Пачка с каждого шарда, из объединения — первые limit по user_id
+        rows = await self.db.fetchall(
+            "SELECT user_id FROM users WHERE user_id > ? AND is_banned = 0 AND bot_blocked = 0 "
+            "ORDER BY user_id LIMIT ?", (after, limit))
+        return sorted(r["user_id"] for r in rows)[:limit]
+
+    # --- платежи (лежат в шарде игрока) ---
+    async def add_payment(self, user_id: int, invoice_id: int, item_key: str, amount_usd: float,
+                          created_at: str):
+        await self.db.for_user(user_id).execute(
+            "INSERT INTO payments (user_id, invoice_id, item_key, amount_usd, created_at) "
+            "VALUES (?,?,?,?,?)", (user_id, invoice_id, item_key, amount_usd, created_at))
+
+    async def get_payment(self, user_id: int, invoice_id: int) -> Optional[dict]:
+        return await self.db.for_user(user_id).fetchone(
+            "SELECT * FROM payments WHERE invoice_id = ? AND user_id = ?", (invoice_id, user_id))
+
+    async def pending_payments(self) -> list:
+        rows = await self.db.fetchall("SELECT * FROM payments WHERE status='pending'")
+        rows.sort(key=lambda p: p["created_at"])
+        return rows
+
+    async def mark_paid(self, payment: dict, paid_at: str, add: dict, assign: dict) -> Optional[dict]:
+        sets = [f'"{c}" = "{c}" + ?' for c in add] + [f'"{c}" = ?' for c in assign]
+        cols = ", ".join(f'"{c}"' for c in (*add, *assign))
+        # Статус платежа и награда — одной транзакцией шарда игрока
+        async with self.db.for_user(payment["user_id"]).transaction() as conn:
+            cur = await conn.execute(
+                "UPDATE payments SET status='paid', paid_at=? WHERE id=? AND status='pending'",
+                (paid_at, payment["id"]))
+            if cur.rowcount != 1:
+                return None
+            await conn.execute(f"UPDATE users SET {', '.join(sets)} WHERE user_id = ?",
+                               (*add.values(), *assign.values(), payment["user_id"]))
+            async with conn.execute(f"SELECT {cols} FROM users WHERE user_id = ?",
+                                    (payment["user_id"],)) as cur:
+                row = await cur.fetchone()
+        return dict(row) if row else {}
+
+    async def expire_payment(self, payment: dict) -> bool:
+        return await self.db.for_user(payment["user_id"]).execute(
+            "UPDATE payments SET status='expired' WHERE id=? AND status='pending'", (payment["id"],)) == 1
+
+    # --- промокоды ---
+    async def add_promo(self, code: str, gold: int, gems: int, max_uses: int, created_at: str):
+        await self.main.execute("INSERT OR REPLACE INTO promo_codes VALUES (?,?,?,?,0,?)",
+                                (code, gold, gems, max_uses, created_at))
+
+    async def redeem_promo(self, code: str, user_id: int) -> tuple:
+        # Проверка и списание использования — одной транзакцией писателя
+        async with self.main.transaction() as conn:
+            async with conn.execute("SELECT * FROM promo_codes WHERE code = ?", (code,)) as cur:
+                promo = await cur.fetchone()
+            if not promo:
+                return "not_found", None
+            promo = dict(promo)
+            if promo["used_count"] >= promo["max_uses"]:
+                return "exhausted", promo
+            async with conn.execute("SELECT 1 FROM promo_uses WHERE user_id=? AND code=?",
+                                    (user_id, code)) as cur:
+                if await cur.fetchone():
+                    return "used", promo
+            await conn.execute("INSERT INTO promo_uses VALUES (?,?)", (user_id, code))
+            await conn.execute("UPDATE promo_codes SET used_count=used_count+1 WHERE code=?", (code,))
+        return "ok", promo
+
+    async def recent_promos(self, limit: int) -> list:
+        return await self.main.fetchall("SELECT * FROM promo_codes ORDER BY created_at DESC LIMIT ?", (limit,))
+
+    # --- рассылки ---
+    async def create_broadcast(self, text: str, total: int, created_by: int, created_at: str) -> dict:
+        async with self.main.transaction() as conn:
+            cur = await conn.execute(
+                "INSERT INTO broadcasts (text, total, created_by, created_at) VALUES (?, ?, ?, ?)",
+                (text, total, created_by, created_at))
+            job_id = cur.lastrowid
+        return await self.main.fetchone("SELECT * FROM broadcasts WHERE id = ?", (job_id,))
+
+    async def running_broadcasts(self) -> list:
+        return await self.main.fetchall("SELECT * FROM broadcasts WHERE status = 'running'")
+
+    async def save_broadcast(self, job: dict):
+        await self.main.execute(
+            "UPDATE broadcasts SET cursor=?, sent=?, failed=?, blocked=? WHERE id=?",
+            (job["cursor"], job["sent"], job["failed"], job["blocked"], job["id"]))
+
+    async def finish_broadcast(self, job_id: int, status: str, finished_at: str):
+        await self.main.execute("UPDATE broadcasts SET status=?, finished_at=? WHERE id=?",
+                                (status, finished_at, job_id))
+
+    async def recent_broadcasts(self, limit: int) -> list:
+        return await self.main.fetchall("SELECT * FROM broadcasts ORDER BY id DESC LIMIT ?", (limit,))
+
+    # --- агрегаты ---
+    async def count_users(self, created_since: Optional[str] = None) -> int:
+        if created_since is None:
+            return await self.db.fetchval_sum("SELECT COUNT(*) FROM users")
+        return await self.db.fetchval_sum("SELECT COUNT(*) FROM users WHERE created_at >= ?", (created_since,))
+
+    async def world_stats(self, active_since: str) -> dict:
+        # По строке с каждого шарда: суммы складываем, максимум — максимум
+        rows = await self.db.fetchall(self.WORLD_STATS_SQL, (active_since,))
+        return {key: max(r[key] for r in rows) if key == "max_level" else sum(r[key] for r in rows)
+                for key in rows[0]}
+
+    async def payment_totals(self) -> dict:
+        rows = await self.db.fetchall(
+            "SELECT COUNT(*) AS payments, COALESCE(SUM(amount_usd), 0) AS revenue "
+            "FROM payments WHERE status = 'paid'")
+        return {"payments": sum(r["payments"] for r in rows), "revenue": sum(r["revenue"] for r in rows)}
+
+    async def revenue_by_day(self, since: str) -> list:
+        days: dict = {}
+        for r in await self.db.fetchall(
+                "SELECT date(paid_at) as day, SUM(amount_usd) as total, COUNT(*) as cnt "
+                "FROM payments WHERE status='paid' AND paid_at >= ? GROUP BY day", (since,)):
+            day = days.setdefault(r["day"], {"day": r["day"], "total": 0, "cnt": 0})
+            day["total"] += r["total"]
+            day["cnt"] += r["cnt"]
+        return [days[d] for d in sorted(days)]
+
+    async def top_donors(self, limit: int) -> list:
+        rows = await self.db.fetchall(
+            "SELECT username, user_id, total_spent_usd FROM users "
+            "WHERE total_spent_usd > 0 ORDER BY total_spent_usd DESC LIMIT ?", (limit,))
+        return sorted(rows, key=lambda r: -r["total_spent_usd"])[:limit]
+
+    async def donor_stats(self, now: str) -> dict:
+        rows = await self.db.fetchall(
+            "SELECT COALESCE(SUM(total_spent_usd), 0) AS revenue, "
+            "COALESCE(SUM(total_spent_usd > 0), 0) AS paying, "
+            "COALESCE(SUM(vip_until > ?), 0) AS vip FROM users", (now,))
+        return {key: sum(r[key] for r in rows) for key in ("revenue", "paying", "vip")}
+
+    async def item_stats(self, item_id: int) -> dict:
+        rows = await self.db.fetchall(
+            "SELECT COUNT(*) AS owners, COALESCE(SUM(count), 0) AS in_inventory "
+            "FROM user_items WHERE item_id = ?", (item_id,))
+        return {
+            "owners": sum(r["owners"] for r in rows),
+            "in_inventory": sum(r["in_inventory"] for r in rows),
+            "equipped": await self.db.fetchval_sum(
+                "SELECT COUNT(*) FROM user_equipment WHERE item_id = ?", (item_id,)),
+        }
+
+
+class MemoryStorage:
+    """
+    Хранилище в словарях процесса — та же семантика, что у SQLiteStorage,
+    но без файлов и SQL. Для бенчмарков (loadtest.py) и прогонов игровой
+    логики; после остановки всё теряется. Значения по умолчанию для нового
+    игрока берутся из тех же миграций, так что колонки совпадают.
+    """
+
+    WORLD_SUMS = {
+        "total_fights": "dungeon_wins", "total_bosses": "boss_kills", "total_pvp": "wins",
+        "total_elites": "elite_kills", "total_gold": "total_gold_earned",
+        "total_gems": "total_gems_earned", "total_chests": "chests_opened", "total_crafts": "crafts_done",
+    }
+
+    def __init__(self):
+        self.users: dict = {}
+        self.payments: dict = {}
+        self.invoices: dict = {}   # (invoice_id, user_id) -> id платежа
+        self.promos: dict = {}
+        self.promo_uses: set = set()
+        self.broadcasts: dict = {}
+        self.items: dict = {}
+        self.defaults: dict = {}
+
+    @staticmethod
+    def schema_defaults() -> dict:
+        """Строка users по умолчанию — из SQL-миграций во временной базе в памяти."""
+        conn = sqlite3.connect(":memory:")
+        conn.row_factory = sqlite3.Row
+        try:
+            for _, _, migration in MIGRATIONS:
+                if not callable(migration):
+                    for stmt in split_sql(migration):
+                        conn.execute(stmt)
+            conn.execute("INSERT INTO users (user_id) VALUES (0)")
+            row = dict(conn.execute("SELECT * FROM users").fetchone())
+        finally:
+            conn.close()
+        row.update(collections_from_rows(()))
+        return row
+
+    async def start(self):
+        self.defaults = self.schema_defaults()
+
+    async def close(self):
+        pass
+
+    def describe(self) -> str:
+        return f"в памяти (игроков: {len(self.users)}, платежей: {len(self.payments)})"
+
+    @staticmethod
+    def _active(row: dict) -> bool:
+        return row["class"] != "" and not row["is_banned"]
+
+    @staticmethod
+    def _copy(row: dict, fields: Optional[tuple] = None) -> dict:
+        if fields:
+            return {f: row[f] for f in fields}
+        return {k: v for k, v in row.items() if k not in COLLECTIONS_SET}
+
+    @staticmethod
+    def _with_collections(row: dict) -> dict:
+        data = dict(row)
+        data.update(clone_collections(row))
+        return data
+
+    # --- игроки ---
+    async def register_items(self, keys: list) -> dict:
+        for key in keys:
+            self.items.setdefault(key, len(self.items) + 1)
+        return dict(self.items)
+
+    async def load_user(self, user_id: int) -> Optional[dict]:
+        row = self.users.get(user_id)
+        return self._with_collections(row) if row is not None else None
+
+    async def create_user(self, user_id: int, username: str, now: str):
+        if user_id in self.users:
+            return
+        row = self._with_collections(self.defaults)
+        row.update(user_id=user_id, username=username, created_at=now, last_energy=now)
+        self.users[user_id] = row
+
+    def write_groups(self, user_ids) -> list:
+        user_ids = list(user_ids)
+        return [user_ids] if user_ids else []
+
+    async def save_users(self, batch: dict, old: dict, new: dict):
+        for uid, fields in batch.items():
+            row = self.users.get(uid)
+            if row is None:
+                continue
+            row.update((f, v) for f, v in fields.items() if f not in COLLECTIONS_SET)
+            if not COLLECTIONS_SET.isdisjoint(fields):
+                row.update((f, c) for f, c in clone_collections(new[uid]).items() if f in fields)
+
+    async def top_users(self, order_by: str, limit: int, fields: Optional[tuple] = None) -> list:
+        rows = heapq.nsmallest(limit, (r for r in self.users.values() if self._active(r)),
+                               key=lambda r: (-r[order_by], -r["xp"], r["user_id"]))
+        return [self._copy(r, fields) for r in rows]
+
+    async def pvp_candidates(self) -> list:
+        return [self._with_collections(r) for r in self.users.values() if self._active(r)]
+
+    async def timer_candidates(self, now: str) -> list:
+        return [self._copy(r) for r in self.users.values()
+                if self._active(r) and not r["bot_blocked"]
+                and (r["expedition"] != "" or r["energy"] < r["max_energy"] or r["vip_until"] > now)]
+
+    async def count_recipients(self) -> int:
+        return sum(1 for r in self.users.values() if not r["is_banned"] and not r["bot_blocked"])
+
+    async def broadcast_recipients(self, after: int, limit: int) -> list:
+        return heapq.nsmallest(limit, (uid for uid, r in self.users.items()
+                                       if uid > after and not r["is_banned"] and not r["bot_blocked"]))
+
+    # --- платежи ---
+    async def add_payment(self, user_id: int, invoice_id: int, item_key: str, amount_usd: float,
+                          created_at: str):
+        payment_id = len(self.payments) + 1
+        self.payments[payment_id] = {
+            "id": payment_id, "user_id": user_id, "invoice_id": invoice_id, "item_key": item_key,
+            "amount_usd": amount_usd, "status": "pending", "created_at": created_at, "paid_at": "",
+        }
+        self.invoices.setdefault((invoice_id, user_id), payment_id)
+
+    async def get_payment(self, user_id: int, invoice_id: int) -> Optional[dict]:
+        payment_id = self.invoices.get((invoice_id, user_id))
+        return dict(self.payments[payment_id]) if payment_id else None
+
+    async def pending_payments(self) -> list:
+        rows = [dict(p) for p in self.payments.values() if p["status"] == "pending"]
+        rows.sort(key=lambda p: p["created_at"])
+        return rows
+
+    async def mark_paid(self, payment: dict, paid_at: str, add: dict, assign: dict) -> Optional[dict]:
+        row = self.payments.get(payment["id"])
+        if row is None or row["status"] != "pending":
+            return None
+        row.update(status="paid", paid_at=paid_at)
+        user = self.users.get(payment["user_id"])
+        if user is None:
+            return {}
+        for col, delta in add.items():
+            user[col] += delta
+        user.update(assign)
+        return {col: user[col] for col in (*add, *assign)}
+
+    async def expire_payment(self, payment: dict) -> bool:
+        row = self.payments.get(payment["id"])
+        if row is None or row["status"] != "pending":
+            return False
+        row["status"] = "expired"
+        return True
+
+    # --- промокоды ---
+    async def add_promo(self, code: str, gold: int, gems: int, max_uses: int, created_at: str):
+        self.promos[code] = {"code": code, "gold": gold, "gems": gems, "max_uses": max_uses,
+                             "used_count": 0, "created_at": created_at}
+
+    async def redeem_promo(self, code: str, user_id: int) -> tuple:
+        promo = self.promos.get(code)
+        if promo is None:
+            return "not_found", None
+        if promo["used_count"] >= promo["max_uses"]:
+            return "exhausted", dict(promo)
+        if (user_id, code) in self.promo_uses:
+            return "used", dict(promo)
+        self.promo_uses.add((user_id, code))
+        promo["used_count"] += 1
+        return "ok", dict(promo)
+
+    async def recent_promos(self, limit: int) -> list:
+        rows = sorted(self.promos.values(), key=lambda p: p["created_at"], reverse=True)
+        return [dict(p) for p in rows[:limit]]
+
+    # --- рассылки ---
+    async def create_broadcast(self, text: str, total: int, created_by: int, created_at: str) -> dict:
+        job_id = len(self.broadcasts) + 1
+        self.broadcasts[job_id] = {
+            "id": job_id, "text": text, "status": "running", "cursor": 0, "total": total,
+            "sent": 0, "failed": 0, "blocked": 0, "created_by": created_by,
+            "created_at": created_at, "finished_at": "",
+        }
+        return dict(self.broadcasts[job_id])
+
+    async def running_broadcasts(self) -> list:
+        return [dict(b) for b in self.broadcasts.values() if b["status"] == "running"]
+
+    async def save_broadcast(self, job: dict):
+        self.broadcasts[job["id"]].update({k: job[k] for k in ("cursor", "sent", "failed", "blocked")})
+
+    async def finish_broadcast(self, job_id: int, status: str, finished_at: str):
+        self.broadcasts[job_id].update(status=status, finished_at=finished_at)
+
+    async def recent_broadcasts(self, limit: int) -> list:
+        return [dict(self.broadcasts[i]) for i in sorted(self.broadcasts, reverse=True)[:limit]]
+
+    # --- агрегаты ---
+    async def count_users(self, created_since: Optional[str] = None) -> int:
+        if created_since is None:
+            return len(self.users)
+        return sum(1 for r in self.users.values() if r["created_at"] >= created_since)
+
+    async def world_stats(self, active_since: str) -> dict:
+        stats = {"total_players": 0, "level_sum": 0, "max_level": 0}
+        stats.update(dict.fromkeys(self.WORLD_SUMS, 0))
+        stats["active_24h"] = 0
+        stats.update({f"class_{cls}": 0 for cls in CLASSES})
+        for r in self.users.values():
+            if r["class"] != "":
+                stats["total_players"] += 1
+                stats["level_sum"] += r["level"]
+                stats["max_level"] = max(stats["max_level"], r["level"])
+                if r["class"] in CLASSES:
+                    stats[f"class_{r['class']}"] += 1
+            for key, col in self.WORLD_SUMS.items():
+                stats[key] += r[col]
+            if r["last_energy"] >= active_since:
+                stats["active_24h"] += 1
+        return stats
+
+    async def payment_totals(self) -> dict:
+        paid = [p["amount_usd"] for p in self.payments.values() if p["status"] == "paid"]
+        return {"payments": len(paid), "revenue": sum(paid)}
+
+    async def revenue_by_day(self, since: str) -> list:
+        days: dict = {}
+        for p in self.payments.values():
+            if p["status"] == "paid" and p["paid_at"] >= since:
+                day = days.setdefault(p["paid_at"][:10], {"day": p["paid_at"][:10], "total": 0, "cnt": 0})
+                day["total"] += p["amount_usd"]
+                day["cnt"] += 1
+        return [days[d] for d in sorted(days)]
+
+    async def top_donors(self, limit: int) -> list:
+        rows = heapq.nlargest(limit, (r for r in self.users.values() if r["total_spent_usd"] > 0),
+                              key=lambda r: r["total_spent_usd"])
+        return [self._copy(r, ("username", "user_id", "total_spent_usd")) for r in rows]
+
+    async def donor_stats(self, now: str) -> dict:
+        users = self.users.values()
+        return {
+            "revenue": sum(r["total_spent_usd"] for r in users),
+            "paying": sum(1 for r in users if r["total_spent_usd"] > 0),
+            "vip": sum(1 for r in users if r["vip_until"] > now),
+        }
+
+    async def item_stats(self, item_id: int) -> dict:
+        key = ITEM_KEYS.get(item_id)
+        owners = [r["inventory"][key] for r in self.users.values() if key in r["inventory"]]
+        return {
+            "owners": len(owners),
+            "in_inventory": sum(owners),
+            "equipped": sum(1 for r in self.users.values() for k in r["equipment"].values() if k == key),
+        }
+
+
+if STORAGE not in ("sqlite", "memory"):
+    raise RuntimeError(f"STORAGE={STORAGE}: поддерживаются sqlite и memory")
+storage: Storage = MemoryStorage() if STORAGE == "memory" else SQLiteStorage(shards)
+
+
+# ===================== КЭШ ИГРОКОВ =====================
+class UserState:
+    """
+    Строка users в памяти, множество полей, ещё не записанных в БД,
+    и последние сохранённые коллекции — от них считается построчная разница.
+    """
+    __slots__ = ("data", "dirty", "touched", "saved")
+
+    def __init__(self, data: dict):
+        self.data = data
+        self.dirty: set = set()
+        self.touched = time.monotonic()
+        self.saved = clone_collections(data)
+
+
+class UserCache:
+    """
+    Write-behind кэш игроков с LRU/TTL-вытеснением.
+    Чтение горячего игрока не ходит в БД; изменения помечают поля грязными,
+    а фоновая задача раз в USER_FLUSH_INTERVAL_MS сбрасывает их пачкой —
+    по группам хранилища (в SQLite — транзакция на шард, шарды параллельно).
+    Грязные записи не вытесняются до сброса.
+    """
+
+    def __init__(self, storage: Storage, max_size: int = USER_CACHE_SIZE, ttl: int = USER_CACHE_TTL,
+                 flush_interval_ms: int = USER_FLUSH_INTERVAL_MS):
+        self.storage = storage
+        self.max_size = max(1, max_size)
+        self.ttl = ttl
+        self.flush_interval = flush_interval_ms / 1000
+        self._items: "OrderedDict[int, UserState]" = OrderedDict()
+        self._task: Optional[asyncio.Task] = None
+        self._listeners: list = []
+        # Сбросы идут строго по очереди: иначе старый снимок мог бы лечь поверх нового
+        self._flush_lock = asyncio.Lock()
+        # Игроки, чьи поля сейчас пишутся: запись уже не грязная, но в БД ещё старые
+        # значения — такие записи нельзя вытеснять, иначе _load прочитает устаревшую строку
+        self._flushing: set = set()
+
+    def __len__(self):
+        return len(self._items)
+
+    @property
+    def dirty_count(self) -> int:
+        return sum(1 for st in self._items.values() if st.dirty)
+
+    def _pinned(self, user_id: int, st: UserState) -> bool:
+        return bool(st.dirty) or user_id in self._flushing
+
+    async def _load(self, user_id: int) -> Optional[UserState]:
+        st = self._items.get(user_id)
+        if st is not None:
+            if self._pinned(user_id, st) or time.monotonic() - st.touched < self.ttl:
+                self._items.move_to_end(user_id)
+                st.touched = time.monotonic()
+                return st
+            del self._items[user_id]
+        row = await self.storage.load_user(user_id)
+        if row is None:
+            return None
+        # Пока ждали БД, запись мог загрузить параллельный хендлер — она свежее
+        st = self._items.get(user_id)
+        if st is None:
+            st = UserState(row)
+            self._items[user_id] = st
+            self._evict()
+        return st
+
+    async def get(self, user_id: int) -> Optional[dict]:
+        st = await self._load(user_id)
+        if st is None:
+            return None
+        user = dict(st.data)
+        user.update(clone_collections(st.data))
+        return user
+
+    async def update(self, user_id: int, fields: dict):
+        st = await self._load(user_id)
+        if st is None:
+            return
+        st.data.update(fields)
+        if not COLLECTIONS_SET.isdisjoint(fields):
+            st.data.update(clone_collections(st.data))
+        st.dirty.update(fields)
+        self.notify(st.data, fields)
+
+    def add_listener(self, fn):
+        """fn(user, fields) вызывается после каждого изменения игрока (словарь не менять)."""
+        self._listeners.append(fn)
+
+    def notify(self, user: dict, fields):
+        for fn in self._listeners:
+            try:
+                fn(user, fields)
+            except Exception as e:
+                logger.error(f"[UserCache] Ошибка подписчика {fn}: {e}")
+
+    async def refresh(self, user_id: int, fields: dict):
+        """
+        Поля, уже записанные в БД мимо кэша (зачисление платежа): заменяют
+        значения в записи и не считаются грязными, подписчики получают изменение.
+        Вызывать под _user_locks игрока, иначе параллельный хендлер перетрёт их.
+        """
+        st = await self._load(user_id)
+        if st is None or not fields:
+            return
+        st.data.update(fields)
+        st.dirty.difference_update(fields)
+        self.notify(st.data, fields)
+
+    def _evict(self):
+        if len(self._items) <= self.max_size:
+            return
+        for uid in list(self._items):
+            if len(self._items) <= self.max_size:
+                break
+            if not self._pinned(uid, self._items[uid]):
+                del self._items[uid]
+
+    def _expire(self):
+        deadline = time.monotonic() - self.ttl
+        for uid in [u for u, st in self._items.items() if not self._pinned(u, st) and st.touched < deadline]:
+            del self._items[uid]
+
+    async def flush(self, user_ids: Optional[list] = None):
+        """Записывает грязные поля (все или только user_ids), группами Storage.write_groups."""
+        async with self._flush_lock:
+            await self._flush(user_ids)
+
+    async def _flush(self, user_ids: Optional[list]):
+        ids = user_ids if user_ids is not None else list(self._items)
+        batch, old, saved = {}, {}, {}
+        for uid in ids:
+            st = self._items.get(uid)
+            if st is None or not st.dirty:
+                continue
+            batch[uid] = {f: st.data[f] for f in st.dirty}
+            old[uid] = st.saved
+            saved[uid] = clone_collections(st.data)
+            st.dirty = set()
+        if not batch:
+            return
+        self._flushing.update(batch)
+        written: set = set()
+        try:
+            groups = self.storage.write_groups(batch)
+            results = await asyncio.gather(
+                *(self.storage.save_users({uid: batch[uid] for uid in uids}, old, saved) for uids in groups),
+                return_exceptions=True)
+            error = None
+            for uids, result in zip(groups, results):
+                if isinstance(result, BaseException):
+                    logger.error(f"[UserCache] Ошибка сброса {len(uids)} игроков: {result}")
+                    error = error or result
+                    continue
+                written.update(uids)
+                for uid in uids:
+                    self._items[uid].saved = saved[uid]
+            if error is not None:
+                raise error
+        finally:
+            # Всё, что не записалось (ошибка группы, отмена, сбой до записи), снова грязное;
+            # записи закреплены на время сброса, так что никуда не делись
+            for uid in batch:
+                if uid not in written:
+                    self._items[uid].dirty.update(batch[uid])
+            self._flushing.difference_update(batch)
+
+    async def _flush_loop(self):
+        while True:
+            await asyncio.sleep(self.flush_interval)
+            try:
+                await self.flush()
+            except Exception:
+                logger.exception("[UserCache] Ошибка фонового сброса")
+            self._expire()
+
+    def start(self):
+        if self._task is None:
+            self._task = asyncio.create_task(self._flush_loop())
+
+    async def stop(self):
+        if self._task is not None:
+            self._task.cancel()
+            try:
+                await self._task
+            except asyncio.CancelledError:
+                pass
+            self._task = None
+        await self.flush()
+
+
+user_cache = UserCache(storage)
+
+
+class Leaderboards:
+    """
+    Топ-K игроков по каждой категории рейтинга в памяти.
+    Заполняется из БД при старте, дальше обновляется подпиской на UserCache,
+    так что просмотр рейтинга — O(K) без запросов к БД. Списки отсортированы
+    по ключу (-значение, -xp, user_id), как ORDER BY col DESC, xp DESC.
+    Если из полного списка выпал игрок, за его пределами могут быть неизвестные
+    нам игроки — список помечается усечённым и, когда в нём станет меньше
+    запрошенного, перечитывается из БД.
+    """
+
+    CATEGORIES = ("level", "wins", "gold", "boss_kills", "total_gems_earned", "elite_kills")
+    INFO_FIELDS = ("user_id", "username", "class", "vip_until", "is_banned", "xp", "gems") + CATEGORIES
+    WATCHED = frozenset(INFO_FIELDS)
+
+    def __init__(self, storage: Storage, size: int = LEADERBOARD_SIZE):
+        self.storage = storage
+        self.size = max(15, size)
+        self._entries = {c: [] for c in self.CATEGORIES}
+        self._keys = {c: {} for c in self.CATEGORIES}
+        self._truncated = {c: False for c in self.CATEGORIES}
+        self._info: dict = {}
+
+    def _tracked(self, uid: int) -> bool:
+        return any(uid in keys for keys in self._keys.values())
+
+    def _place(self, cat: str, uid: int, key: Optional[tuple]):
+        entries, keys = self._entries[cat], self._keys[cat]
+        old = keys.pop(uid, None)
+        if old is not None:
+            del entries[bisect.bisect_left(entries, old)]
+        if key is None:
+            return
+        # Усечённый список: хуже последнего — значит, игрок вне известного топа
+        if self._truncated[cat] and entries and key > entries[-1]:
+            return
+        bisect.insort(entries, key)
+        keys[uid] = key
+        if len(entries) > self.size:
+            dropped = entries.pop()
+            del keys[dropped[2]]
+            self._truncated[cat] = True
+            if not self._tracked(dropped[2]):
+                self._info.pop(dropped[2], None)
+
+    def observe(self, user: dict, fields):
+        if self.WATCHED.isdisjoint(fields):
+            return
+        uid = user["user_id"]
+        eligible = bool(user["class"]) and not user["is_banned"]
+        for cat in self.CATEGORIES:
+            self._place(cat, uid, (-user[cat], -user["xp"], uid) if eligible else None)
+        if self._tracked(uid):
+            self._info[uid] = {f: user[f] for f in self.INFO_FIELDS}
+        else:
+            self._info.pop(uid, None)
+
+    async def seed(self, categories=None):
+        for cat in categories or self.CATEGORIES:
+            rows = await self.storage.top_users(cat, self.size, self.INFO_FIELDS)
+            truncated = len(rows) >= self.size
+            for uid in list(self._keys[cat]):
+                self._place(cat, uid, None)
+            self._truncated[cat] = False
+            for row in rows:
+                row = dict(row)
+                self._place(cat, row["user_id"], (-row[cat], -row["xp"], row["user_id"]))
+                self._info[row["user_id"]] = row
+            self._truncated[cat] = truncated
+            for uid in [u for u in self._info if not self._tracked(u)]:
+                del self._info[uid]
+
+    async def top(self, cat: str, limit: int = 10) -> list:
+        if len(self._entries[cat]) < limit and self._truncated[cat]:
+            # Грязные изменения сначала в БД, иначе перечитаем устаревший топ
+            await user_cache.flush()
+            await self.seed([cat])
+        return [self._info[key[2]] for key in self._entries[cat][:limit]]
+
+
+leaderboards = Leaderboards(storage)
+user_cache.add_listener(leaderboards.observe)
+
+
+class MatchmakingPool:
+    """
+    Соперники для PvP в памяти: активные игроки (класс выбран, не забанен),
+    разложенные по корзинам уровней, со снимком боевых статов из calc_stats.
+    Выбор случайного соперника в ±LEVEL_RANGE — O(1) и без запросов к БД.
+    Обновляется подпиской на UserCache (уровень, класс, бан, экипировка...).
+    """
+
+    LEVEL_RANGE = 3
+    WATCHED = frozenset(("level", "class", "is_banned", "username", "atk", "def", "crit",
+                         "max_hp", "equipment", "buffs"))
+
+    def __init__(self):
+        self._buckets: dict = {}   # level -> [user_id, ...]
+        self._where: dict = {}     # user_id -> (level, индекс в корзине)
+        self._snapshots: dict = {}
+
+    def __len__(self):
+        return len(self._where)
+
+    def _remove(self, uid: int):
+        pos = self._where.pop(uid, None)
+        if pos is None:
+            return
+        level, idx = pos
+        bucket = self._buckets[level]
+        last = bucket.pop()
+        if last != uid:
+            # Переносим последнего на место удалённого — удаление за O(1)
+            bucket[idx] = last
+            self._where[last] = (level, idx)
+        if not bucket:
+            del self._buckets[level]
+        self._snapshots.pop(uid, None)
+
+    def _add(self, user: dict):
+        uid = user["user_id"]
+        stats = calc_stats(user)
+        self._snapshots[uid] = {
+            "name": f"{CLASSES[user['class']]['emoji']} {user['username']}",
+            "max_hp": user["max_hp"], "atk": stats["atk"],
+        }
+        bucket = self._buckets.setdefault(user["level"], [])
+        self._where[uid] = (user["level"], len(bucket))
+        bucket.append(uid)
+
+    def observe(self, user: dict, fields):
+        if self.WATCHED.isdisjoint(fields):
+            return
+        self._remove(user["user_id"])
+        if user["class"] in CLASSES and not user["is_banned"]:
+            self._add(user)
+
+    async def seed(self, storage: Storage):
+        self._buckets.clear()
+        self._where.clear()
+        self._snapshots.clear()
+        for row in await storage.pvp_candidates():
+            if row["class"] in CLASSES:
+                self._add(row)
+
+    def pick(self, user_id: int, level: int) -> Optional[dict]:
+        """Случайный соперник с уровнем в пределах ±LEVEL_RANGE (не сам игрок)."""
+        lo, hi = max(1, level - self.LEVEL_RANGE), level + self.LEVEL_RANGE
+        own = self._where.get(user_id)
+        own_level = own[0] if own and lo <= own[0] <= hi else None
+        candidates, total = [], 0
+        for lvl in range(lo, hi + 1):
+            bucket = self._buckets.get(lvl)
+            if bucket:
+                size = len(bucket) - (1 if lvl == own_level else 0)
+                candidates.append((lvl, bucket, size))
+                total += size
+        if total <= 0:
+            return None
+        n = random.randrange(total)
+        for lvl, bucket, size in candidates:
+            if n < size:
+                if lvl == own_level and n >= own[1]:
+                    n += 1  # пропускаем самого игрока
+                uid = bucket[n]
+                return dict(self._snapshots[uid], user_id=uid)
+            n -= size
+        return None
+
+
+matchmaking = MatchmakingPool()
+user_cache.add_listener(matchmaking.observe)
+
+
+def item_catalog_keys() -> list:
+    return list(SHOP_ITEMS) + list(GEM_SHOP_ITEMS) + list(CRAFT_RECIPES)
+
+
+async def migrate_json_collections(conn):
+    """
+    Переносит JSON-колонки users (inventory, equipment, buffs, achievements)
+    в таблицы с целочисленными id предметов. Сами колонки остаются как были,
+    но больше не читаются.
+    """
+    for stmt in split_sql("""
+        CREATE TABLE IF NOT EXISTS items (item_id INTEGER PRIMARY KEY, key TEXT NOT NULL UNIQUE);
+        CREATE TABLE IF NOT EXISTS user_items (
+            user_id INTEGER NOT NULL, item_id INTEGER NOT NULL, count INTEGER NOT NULL,
+            PRIMARY KEY (user_id, item_id)
+        ) WITHOUT ROWID;
+        CREATE INDEX IF NOT EXISTS idx_user_items_item ON user_items(item_id);
+        CREATE TABLE IF NOT EXISTS user_equipment (
+            user_id INTEGER NOT NULL, slot TEXT NOT NULL, item_id INTEGER NOT NULL,
+            PRIMARY KEY (user_id, slot)
+        ) WITHOUT ROWID;
+        CREATE INDEX IF NOT EXISTS idx_user_equipment_item ON user_equipment(item_id);
+        CREATE TABLE IF NOT EXISTS user_buffs (
+            user_id INTEGER NOT NULL, buff_no INTEGER NOT NULL, item_id INTEGER NOT NULL,
+            fights_left INTEGER NOT NULL, PRIMARY KEY (user_id, buff_no)
+        ) WITHOUT ROWID;
+        CREATE TABLE IF NOT EXISTS user_achievements (
+            user_id INTEGER NOT NULL, achievement TEXT NOT NULL, PRIMARY KEY (user_id, achievement)
+        ) WITHOUT ROWID;
+        CREATE INDEX IF NOT EXISTS idx_user_achievements_key ON user_achievements(achievement);
+    """):
+        await conn.execute(stmt)
+
+    def parse(raw, default):
+        try:
+            value = json.loads(raw) if raw else default
+            return value if isinstance(value, type(default)) else default
+        except (TypeError, ValueError):
+            return default
+
+    # В старых баффах хранилось только имя — находим предмет по нему
+    buff_keys = {item["name"]: key for key, item in list(SHOP_ITEMS.items()) + list(GEM_SHOP_ITEMS.items())
+                 if item["type"] == "buff"}
+    inventory, equipment, buffs, achievements = [], [], [], []
+    keys = set(item_catalog_keys())
+    async with conn.execute(
+            "SELECT user_id, inventory, equipment, buffs, achievements FROM users") as cur:
+        async for uid, inv, eq, bf, ach in cur:
+            for key, cnt in parse(inv, {}).items():
+                if isinstance(cnt, int) and cnt > 0:
+                    inventory.append((uid, key, cnt))
+                    keys.add(key)
+            for slot, key in parse(eq, {}).items():
+                if key:
+                    equipment.append((uid, slot, key))
+                    keys.add(key)
+            no = 0
+            for buff in parse(bf, []):
+                key = buff_keys.get(buff.get("name")) if isinstance(buff, dict) else None
+                if key:
+                    buffs.append((uid, no, key, buff.get("effect", {}).get("duration", 0)))
+                    no += 1
+            for key in parse(ach, []):
+                achievements.append((uid, key))
+
+    await conn.executemany("INSERT OR IGNORE INTO items (key) VALUES (?)", [(k,) for k in sorted(keys)])
+    async with conn.execute("SELECT key, item_id FROM items") as cur:
+        ids = {key: item_id async for key, item_id in cur}
+    await conn.executemany("INSERT OR REPLACE INTO user_items VALUES (?, ?, ?)",
+                           [(uid, ids[key], cnt) for uid, key, cnt in inventory])
+    await conn.executemany("INSERT OR REPLACE INTO user_equipment VALUES (?, ?, ?)",
+                           [(uid, slot, ids[key]) for uid, slot, key in equipment])
+    await conn.executemany("INSERT OR REPLACE INTO user_buffs VALUES (?, ?, ?, ?)",
+                           [(uid, no, ids[key], left) for uid, no, key, left in buffs])
+    await conn.executemany("INSERT OR IGNORE INTO user_achievements VALUES (?, ?)", achievements)
+    logger.info(f"🗄️ Перенесено из JSON: предметов {len(inventory)}, экипировки {len(equipment)}, "
+                f"баффов {len(buffs)}, достижений {len(achievements)}")
+
+
+async def backfill_achievements(conn):
+    """
+    apply_achievements смотрит только изменившиеся счётчики, поэтому игроки,
+    перешедшие пороги до этого, сами достижения не получат. Один полный проход
+    по всем счётчикам индекса: открывает их и начисляет награды.
+    """
+    counters = tuple(ACHIEVEMENT_INDEX)
+    unlocked: dict = {}
+    async with conn.execute("SELECT user_id, achievement FROM user_achievements") as cur:
+        async for uid, key in cur:
+            unlocked.setdefault(uid, []).append(key)
+    rewards, achievements = [], []
+    async with conn.execute(
+            f"SELECT user_id, gold, gems, total_gems_earned, {', '.join(counters)} FROM users") as cur:
+        async for row in cur:
+            user = dict(row)
+            uid = user["user_id"]
+            user["achievements"] = list(unlocked.get(uid, ()))
+            before = len(user["achievements"])
+            if not apply_achievements(user, counters):
+                continue
+            rewards.append((user["gold"], user["gems"], user["total_gems_earned"], uid))
+            achievements.extend((uid, key) for key in user["achievements"][before:])
+    await conn.executemany("UPDATE users SET gold = ?, gems = ?, total_gems_earned = ? WHERE user_id = ?",
+                           rewards)
+    await conn.executemany("INSERT OR IGNORE INTO user_achievements VALUES (?, ?)", achievements)
+    logger.info(f"🗄️ Достижения по уже набранным счётчикам: игроков {len(rewards)}, "
+                f"достижений {len(achievements)}")
+
+
+async def load_item_ids():
+    """Регистрирует новые предметы каталога и загружает карту ключ <-> id."""
+    ids = await storage.register_items(item_catalog_keys())
+    ITEM_IDS.clear()
+    ITEM_KEYS.clear()
+    for key, item_id in ids.items():
+        ITEM_IDS[key] = item_id
+        ITEM_KEYS[item_id] = key
+
+
+async def get_item_stats(key: str) -> dict:
+    """Сколько экземпляров предмета существует (индексные запросы по item_id)."""
+    item_id = ITEM_IDS.get(key)
+    if item_id is None:
+        return {"owners": 0, "in_inventory": 0, "equipped": 0}
+    return await storage.item_stats(item_id)
+
+
+# Миграции схемы: (версия, описание, SQL или async-функция fn(conn)).
+# Применяются по порядку при старте, каждая в своей транзакции, номер
+# записывается в schema_version. Уже выпущенные миграции не редактируем —
+# любое изменение схемы добавляется новой записью в конец списка.
+MIGRATIONS = [
+    (1, "базовая схема", """
+        CREATE TABLE IF NOT EXISTS users (
+            user_id INTEGER PRIMARY KEY, username TEXT DEFAULT '', class TEXT DEFAULT '',
+            level INTEGER DEFAULT 1, xp INTEGER DEFAULT 0, xp_needed INTEGER DEFAULT 100,
+            hp INTEGER DEFAULT 100, max_hp INTEGER DEFAULT 100, atk INTEGER DEFAULT 10,
+            def INTEGER DEFAULT 5, crit INTEGER DEFAULT 5, gold INTEGER DEFAULT 50,
+            gems INTEGER DEFAULT 0, wins INTEGER DEFAULT 0, losses INTEGER DEFAULT 0,
+            dungeon_wins INTEGER DEFAULT 0, boss_kills INTEGER DEFAULT 0,
+            elite_kills INTEGER DEFAULT 0, total_gold_earned INTEGER DEFAULT 0,
+            total_gems_earned INTEGER DEFAULT 0, total_spent_usd REAL DEFAULT 0,
+            inventory TEXT DEFAULT '{}', equipment TEXT DEFAULT '{}',
+            buffs TEXT DEFAULT '[]', achievements TEXT DEFAULT '[]',
+            daily_claimed TEXT DEFAULT '', streak INTEGER DEFAULT 0,
+            energy INTEGER DEFAULT 10, max_energy INTEGER DEFAULT 10,
+            last_energy TEXT DEFAULT '', vip_until TEXT DEFAULT '',
+            expedition TEXT DEFAULT '', expedition_start TEXT DEFAULT '',
+            wheel_spins INTEGER DEFAULT 0, last_wheel TEXT DEFAULT '',
+            crafts_done INTEGER DEFAULT 0, chests_opened INTEGER DEFAULT 0,
+            referrer_id INTEGER DEFAULT 0, referral_count INTEGER DEFAULT 0,
+            created_at TEXT DEFAULT '', is_banned INTEGER DEFAULT 0
+        );
+        CREATE TABLE IF NOT EXISTS payments (
+            id INTEGER PRIMARY KEY AUTOINCREMENT, user_id INTEGER, invoice_id INTEGER,
+            item_key TEXT, amount_usd REAL, status TEXT DEFAULT 'pending',
+            created_at TEXT DEFAULT '', paid_at TEXT DEFAULT ''
+        );
+        CREATE TABLE IF NOT EXISTS promo_codes (
+            code TEXT PRIMARY KEY, gold INTEGER DEFAULT 0, gems INTEGER DEFAULT 0,
+            max_uses INTEGER DEFAULT 1, used_count INTEGER DEFAULT 0, created_at TEXT DEFAULT ''
+        );
+        CREATE TABLE IF NOT EXISTS promo_uses (user_id INTEGER, code TEXT, PRIMARY KEY (user_id, code));
+    """),
+    (2, "индексы для PvP, админки и платежей", """
+        -- cb_pvp_fight: поиск соперника по уровню среди активных
+        CREATE INDEX IF NOT EXISTS idx_users_pvp ON users(level)
+            WHERE class != '' AND is_banned = 0;
+        -- show_admin_panel / get_global_stats: активные, средний уровень, классы
+        CREATE INDEX IF NOT EXISTS idx_users_class_level ON users(class, level);
+        CREATE INDEX IF NOT EXISTS idx_users_created_at ON users(created_at);
+        CREATE INDEX IF NOT EXISTS idx_users_last_energy ON users(last_energy);
+        -- cb_adm_stats / cb_adm_top_don: донатеры и VIP
+        CREATE INDEX IF NOT EXISTS idx_users_spent ON users(total_spent_usd)
+            WHERE total_spent_usd > 0;
+        CREATE INDEX IF NOT EXISTS idx_users_vip_until ON users(vip_until);
+        -- cb_adm_revenue / get_total_revenue / сверка платежей
+        CREATE INDEX IF NOT EXISTS idx_payments_status_paid
+            ON payments(status, paid_at, amount_usd);
+        -- cb_check_payment
+        CREATE INDEX IF NOT EXISTS idx_payments_invoice ON payments(invoice_id, user_id);
+        CREATE INDEX IF NOT EXISTS idx_payments_user ON payments(user_id);
+        -- cb_adm_promo: последние промокоды
+        CREATE INDEX IF NOT EXISTS idx_promo_created_at ON promo_codes(created_at);
+    """),
+    (3, "фоновые рассылки и отметка заблокировавших бота", """
+        ALTER TABLE users ADD COLUMN bot_blocked INTEGER DEFAULT 0;
+        CREATE TABLE IF NOT EXISTS broadcasts (
+            id INTEGER PRIMARY KEY AUTOINCREMENT, text TEXT, status TEXT DEFAULT 'running',
+            cursor INTEGER DEFAULT 0, total INTEGER DEFAULT 0, sent INTEGER DEFAULT 0,
+            failed INTEGER DEFAULT 0, blocked INTEGER DEFAULT 0, created_by INTEGER DEFAULT 0,
+            created_at TEXT DEFAULT '', finished_at TEXT DEFAULT ''
+        );
+        CREATE INDEX IF NOT EXISTS idx_broadcasts_status ON broadcasts(status);
+    """),
+    (4, "инвентарь, экипировка, баффы и достижения в отдельных таблицах", migrate_json_collections),
+    (5, "настройки хранилища (число шардов)", """
+        CREATE TABLE IF NOT EXISTS settings (key TEXT PRIMARY KEY, value TEXT);
+    """),
+    (6, "достижения за пороги, пройденные до проверки по изменившимся счётчикам", backfill_achievements),
+]
+
+
+def split_sql(script: str) -> list[str]:
+    """Режет SQL-скрипт на отдельные statement'ы (executescript не умеет в транзакцию)."""
+    statements, current = [], ""
+    for line in script.splitlines(keepends=True):
+        if line.strip().startswith("--"):
+            continue
+        current += line
+        if sqlite3.complete_statement(current):
+            statements.append(current.strip())
+            current = ""
+    if current.strip():
+        statements.append(current.strip())
+    return statements
+
+
+async def run_migrations(db: Database):
+    await db.execute(
+        "CREATE TABLE IF NOT EXISTS schema_version "
+        "(version INTEGER PRIMARY KEY, description TEXT, applied_at TEXT)")
+    current = await db.fetchval("SELECT MAX(version) FROM schema_version", default=0)
+    for version, desc, migration in MIGRATIONS:
+        if version <= current:
+            continue
+        async with db.transaction() as conn:
+            await conn.execute("BEGIN")
+            if callable(migration):
+                await migration(conn)
+            else:
+                for stmt in split_sql(migration):
+                    await conn.execute(stmt)
+            await conn.execute("INSERT INTO schema_version VALUES (?, ?, ?)",
+                               (version, desc, datetime.now().isoformat()))
+        logger.info(f"🗄️ Миграция {version}: {desc}"
+                    + (f" ({os.path.basename(db.path)})" if db is not database else ""))
+
+
+async def init_db(shard_set: ShardSet):
+    main_db = shard_set.main
+    await run_migrations(main_db)
+    # Число шардов записано в основной базе; разъехавшаяся настройка означала бы,
+    # что игроки ищутся не в тех файлах
+    stored = await main_db.fetchval("SELECT value FROM settings WHERE key = 'shards'")
+    if stored is None:
+        # Старая однофайловая база с игроками — это 1 шард; пустую размечаем под DB_SHARDS
+        has_users = await main_db.fetchval("SELECT 1 FROM users LIMIT 1")
+        stored = 1 if has_users else shard_set.count
+        await main_db.execute("INSERT INTO settings (key, value) VALUES ('shards', ?)", (str(stored),))
+    stored = int(stored)
+    if stored != shard_set.count:
+        raise RuntimeError(f"База разбита на {stored} шард(ов), а DB_SHARDS={shard_set.count}. "
+                           f"Останови бота и выполни: python reshard.py --to {shard_set.count}")
+    for db in shard_set.all:
+        if db is not main_db:
+            await run_migrations(db)
+
+
+async def get_user(user_id: int) -> Optional[dict]:
+    return await user_cache.get(user_id)
+
+
+async def create_user(user_id: int, username: str):
+    await storage.create_user(user_id, username, datetime.now().isoformat())
 
 
 async def update_user(user_id: int, **kwargs):
+    """Изменения попадают в кэш и сбрасываются в БД фоновой задачей."""
     if not kwargs:
         return
-    async with aiosqlite.connect(DB_PATH) as db:
-        sets = ", ".join(f'"{k}" = ?' for k in kwargs)
-        vals = list(kwargs.values()) + [user_id]
-        await db.execute(f"UPDATE users SET {sets} WHERE user_id = ?", vals)
-        await db.commit()
+    await user_cache.update(user_id, kwargs)
+
+
+class KeyedLocks:
+    """asyncio.Lock на ключ; запись удаляется, когда её никто не держит и не ждёт."""
+
+    def __init__(self):
+        self._locks: dict = {}
+
+    @asynccontextmanager
+    async def hold(self, key):
+        entry = self._locks.get(key)
+        if entry is None:
+            entry = self._locks[key] = [asyncio.Lock(), 0]
+        entry[1] += 1
+        try:
+            async with entry[0]:
+                yield
+        finally:
+            entry[1] -= 1
+            if entry[1] == 0:
+                del self._locks[key]
+
+
+_user_locks = KeyedLocks()
+
+
+@asynccontextmanager
+async def user_action(user_id: int, durable: bool = False):
+    """
+    Атомарное действие игрока. Действия одного игрока выполняются строго
+    по очереди: состояние читается один раз, хендлер меняет словарь в памяти,
+    а при выходе из блока все изменения применяются одним update_user
+    (и попадают в БД одной транзакцией). При исключении не применяется ничего.
+    durable=True — сразу записать в БД (платежи, промокоды).
+    Внутри блока не отправляем сообщения — только считаем.
+    """
+    async with _user_locks.hold(user_id):
+        user = await get_user(user_id)
+        original = dict(user, **clone_collections(user)) if user else None
+        yield user
+        if user is None:
+            return
+        changed = {k: v for k, v in user.items() if original.get(k) != v}
+        if changed:
+            await update_user(user_id, **changed)
+        if durable:
+            await user_cache.flush([user_id])
+
+
+async def mark_bot_blocked(user_id: int):
+    """Игрок заблокировал бота (рассылка, уведомление) — отметка под локом игрока."""
+    async with user_action(user_id) as user:
+        if user:
+            user["bot_blocked"] = 1
+
+
+class TokenBucket:
+    """
+    Ограничитель частоты: rate токенов в секунду, запас capacity.
+    pause() останавливает всех ожидающих (например, на TelegramRetryAfter).
+    """
+
+    def __init__(self, rate: float, capacity: Optional[float] = None):
+        self.rate = rate
+        self.capacity = capacity if capacity is not None else max(1.0, rate)
+        self._tokens = self.capacity
+        self._updated = time.monotonic()
+        self._paused_until = 0.0
+        self._lock = asyncio.Lock()
+
+    def _refill(self, now: float):
+        self._tokens = min(self.capacity, self._tokens + (now - self._updated) * self.rate)
+        self._updated = now
+
+    def try_acquire(self) -> bool:
+        now = time.monotonic()
+        if now < self._paused_until:
+            return False
+        self._refill(now)
+        if self._tokens >= 1:
+            self._tokens -= 1
+            return True
+        return False
+
+    async def acquire(self):
+        async with self._lock:
+            while True:
+                now = time.monotonic()
+                if now < self._paused_until:
+                    await asyncio.sleep(self._paused_until - now)
+                    continue
+                self._refill(now)
+                if self._tokens >= 1:
+                    self._tokens -= 1
+                    return
+                await asyncio.sleep((1 - self._tokens) / self.rate)
+
+    def pause(self, seconds: float):
+        self._paused_until = max(self._paused_until, time.monotonic() + seconds)
+        self._tokens = 0
+
+    def full(self) -> bool:
+        """Запас восстановился полностью — ведро можно выбросить без потери состояния."""
+        now = time.monotonic()
+        return now >= self._paused_until and (now - self._updated) * self.rate >= self.capacity - self._tokens
+
+
+# ======================== АНТИФЛУД ========================
+def parse_throttle_limits(spec: str) -> list:
+    """'fight_=1/3,buy_=2/4' -> [(префикс, скорость, запас)], длинные префиксы первыми."""
+    limits = []
+    for part in spec.split(","):
+        if not part.strip():
+            continue
+        try:
+            prefix, value = part.split("=", 1)
+            rate, _, burst = value.partition("/")
+            rate = float(rate)
+            burst = float(burst) if burst else max(1.0, rate)
+            if rate <= 0 or burst < 1:
+                raise ValueError
+        except ValueError:
+            logger.warning(f"⚠️ THROTTLE_LIMITS: пропускаю некорректное правило {part!r}")
+            continue
+        limits.append((prefix.strip(), rate, burst))
+    return sorted(limits, key=lambda x: -len(x[0]))
+
+
+class ThrottleMiddleware(BaseMiddleware):
+    """
+    Ограничивает частоту нажатий кнопок: своё TokenBucket-ведро на пару
+    (игрок, префикс callback_data). Лишние нажатия получают короткий ответ
+    и до хендлера (и БД) не доходят. Неиспользуемые вёдра — уже полные —
+    периодически выбрасываются.
+    """
+
+    def __init__(self, limits: list, default: tuple):
+        self.limits = limits
+        self.default = default
+        self._buckets: dict = {}
+        self._prune_at = 10_000
+        self.throttled = 0
+
+    def _rule(self, data: str) -> tuple:
+        for prefix, rate, burst in self.limits:
+            if data.startswith(prefix):
+                return prefix, rate, burst
+        return ("", *self.default)
+
+    def _prune(self):
+        self._buckets = {k: b for k, b in self._buckets.items() if not b.full()}
+        self._prune_at = max(10_000, 2 * len(self._buckets))
+
+    async def __call__(self, handler, event: CallbackQuery, data: dict):
+        prefix, rate, burst = self._rule(event.data or "")
+        key = (event.from_user.id, prefix)
+        bucket = self._buckets.get(key)
+        if bucket is None:
+            if len(self._buckets) >= self._prune_at:
+                self._prune()
+            bucket = self._buckets[key] = TokenBucket(rate, burst)
+        if not bucket.try_acquire():
+            self.throttled += 1
+            stats = _update_stats.get()
+            if stats is not None:
+                stats.handler = "throttled"
+            try:
+                await event.answer("⏳ Не так быстро!")
+            except Exception:
+                pass
+            return None
+        return await handler(event, data)
+
+
+throttle = ThrottleMiddleware(parse_throttle_limits(THROTTLE_LIMITS), (THROTTLE_RATE, THROTTLE_BURST))
+dp.callback_query.outer_middleware(throttle)
 
 
 async def get_top_players(order_by="level", limit=10):
@@ -528,94 +2864,216 @@ async def get_top_players(order_by="level", limit=10):
                "dungeon_wins", "xp", "losses"}
     if order_by not in allowed:
         order_by = "level"
-    async with aiosqlite.connect(DB_PATH) as db:
-        db.row_factory = aiosqlite.Row
-        async with db.execute(
-            f'SELECT * FROM users WHERE class != "" AND is_banned = 0 '
-            f'ORDER BY "{order_by}" DESC, xp DESC LIMIT ?', (limit,)
-        ) as cur:
-            return [dict(r) for r in await cur.fetchall()]
+    if order_by in Leaderboards.CATEGORIES and limit <= leaderboards.size:
+        return await leaderboards.top(order_by, limit)
+    return await storage.top_users(order_by, limit)
 
 
 async def get_all_users_count():
-    async with aiosqlite.connect(DB_PATH) as db:
-        async with db.execute("SELECT COUNT(*) FROM users") as cur:
-            return (await cur.fetchone())[0]
+    return await storage.count_users()
 
 
-async def get_total_revenue():
-    async with aiosqlite.connect(DB_PATH) as db:
-        async with db.execute("SELECT COALESCE(SUM(amount_usd), 0) FROM payments WHERE status = 'paid'") as cur:
-            return (await cur.fetchone())[0]
+_global_stats_cache = {"at": 0.0, "data": None}
+_global_stats_lock = asyncio.Lock()
 
 
 async def get_global_stats() -> dict:
-    async with aiosqlite.connect(DB_PATH) as db:
-        stats = {}
-        queries = {
-            "total_players": "SELECT COUNT(*) FROM users WHERE class != ''",
-            "avg_level": "SELECT COALESCE(AVG(level), 0) FROM users WHERE class != ''",
-            "max_level": "SELECT COALESCE(MAX(level), 0) FROM users WHERE class != ''",
-            "total_fights": "SELECT COALESCE(SUM(dungeon_wins), 0) FROM users",
-            "total_bosses": "SELECT COALESCE(SUM(boss_kills), 0) FROM users",
-            "total_pvp": "SELECT COALESCE(SUM(wins), 0) FROM users",
-            "total_elites": "SELECT COALESCE(SUM(elite_kills), 0) FROM users",
-            "total_gold": "SELECT COALESCE(SUM(total_gold_earned), 0) FROM users",
-            "total_gems": "SELECT COALESCE(SUM(total_gems_earned), 0) FROM users",
-            "total_chests": "SELECT COALESCE(SUM(chests_opened), 0) FROM users",
-            "total_crafts": "SELECT COALESCE(SUM(crafts_done), 0) FROM users",
-        }
-        for key, query in queries.items():
-            async with db.execute(query) as c:
-                val = (await c.fetchone())[0]
-                stats[key] = round(val, 1) if key == "avg_level" else val
-        for cls in CLASSES:
-            async with db.execute("SELECT COUNT(*) FROM users WHERE class = ?", (cls,)) as c:
-                stats[f"class_{cls}"] = (await c.fetchone())[0]
+    """Статистика мира из кэша на WORLD_STATS_TTL секунд (один запрос на всех)."""
+    if _global_stats_cache["data"] and time.monotonic() - _global_stats_cache["at"] < WORLD_STATS_TTL:
+        return _global_stats_cache["data"]
+    async with _global_stats_lock:
+        # Пока ждали лок, кэш мог обновить другой хендлер
+        if _global_stats_cache["data"] and time.monotonic() - _global_stats_cache["at"] < WORLD_STATS_TTL:
+            return _global_stats_cache["data"]
         day_ago = (datetime.now() - timedelta(days=1)).isoformat()
-        async with db.execute("SELECT COUNT(*) FROM users WHERE last_energy >= ?", (day_ago,)) as c:
-            stats["active_24h"] = (await c.fetchone())[0]
+        stats = await storage.world_stats(day_ago)
+        level_sum = stats.pop("level_sum")
+        stats["avg_level"] = round(level_sum / stats["total_players"], 1) if stats["total_players"] else 0
+        _global_stats_cache.update(at=time.monotonic(), data=stats)
         return stats
 
 
 # ======================== CRYPTO PAY API ========================
-CRYPTO_PAY_API = "https://pay.crypt.bot/api"
 
 
 async def crypto_create_invoice(amount: float, description: str, payload: str) -> Optional[dict]:
     if not CRYPTO_PAY_TOKEN:
         return None
     try:
-        async with aiohttp.ClientSession() as session:
-            headers = {"Crypto-Pay-API-Token": CRYPTO_PAY_TOKEN}
-            params = {
-                "currency_type": "fiat", "fiat": "USD", "amount": str(amount),
-                "description": description, "payload": payload,
-                "paid_btn_name": "callback",
-                "paid_btn_url": f"https://t.me/{(await bot.get_me()).username}",
-            }
-            async with session.get(f"{CRYPTO_PAY_API}/createInvoice",
-                                   headers=headers, params=params) as resp:
+        headers = {"Crypto-Pay-API-Token": CRYPTO_PAY_TOKEN}
+        params = {
+            "currency_type": "fiat", "fiat": "USD", "amount": str(amount),
+            "description": description, "payload": payload,
+            "paid_btn_name": "callback",
+            "paid_btn_url": f"https://t.me/{(await bot.get_me()).username}",
+            "expires_in": PAYMENT_EXPIRE_HOURS * 3600,
+        }
+        with RequestTimer("cryptopay") as req:
+            async with get_http_session().get(f"{CRYPTO_PAY_API}/createInvoice",
+                                              headers=headers, params=params) as resp:
                 data = await resp.json()
-                return data["result"] if data.get("ok") else None
+                req.ok = bool(data.get("ok"))
+        return data["result"] if req.ok else None
     except Exception as e:
         logger.error(f"Crypto Pay exception: {e}")
         return None
 
 
-async def crypto_get_invoices(invoice_ids: str) -> list:
+async def crypto_get_invoices(invoice_ids: str) -> Optional[list]:
+    """Счета по списку id через запятую. None — API недоступен (не путать с пустым ответом)."""
     if not CRYPTO_PAY_TOKEN:
-        return []
+        return None
     try:
-        async with aiohttp.ClientSession() as session:
-            headers = {"Crypto-Pay-API-Token": CRYPTO_PAY_TOKEN}
-            async with session.get(f"{CRYPTO_PAY_API}/getInvoices", headers=headers,
-                                   params={"invoice_ids": invoice_ids}) as resp:
+        headers = {"Crypto-Pay-API-Token": CRYPTO_PAY_TOKEN}
+        params = {"invoice_ids": invoice_ids, "count": invoice_ids.count(",") + 1}
+        with RequestTimer("cryptopay") as req:
+            async with get_http_session().get(f"{CRYPTO_PAY_API}/getInvoices", headers=headers,
+                                              params=params) as resp:
                 data = await resp.json()
-                return data["result"].get("items", []) if data.get("ok") else []
+                req.ok = bool(data.get("ok"))
+        return data["result"].get("items", []) if req.ok else None
     except Exception as e:
         logger.error(f"Crypto Pay check error: {e}")
-        return []
+        return None
+
+
+async def credit_payment(payment: dict) -> Optional[dict]:
+    """
+    Идемпотентно зачисляет оплаченный счёт. Статус платежа и награды игрока
+    пишутся атомарно (Storage.mark_paid), а условие status='pending' гарантирует, что
+    повторная проверка (кнопка, фоновая сверка) второй раз ничего не начислит.
+    Возвращает товар, если зачислил именно этот вызов.
+    """
+    item = DONATE_ITEMS.get(payment["item_key"])
+    if not item:
+        return None
+    user_id = payment["user_id"]
+    async with _user_locks.hold(user_id):
+        # Награда прибавляется к строке в БД — сначала туда должны попасть все изменения игрока
+        await user_cache.flush([user_id])
+        user = await get_user(user_id)
+        if not user:
+            return None
+        vip_until = user["vip_until"]
+        if item.get("vip_days"):
+            vip_until = (get_vip_end(user) + timedelta(days=item["vip_days"])).isoformat()
+        rewards = {"gold": item.get("gold", 0), "gems": item.get("gems", 0),
+                   "total_gems_earned": item.get("gems", 0), "total_spent_usd": item["price_usd"]}
+        saved = await storage.mark_paid(payment, datetime.now().isoformat(), rewards, {"vip_until": vip_until})
+        if saved is None:
+            return None
+        # Записанные значения — прямо в запись кэша (она могла стать грязной, пока ждали БД)
+        await user_cache.refresh(user_id, saved)
+    return item
+
+
+async def expire_payment(payment: dict) -> bool:
+    return await storage.expire_payment(payment)
+
+
+def payment_success_text(item: dict) -> str:
+    rewards = []
+    if item.get("gold"):
+        rewards.append(f"+{item['gold']}💰")
+    if item.get("gems"):
+        rewards.append(f"+{item['gems']}💎")
+    if item.get("vip_days"):
+        rewards.append(f"👑VIP {item['vip_days']}д")
+    return (f"✅ <b>Оплата получена!</b>\n\n"
+            f"📦 {item['name']}\n{' '.join(rewards)}\n\nСпасибо! 🐉")
+
+
+async def notify_admins_payment(user_id: int, item: dict):
+    user = await get_user(user_id)
+    name = user["username"] if user else ""
+    for admin_id in ADMIN_IDS:
+        try:
+            await bot.send_message(
+                admin_id,
+                f"💰 <b>Платёж!</b>\n👤 {name} (ID:{user_id})\n"
+                f"📦 {item['name']} — ${item['price_usd']}")
+        except Exception:
+            pass
+
+
+class PaymentReconciler:
+    """
+    Фоновая сверка платежей: раз в interval секунд берёт все pending-счета,
+    спрашивает Crypto Pay пачками (getInvoices с invoice_ids через запятую),
+    зачисляет оплаченные и закрывает истёкшие. Кнопка «Проверить оплату»
+    остаётся, но больше не обязательна.
+    """
+
+    def __init__(self, interval: int = PAYMENT_POLL_INTERVAL, batch_size: int = PAYMENT_BATCH_SIZE,
+                 expire_hours: int = PAYMENT_EXPIRE_HOURS):
+        self.interval = interval
+        self.batch_size = max(1, batch_size)
+        self.expire_after = timedelta(hours=expire_hours)
+        self._task: Optional[asyncio.Task] = None
+        self.api_calls = 0
+        self.credited = 0
+        self.expired = 0
+
+    async def run_once(self) -> dict:
+        """Один проход сверки. Возвращает число зачисленных и закрытых счетов."""
+        result = {"credited": 0, "expired": 0}
+        if not CRYPTO_PAY_TOKEN:
+            return result
+        rows = await storage.pending_payments()
+        stale_before = (datetime.now() - self.expire_after).isoformat()
+        for i in range(0, len(rows), self.batch_size):
+            batch = rows[i:i + self.batch_size]
+            ids = ",".join(str(p["invoice_id"]) for p in batch)
+            invoices = await crypto_get_invoices(ids)
+            self.api_calls += 1
+            if invoices is None:
+                continue
+            by_id = {inv.get("invoice_id"): inv for inv in invoices}
+            for payment in batch:
+                status = by_id.get(payment["invoice_id"], {}).get("status")
+                if status == "paid":
+                    item = await credit_payment(payment)
+                    if item:
+                        result["credited"] += 1
+                        await self._notify(payment["user_id"], item)
+                elif status == "expired" or (status is None and payment["created_at"] < stale_before):
+                    if await expire_payment(payment):
+                        result["expired"] += 1
+        self.credited += result["credited"]
+        self.expired += result["expired"]
+        return result
+
+    async def _notify(self, user_id: int, item: dict):
+        try:
+            await bot.send_message(user_id, payment_success_text(item),
+                                   reply_markup=make_kb([[("🔙 Меню", "main_menu")]]))
+        except Exception:
+            pass
+        await notify_admins_payment(user_id, item)
+
+    async def _loop(self):
+        while True:
+            await asyncio.sleep(self.interval)
+            try:
+                await self.run_once()
+            except Exception as e:
+                logger.error(f"[Payments] Ошибка сверки: {e}")
+
+    def start(self):
+        if self._task is None and CRYPTO_PAY_TOKEN:
+            self._task = asyncio.create_task(self._loop())
+
+    async def stop(self):
+        if self._task is not None:
+            self._task.cancel()
+            try:
+                await self._task
+            except asyncio.CancelledError:
+                pass
+            self._task = None
+
+
+payment_reconciler = PaymentReconciler()
 
 
 # ======================== УТИЛИТЫ ========================
@@ -623,13 +3081,20 @@ def xp_for_level(level: int) -> int:
     return int(100 * (level ** 1.5))
 
 
+@functools.lru_cache(maxsize=65536)
+def parse_ts(value: str) -> Optional[datetime]:
+    """ISO-время из БД; одни и те же строки читаются постоянно, поэтому разбор кэшируется."""
+    try:
+        return datetime.fromisoformat(value)
+    except (TypeError, ValueError):
+        return None
+
+
 def is_vip(user: dict) -> bool:
     if not user.get("vip_until"):
         return False
-    try:
-        return datetime.fromisoformat(user["vip_until"]) > datetime.now()
-    except Exception:
-        return False
+    until = parse_ts(user["vip_until"])
+    return until is not None and until > datetime.now()
 
 
 def get_title(level: int) -> str:
@@ -640,44 +3105,63 @@ def get_title(level: int) -> str:
     return title
 
 
-def calc_stats(user: dict) -> dict:
-    stats = {"atk": user["atk"], "def": user["def"], "crit": user["crit"],
-             "hp": user["hp"], "max_hp": user["max_hp"]}
-    equipment = json.loads(user["equipment"]) if user["equipment"] else {}
-    for slot, item_key in equipment.items():
-        item = SHOP_ITEMS.get(item_key) or GEM_SHOP_ITEMS.get(item_key) or CRAFT_RECIPES.get(item_key)
+@functools.lru_cache(maxsize=4096)
+def _stat_bonus(equipment: tuple, buffs: tuple) -> tuple:
+    """Прибавки к статам от экипировки и баффов (ключи предметов)."""
+    bonus = [0] * len(STAT_FIELDS)
+    for key in equipment + buffs:
+        item = ITEM_CATALOG.get(key)
         if item:
-            for k, v in item.get("effect", {}).items():
-                if k in stats:
-                    stats[k] += v
-    buffs = json.loads(user["buffs"]) if user["buffs"] else []
-    for buff in buffs:
-        for k, v in buff.get("effect", {}).items():
-            if k in stats and k not in ("duration", "xp_mult", "gold_mult", "gem_luck"):
-                stats[k] += v
-    return stats
+            for i, v in enumerate(item.stats):
+                bonus[i] += v
+    return tuple(bonus)
+
+
+@functools.lru_cache(maxsize=1024)
+def _buff_mults(buffs: tuple, vip: bool) -> tuple:
+    xp_mult, gold_mult, gem_luck = 1.0, 1.0, 0
+    for key in buffs:
+        item = ITEM_CATALOG.get(key)
+        if item:
+            xp_mult = max(xp_mult, item.xp_mult)
+            gold_mult = max(gold_mult, item.gold_mult)
+            gem_luck += item.gem_luck
+    if vip:
+        xp_mult *= VIP_BENEFITS["xp_bonus"]
+        gold_mult *= VIP_BENEFITS["gold_bonus"]
+        gem_luck += VIP_BENEFITS["gem_drop_bonus"]
+    return xp_mult, gold_mult, gem_luck
+
+
+def derived_stats(user: dict) -> tuple:
+    """
+    Прибавки к статам и множители по сигнатуре (экипировка, баффы, VIP).
+    Результат мемоизирован — сам расчёт выполняется один раз на сигнатуру.
+    """
+    buffs = tuple([b["key"] for b in user["buffs"]])
+    return (_stat_bonus(tuple(user["equipment"].values()), buffs),
+            _buff_mults(buffs, is_vip(user)))
+
+
+def apply_bonus(user: dict, bonus: tuple) -> dict:
+    atk, def_, crit, hp, max_hp = bonus
+    return {"atk": user["atk"] + atk, "def": user["def"] + def_, "crit": user["crit"] + crit,
+            "hp": user["hp"] + hp, "max_hp": user["max_hp"] + max_hp}
+
+
+def calc_stats(user: dict) -> dict:
+    buffs = tuple([b["key"] for b in user["buffs"]])
+    return apply_bonus(user, _stat_bonus(tuple(user["equipment"].values()), buffs))
 
 
 def get_buff_multipliers(user: dict) -> dict:
-    mults = {"xp_mult": 1.0, "gold_mult": 1.0, "gem_luck": 0}
-    buffs = json.loads(user["buffs"]) if user["buffs"] else []
-    for buff in buffs:
-        eff = buff.get("effect", {})
-        if "xp_mult" in eff:
-            mults["xp_mult"] = max(mults["xp_mult"], eff["xp_mult"])
-        if "gold_mult" in eff:
-            mults["gold_mult"] = max(mults["gold_mult"], eff["gold_mult"])
-        if "gem_luck" in eff:
-            mults["gem_luck"] += eff["gem_luck"]
-    if is_vip(user):
-        mults["xp_mult"] *= VIP_BENEFITS["xp_bonus"]
-        mults["gold_mult"] *= VIP_BENEFITS["gold_bonus"]
-        mults["gem_luck"] += VIP_BENEFITS["gem_drop_bonus"]
-    return mults
-
-
-async def add_xp(user_id: int, xp: int) -> str:
-    user = await get_user(user_id)
+    buffs = tuple([b["key"] for b in user["buffs"]])
+    xp_mult, gold_mult, gem_luck = _buff_mults(buffs, is_vip(user))
+    return {"xp_mult": xp_mult, "gold_mult": gold_mult, "gem_luck": gem_luck}
+
+
+def apply_xp(user: dict, xp: int) -> str:
+    """Начисляет опыт и уровни прямо в словарь игрока (внутри user_action)."""
     new_xp = user["xp"] + xp
     level = user["level"]
     xp_needed = user["xp_needed"]
@@ -700,59 +3184,112 @@ async def add_xp(user_id: int, xp: int) -> str:
         msg += f"\n  ❤️+{hp_b} ⚔️+{atk_b} 🛡️+{def_b}"
 
     new_max_hp = user["max_hp"] + total_hp_bonus
-    new_hp = min(new_max_hp, user["hp"] + total_hp_bonus)
-    await update_user(user_id,
-                      xp=new_xp, level=level, xp_needed=xp_needed,
-                      max_hp=new_max_hp, hp=new_hp,
-                      atk=user["atk"] + total_atk_bonus,
-                      **{"def": user["def"] + total_def_bonus})
+    user.update(xp=new_xp, level=level, xp_needed=xp_needed,
+                max_hp=new_max_hp, hp=min(new_max_hp, user["hp"] + total_hp_bonus),
+                atk=user["atk"] + total_atk_bonus)
+    user["def"] += total_def_bonus
     return msg
 
 
-async def check_achievements(user_id: int) -> str:
-    user = await get_user(user_id)
-    old_unlocked = json.loads(user["achievements"]) if user["achievements"] else []
-    unlocked = list(old_unlocked)
+def build_achievement_index() -> dict:
+    """Счётчик -> (пороги по возрастанию, ключи достижений в том же порядке)."""
+    by_check: dict = {}
+    for key, ach in ACHIEVEMENTS.items():
+        by_check.setdefault(ach["check"], []).append((ach["value"], key))
+    return {check: ([v for v, _ in sorted(items)], [k for _, k in sorted(items)])
+            for check, items in by_check.items()}
+
+
+ACHIEVEMENT_INDEX = build_achievement_index()
+# Счётчики, которые меняет каждая выигранная битва (опыт и золото в do_battle)
+BATTLE_COUNTERS = ("level", "total_gold_earned")
+
+
+def apply_achievements(user: dict, changed) -> str:
+    """
+    Открывает достижения и начисляет награды в словарь игрока (внутри
+    user_action — награда пишется той же транзакцией, что и само действие).
+    Смотрит только счётчики из changed: bisect по отсортированным порогам
+    сразу отсекает всё, что ещё не достигнуто.
+    """
+    unlocked = user["achievements"]
     msg = ""
     new_keys = []
-    for key, ach in ACHIEVEMENTS.items():
-        if key in unlocked:
+    for check in changed:
+        index = ACHIEVEMENT_INDEX.get(check)
+        if not index:
             continue
-        val = user.get(ach["check"], 0)
-        if val >= ach["value"]:
+        values, keys = index
+        for key in keys[:bisect.bisect_right(values, user.get(check, 0))]:
+            if key in unlocked:
+                continue
+            ach = ACHIEVEMENTS[key]
             unlocked.append(key)
             new_keys.append(key)
             msg += f"\n🏅 <b>Достижение: {ach['name']}!</b> +{ach['reward_gold']}💰 +{ach['reward_gems']}💎"
     if new_keys:
         total_gold = sum(ACHIEVEMENTS[k]["reward_gold"] for k in new_keys)
         total_gems = sum(ACHIEVEMENTS[k]["reward_gems"] for k in new_keys)
-        await update_user(user_id,
-                          gold=user["gold"] + total_gold,
-                          gems=user["gems"] + total_gems,
-                          total_gems_earned=user["total_gems_earned"] + total_gems,
-                          achievements=json.dumps(unlocked))
+        user["gold"] += total_gold
+        user["gems"] += total_gems
+        user["total_gems_earned"] += total_gems
     return msg
 
 
-async def regen_energy(user_id: int):
-    user = await get_user(user_id)
-    if not user or not user.get("last_energy"):
-        return
-    try:
-        last = datetime.fromisoformat(user["last_energy"])
-    except Exception:
-        return
-    now = datetime.now()
-    minutes_passed = (now - last).total_seconds() / 60
-    regen_rate = VIP_BENEFITS["energy_regen"] if is_vip(user) else 10
-    regen = int(minutes_passed / regen_rate)
-    if regen > 0:
-        max_e = user["max_energy"] + (VIP_BENEFITS["max_energy_bonus"] if is_vip(user) else 0)
-        new_energy = min(user["energy"] + regen, max_e)
-        await update_user(user_id, energy=new_energy, last_energy=now.isoformat())
+# Энергия хранится парой (energy, last_energy): значение на момент last_energy.
+# Текущее значение считается при чтении в замкнутой форме, а в БД пара
+# переписывается только когда энергию реально меняют (бой, пополнение).
+def energy_state(user: dict, now: Optional[datetime] = None) -> tuple:
+    """(энергия сейчас, новая точка отсчёта) по сохранённой паре, без записи."""
+    now = now or datetime.now()
+    energy, max_e = user["energy"], get_max_energy(user)
+    last = parse_ts(user["last_energy"])
+    if last is None or energy >= max_e:
+        return energy, now
+    rate = energy_regen_rate(user)
+    ticks = int((now - last) / rate)
+    if ticks <= 0:
+        return energy, last
+    if energy + ticks >= max_e:
+        return max_e, now
+    # Точка отсчёта сдвигается на целое число тиков — неполный тик не теряется
+    return energy + ticks, last + ticks * rate
+
+
+def energy_regen_rate(user: dict) -> timedelta:
+    return timedelta(minutes=VIP_BENEFITS["energy_regen"] if is_vip(user) else 10)
+
+
+def energy_full_at(user: dict) -> Optional[datetime]:
+    """Когда энергия восстановится до максимума (None — уже полная)."""
+    energy, anchor = energy_state(user)
+    missing = get_max_energy(user) - energy
+    if missing <= 0:
+        return None
+    return anchor + missing * energy_regen_rate(user)
 
 
-def make_kb(buttons: list[list[tuple]]) -> InlineKeyboardMarkup:
+def current_energy(user: dict) -> int:
+    return energy_state(user)[0]
+
+
+def regen_energy(user: dict):
+    """Фиксирует восстановленную энергию в словаре — только перед её изменением."""
+    energy, anchor = energy_state(user)
+    user["energy"] = energy
+    user["last_energy"] = anchor.isoformat()
+
+
+def add_energy(user: dict, amount: int):
+    regen_energy(user)
+    user["energy"] = min(user["energy"] + amount, get_max_energy(user))
+
+
+def get_max_energy(user: dict) -> int:
+    return user["max_energy"] + (VIP_BENEFITS["max_energy_bonus"] if is_vip(user) else 0)
+
+
+def build_kb(buttons: list[list[tuple]]) -> InlineKeyboardMarkup:
     keyboard = []
     for row in buttons:
         keyboard.append([
@@ -763,13 +3300,133 @@ def make_kb(buttons: list[list[tuple]]) -> InlineKeyboardMarkup:
     return InlineKeyboardMarkup(inline_keyboard=keyboard)
 
 
-def get_vip_end(user: dict) -> datetime:
-    if user.get("vip_until") and user["vip_until"]:
-        try:
-            return max(datetime.fromisoformat(user["vip_until"]), datetime.now())
-        except Exception:
-            pass
-    return datetime.now()
+# Модели aiogram неизменяемы (frozen), поэтому одна и та же раскладка кнопок
+# собирается один раз и дальше переиспользуется всеми хендлерами.
+KB_CACHE_SIZE = 512
+_kb_cache: OrderedDict = OrderedDict()
+
+
+def make_kb(buttons: list[list[tuple]]) -> InlineKeyboardMarkup:
+    key = tuple(map(tuple, buttons))
+    kb = _kb_cache.get(key)
+    if kb is not None:
+        _kb_cache.move_to_end(key)
+        return kb
+    kb = _kb_cache[key] = build_kb(buttons)
+    if len(_kb_cache) > KB_CACHE_SIZE:
+        _kb_cache.popitem(last=False)
+    return kb
+
+
+def get_vip_end(user: dict) -> datetime:
+    if user.get("vip_until") and user["vip_until"]:
+        until = parse_ts(user["vip_until"])
+        if until is not None:
+            return max(until, datetime.now())
+    return datetime.now()
+
+
+# ======================== БОЕВОЙ ДВИЖОК ========================
+# Чистые функции без БД и текста: получают статы игрока (calc_stats) и
+# словарь врага, возвращают исход. Хендлеры только сохраняют результат.
+BATTLE_MAX_TURNS = 30
+
+
+@dataclass
+class BattleResult:
+    won: bool
+    turns: int
+    dmg_dealt: int
+    dmg_taken: int
+    player_hp: int
+    enemy_hp: int
+    # (кто бьёт: "player"/"enemy", урон, крит) — только при with_log=True
+    log: list = field(default_factory=list)
+
+
+def simulate_battle(stats: dict, enemy: dict, rng=random, with_log: bool = False) -> BattleResult:
+    """Один бой. Игрок бьёт первым; после BATTLE_MAX_TURNS ходов — ничья (не победа)."""
+    p_hp = stats["hp"]
+    e_hp = enemy["hp"]
+    dealt = taken = turn = 0
+    log = []
+    while p_hp > 0 and e_hp > 0 and turn < BATTLE_MAX_TURNS:
+        turn += 1
+        is_crit = rng.randint(1, 100) <= stats["crit"]
+        dmg = max(1, stats["atk"] - rng.randint(0, 3))
+        if is_crit:
+            dmg = int(dmg * 2)
+        e_hp -= dmg
+        dealt += dmg
+        if with_log:
+            log.append(("player", dmg, is_crit))
+        if e_hp <= 0:
+            break
+        e_dmg = max(1, enemy["atk"] - stats["def"] // 2 + rng.randint(-2, 2))
+        p_hp -= e_dmg
+        taken += e_dmg
+        if with_log:
+            log.append(("enemy", e_dmg, False))
+    return BattleResult(won=e_hp <= 0, turns=turn, dmg_dealt=dealt, dmg_taken=taken,
+                        player_hp=p_hp, enemy_hp=e_hp, log=log)
+
+
+@dataclass
+class BatchResult:
+    won: "np.ndarray"
+    turns: "np.ndarray"
+    dmg_dealt: "np.ndarray"
+    dmg_taken: "np.ndarray"
+
+    @property
+    def win_rate(self) -> float:
+        return float(self.won.mean()) if len(self.won) else 0.0
+
+    @property
+    def avg_turns(self) -> float:
+        return float(self.turns.mean()) if len(self.turns) else 0.0
+
+
+def simulate_battles(stats: dict, enemy: dict, n: int, seed: Optional[int] = None,
+                     chunk: int = 100_000) -> BatchResult:
+    """
+    Пакетная симуляция n боёв (NumPy): те же правила, что в simulate_battle,
+    но все ходы всех боёв считаются массивами. Для офлайн-баланса
+    DUNGEONS / ELITE_MONSTERS — миллионы боёв за секунды.
+    """
+    if np is None:
+        raise RuntimeError("Для пакетной симуляции нужен numpy: pip install numpy")
+    rng = np.random.default_rng(seed)
+    parts = []
+    for start in range(0, n, chunk):
+        size = min(chunk, n - start)
+        shape = (size, BATTLE_MAX_TURNS)
+        crit = rng.integers(1, 101, shape) <= stats["crit"]
+        p_dmg = np.maximum(1, stats["atk"] - rng.integers(0, 4, shape))
+        p_dmg = np.where(crit, p_dmg * 2, p_dmg)
+        e_dmg = np.maximum(1, enemy["atk"] - stats["def"] // 2 + rng.integers(-2, 3, shape))
+        p_cum = p_dmg.cumsum(axis=1)
+        e_cum = e_dmg.cumsum(axis=1)
+
+        killed = p_cum >= enemy["hp"]
+        died = e_cum >= stats["hp"]
+        kill_turn = np.where(killed.any(axis=1), killed.argmax(axis=1), BATTLE_MAX_TURNS)
+        death_turn = np.where(died.any(axis=1), died.argmax(axis=1), BATTLE_MAX_TURNS)
+        # Игрок бьёт первым: добил в тот же ход, когда умер бы сам, — победа
+        won = kill_turn <= death_turn
+        won &= kill_turn < BATTLE_MAX_TURNS
+        last = np.minimum(np.minimum(kill_turn, death_turn), BATTLE_MAX_TURNS - 1)
+
+        dealt = np.take_along_axis(p_cum, last[:, None], axis=1)[:, 0]
+        taken = np.take_along_axis(e_cum, last[:, None], axis=1)[:, 0]
+        # В ход победы враг уже не отвечает
+        taken = np.where(won, taken - np.take_along_axis(e_dmg, last[:, None], axis=1)[:, 0], taken)
+        parts.append((won, last + 1, dealt, taken))
+
+    if not parts:
+        empty = np.zeros(0, dtype=np.int64)
+        return BatchResult(empty.astype(bool), empty, empty, empty)
+    return BatchResult(*(np.concatenate(col) for col in zip(*parts)))
 
 
 # ======================== ОБРАБОТЧИКИ ========================
@@ -783,23 +3440,33 @@ async def cmd_start(message: Message):
 
     await create_user(uid, username)
     user = await get_user(uid)
+    if user.get("bot_blocked"):
+        # Вернулся после блокировки — снова получает рассылки
+        async with user_action(uid) as u:
+            u["bot_blocked"] = 0
 
     # Реферал
     if message.text:
         args = message.text.split()
         if len(args) > 1 and args[1].isdigit():
             ref_id = int(args[1])
-            if ref_id != uid and user["referrer_id"] == 0:
-                ref_user = await get_user(ref_id)
-                if ref_user:
-                    await update_user(uid, referrer_id=ref_id)
-                    await update_user(ref_id, gold=ref_user["gold"] + 50, gems=ref_user["gems"] + 2,
-                                      referral_count=ref_user["referral_count"] + 1,
-                                      total_gems_earned=ref_user["total_gems_earned"] + 2)
-                    try:
-                        await bot.send_message(ref_id, f"🎉 Новый реферал: {username}! +50💰 +2💎")
-                    except Exception:
-                        pass
+            linked = False
+            if ref_id != uid and await get_user(ref_id):
+                async with user_action(uid) as u:
+                    if u["referrer_id"] == 0:
+                        u["referrer_id"] = ref_id
+                        linked = True
+            if linked:
+                async with user_action(ref_id) as ref_user:
+                    ref_user["gold"] += 50
+                    ref_user["gems"] += 2
+                    ref_user["referral_count"] += 1
+                    ref_user["total_gems_earned"] += 2
+                    ach_msg = apply_achievements(ref_user, ("referral_count",))
+                try:
+                    await bot.send_message(ref_id, f"🎉 Новый реферал: {username}! +50💰 +2💎{ach_msg}")
+                except Exception:
+                    pass
 
     if user["class"]:
         await send_main_menu(message)
@@ -824,12 +3491,9 @@ async def choose_class(callback: CallbackQuery):
     if cls_key not in CLASSES:
         return await callback.answer("❌ Неизвестный класс")
     cls = CLASSES[cls_key]
-    await update_user(callback.from_user.id,
-                      **{"class": cls_key},
-                      hp=cls["hp"], max_hp=cls["hp"],
-                      atk=cls["atk"],
-                      **{"def": cls["def"]},
-                      crit=cls["crit"])
+    async with user_action(callback.from_user.id) as user:
+        user.update({"class": cls_key, "hp": cls["hp"], "max_hp": cls["hp"],
+                     "atk": cls["atk"], "def": cls["def"], "crit": cls["crit"]})
     await callback.message.edit_text(
         f"🎉 <b>Ты стал {cls['name']}!</b>\n\n"
         f"❤️{cls['hp']} ⚔️{cls['atk']} 🛡️{cls['def']} 🎯{cls['crit']}%\n\nУдачи, герой! 🐉")
@@ -838,18 +3502,21 @@ async def choose_class(callback: CallbackQuery):
     await callback.answer()
 
 
+MAIN_MENU_TEXT = "🐉 <b>Dungeon Master</b> — Главное меню\n\nВыбери действие:"
+MAIN_MENU_KB = build_kb([
+    [("👤 Профиль", "profile"), ("🗺️ Подземелья", "dungeons")],
+    [("🏟️ PvP Арена", "pvp"), ("🎰 Мини-игры", "games")],
+    [("🛒 Магазин", "shop"), ("💎 Гем-магазин", "gem_shop")],
+    [("🔨 Крафт", "craft"), ("🎯 Экспедиции", "expeditions")],
+    [("🎡 Колесо фортуны", "wheel"), ("🏆 Достижения", "achievements")],
+    [("🏆 Рейтинг", "leaderboard"), ("🎁 Ежедневная", "daily")],
+    [("📊 Статистика мира", "world_stats"), ("📦 Инвентарь", "inventory")],
+    [("💳 Донат-магазин", "donate_shop"), ("🔗 Реферал", "referral")],
+])
+
+
 async def send_main_menu(message: Message, edit=False):
-    kb = make_kb([
-        [("👤 Профиль", "profile"), ("🗺️ Подземелья", "dungeons")],
-        [("🏟️ PvP Арена", "pvp"), ("🎰 Мини-игры", "games")],
-        [("🛒 Магазин", "shop"), ("💎 Гем-магазин", "gem_shop")],
-        [("🔨 Крафт", "craft"), ("🎯 Экспедиции", "expeditions")],
-        [("🎡 Колесо фортуны", "wheel"), ("🏆 Достижения", "achievements")],
-        [("🏆 Рейтинг", "leaderboard"), ("🎁 Ежедневная", "daily")],
-        [("📊 Статистика мира", "world_stats"), ("📦 Инвентарь", "inventory")],
-        [("💳 Донат-магазин", "donate_shop"), ("🔗 Реферал", "referral")],
-    ])
-    text = "🐉 <b>Dungeon Master</b> — Главное меню\n\nВыбери действие:"
+    kb, text = MAIN_MENU_KB, MAIN_MENU_TEXT
     try:
         if edit:
             await message.edit_text(text, reply_markup=kb)
@@ -867,59 +3534,69 @@ async def cb_main_menu(callback: CallbackQuery):
 
 
 # ===================== ПРОФИЛЬ =====================
+# Рамка профиля собрана заранее: на каждый показ подставляются только поля игрока.
+SEPARATOR = "━" * 25
+PROFILE_TEMPLATE = (
+    "👤 <b>{username}</b> {emoji} {vip}\n"
+    "{title}\n" + SEPARATOR + "\n"
+    "📊 Уровень: <b>{level}</b> | ✨ {xp}/{xp_needed}\n"
+    "❤️ HP: {hp}/{max_hp}\n"
+    "⚔️{atk} 🛡️{def_} 🎯{crit}%\n"
+    "⚡ Энергия: {energy}/{max_energy}\n" + SEPARATOR + "\n"
+    "💰 {gold} | 💎 {gems}\n" + SEPARATOR + "\n"
+    "⚔️ PvP: {wins}W/{losses}L\n"
+    "🏰 Данжи: {dungeon_wins} | 👑 Боссы: {boss_kills}\n"
+    "🌟 Элиты: {elite_kills} | 🏅 Достижения: {unlocked}/" + str(len(ACHIEVEMENTS)) + "\n"
+    + SEPARATOR + "\n🎽 <b>Экипировка:</b>\n{equipment}"
+)
+PROFILE_KB = build_kb([
+    [("❤️ Лечиться (10💰)", "heal"), ("⚡ +Энергия (3💎)", "gem_energy")],
+    [("🔙 Назад", "main_menu")],
+])
+
+
 @router.callback_query(F.data == "profile")
 async def cb_profile(callback: CallbackQuery):
     fire_hiviews_callback(callback)
     user = await get_user(callback.from_user.id)
     if not user or not user["class"]:
         return await callback.answer("Сначала создай персонажа!")
-    await regen_energy(callback.from_user.id)
-    user = await get_user(callback.from_user.id)
     stats = calc_stats(user)
-    cls = CLASSES[user["class"]]
-    title = get_title(user["level"])
-    vip_text = "👑 VIP" if is_vip(user) else ""
-    equipment = json.loads(user["equipment"]) if user["equipment"] else {}
     eq_text = ""
-    for slot, item_key in equipment.items():
-        item = SHOP_ITEMS.get(item_key) or GEM_SHOP_ITEMS.get(item_key) or CRAFT_RECIPES.get(item_key)
+    for slot, item_key in user["equipment"].items():
+        item = ITEM_CATALOG.get(item_key)
         if item:
-            eq_text += f"  {item['name']}\n"
-    if not eq_text:
-        eq_text = "  Ничего\n"
-    unlocked = json.loads(user["achievements"]) if user["achievements"] else []
-    max_e = user["max_energy"] + (VIP_BENEFITS["max_energy_bonus"] if is_vip(user) else 0)
-    text = (
-        f"👤 <b>{user['username']}</b> {cls['emoji']} {vip_text}\n"
-        f"{title}\n{'━' * 25}\n"
-        f"📊 Уровень: <b>{user['level']}</b> | ✨ {user['xp']}/{user['xp_needed']}\n"
-        f"❤️ HP: {user['hp']}/{stats['max_hp']}\n"
-        f"⚔️{stats['atk']} 🛡️{stats['def']} 🎯{stats['crit']}%\n"
-        f"⚡ Энергия: {user['energy']}/{max_e}\n{'━' * 25}\n"
-        f"💰 {user['gold']} | 💎 {user['gems']}\n{'━' * 25}\n"
-        f"⚔️ PvP: {user['wins']}W/{user['losses']}L\n"
-        f"🏰 Данжи: {user['dungeon_wins']} | 👑 Боссы: {user['boss_kills']}\n"
-        f"🌟 Элиты: {user['elite_kills']} | 🏅 Достижения: {len(unlocked)}/{len(ACHIEVEMENTS)}\n"
-        f"{'━' * 25}\n🎽 <b>Экипировка:</b>\n{eq_text}"
+            eq_text += f"  {item.name}\n"
+    text = PROFILE_TEMPLATE.format(
+        username=user["username"], emoji=CLASSES[user["class"]]["emoji"],
+        vip="👑 VIP" if is_vip(user) else "", title=get_title(user["level"]),
+        level=user["level"], xp=user["xp"], xp_needed=user["xp_needed"],
+        hp=user["hp"], max_hp=stats["max_hp"], atk=stats["atk"], def_=stats["def"], crit=stats["crit"],
+        energy=current_energy(user), max_energy=get_max_energy(user),
+        gold=user["gold"], gems=user["gems"], wins=user["wins"], losses=user["losses"],
+        dungeon_wins=user["dungeon_wins"], boss_kills=user["boss_kills"],
+        elite_kills=user["elite_kills"], unlocked=len(user["achievements"]),
+        equipment=eq_text or "  Ничего\n",
     )
-    kb = make_kb([
-        [("❤️ Лечиться (10💰)", "heal"), ("⚡ +Энергия (3💎)", "gem_energy")],
-        [("🔙 Назад", "main_menu")],
-    ])
-    await callback.message.edit_text(text, reply_markup=kb)
+    await callback.message.edit_text(text, reply_markup=PROFILE_KB)
     await callback.answer()
 
 
 @router.callback_query(F.data == "heal")
 async def cb_heal(callback: CallbackQuery):
     fire_hiviews_callback(callback)
-    user = await get_user(callback.from_user.id)
-    if user["hp"] >= user["max_hp"]:
-        return await callback.answer("❤️ Здоровье полное!")
-    if user["gold"] < 10:
-        return await callback.answer("💰 Недостаточно золота!")
-    heal = min(50, user["max_hp"] - user["hp"])
-    await update_user(callback.from_user.id, hp=user["hp"] + heal, gold=user["gold"] - 10)
+    notice = None
+    async with user_action(callback.from_user.id) as user:
+        if user["hp"] >= user["max_hp"]:
+            notice = "❤️ Здоровье полное!"
+        elif user["gold"] < 10:
+            notice = "💰 Недостаточно золота!"
+        else:
+            heal = min(50, user["max_hp"] - user["hp"])
+            user["hp"] += heal
+            user["gold"] -= 10
+    if notice:
+        return await callback.answer(notice)
     await callback.answer(f"❤️ +{heal} HP!")
     await cb_profile(callback)
 
@@ -927,15 +3604,18 @@ async def cb_heal(callback: CallbackQuery):
 @router.callback_query(F.data == "gem_energy")
 async def cb_gem_energy(callback: CallbackQuery):
     fire_hiviews_callback(callback)
-    user = await get_user(callback.from_user.id)
-    if user["gems"] < 3:
-        return await callback.answer("💎 Нужно 3 гема!", show_alert=True)
-    max_e = user["max_energy"] + (VIP_BENEFITS["max_energy_bonus"] if is_vip(user) else 0)
-    if user["energy"] >= max_e:
-        return await callback.answer("⚡ Энергия уже полная!")
-    new_e = min(user["energy"] + 10, max_e)
-    await update_user(callback.from_user.id, gems=user["gems"] - 3, energy=new_e,
-                      last_energy=datetime.now().isoformat())
+    notice = None
+    async with user_action(callback.from_user.id) as user:
+        max_e = get_max_energy(user)
+        if user["gems"] < 3:
+            notice = ("💎 Нужно 3 гема!", True)
+        elif current_energy(user) >= max_e:
+            notice = ("⚡ Энергия уже полная!", False)
+        else:
+            user["gems"] -= 3
+            add_energy(user, 10)
+    if notice:
+        return await callback.answer(notice[0], show_alert=notice[1])
     await callback.answer("⚡ Энергия восстановлена!")
     await cb_profile(callback)
 
@@ -944,22 +3624,25 @@ async def cb_gem_energy(callback: CallbackQuery):
 @router.callback_query(F.data == "daily")
 async def cb_daily(callback: CallbackQuery):
     fire_hiviews_callback(callback)
-    user = await get_user(callback.from_user.id)
     today = datetime.now().strftime("%Y-%m-%d")
-    if user["daily_claimed"] == today:
+    async with user_action(callback.from_user.id) as user:
+        claimed = user["daily_claimed"] == today
+        if not claimed:
+            yesterday = (datetime.now() - timedelta(days=1)).strftime("%Y-%m-%d")
+            streak = user["streak"] + 1 if user["daily_claimed"] == yesterday else 1
+            gold = 20 + streak * 10
+            gems = (1 if streak >= 3 else 0) + (VIP_BENEFITS["daily_gems"] if is_vip(user) else 0)
+            energy_bonus = 3 if streak >= 5 else 0
+            wheel_spin = 1 if streak >= 2 else 0
+            user.update(daily_claimed=today, streak=streak,
+                        gold=user["gold"] + gold, gems=user["gems"] + gems,
+                        total_gems_earned=user["total_gems_earned"] + gems,
+                        wheel_spins=user["wheel_spins"] + wheel_spin)
+            if energy_bonus:
+                add_energy(user, energy_bonus)
+            ach_msg = apply_achievements(user, ("streak",))
+    if claimed:
         return await callback.answer("🎁 Уже забрал! Приходи завтра.", show_alert=True)
-    yesterday = (datetime.now() - timedelta(days=1)).strftime("%Y-%m-%d")
-    streak = user["streak"] + 1 if user["daily_claimed"] == yesterday else 1
-    gold = 20 + streak * 10
-    gems = (1 if streak >= 3 else 0) + (VIP_BENEFITS["daily_gems"] if is_vip(user) else 0)
-    energy_bonus = 3 if streak >= 5 else 0
-    wheel_spin = 1 if streak >= 2 else 0
-    max_e = user["max_energy"] + (VIP_BENEFITS["max_energy_bonus"] if is_vip(user) else 0)
-    await update_user(callback.from_user.id, daily_claimed=today, streak=streak,
-                      gold=user["gold"] + gold, gems=user["gems"] + gems,
-                      total_gems_earned=user["total_gems_earned"] + gems,
-                      energy=min(user["energy"] + energy_bonus, max_e),
-                      wheel_spins=user["wheel_spins"] + wheel_spin)
     text = f"🎁 <b>Ежедневная награда!</b>\n🔥 Стрик: <b>{streak}</b>\n\n💰 +{gold}\n"
     if gems:
         text += f"💎 +{gems}\n"
@@ -968,7 +3651,6 @@ async def cb_daily(callback: CallbackQuery):
     if wheel_spin:
         text += f"🎡 +{wheel_spin} вращение колеса!\n"
     text += "\n💡 Заходи каждый день!"
-    ach_msg = await check_achievements(callback.from_user.id)
     if ach_msg:
         text += ach_msg
     kb = make_kb([[("🔙 Назад", "main_menu")]])
@@ -983,10 +3665,8 @@ async def cb_dungeons(callback: CallbackQuery):
     user = await get_user(callback.from_user.id)
     if not user or not user["class"]:
         return await callback.answer("Создай персонажа!")
-    await regen_energy(callback.from_user.id)
-    user = await get_user(callback.from_user.id)
-    max_e = user["max_energy"] + (VIP_BENEFITS["max_energy_bonus"] if is_vip(user) else 0)
-    text = f"🗺️ <b>Подземелья</b>\n⚡ {user['energy']}/{max_e}\n\n"
+    max_e = get_max_energy(user)
+    text = f"🗺️ <b>Подземелья</b>\n⚡ {current_energy(user)}/{max_e}\n\n"
     buttons = []
     for d_id, dungeon in DUNGEONS.items():
         locked = user["level"] < dungeon["min_lvl"]
@@ -1004,12 +3684,11 @@ async def cb_dungeons(callback: CallbackQuery):
 async def cb_enter_dungeon(callback: CallbackQuery):
     fire_hiviews_callback(callback)
     d_id = int(callback.data.replace("enter_dungeon_", ""))
-    user = await get_user(callback.from_user.id)
     dungeon = DUNGEONS.get(d_id)
-    if not dungeon or user["level"] < dungeon["min_lvl"]:
-        return await callback.answer("🔒 Недоступно!")
-    await regen_energy(callback.from_user.id)
     user = await get_user(callback.from_user.id)
+    allowed = dungeon and user["level"] >= dungeon["min_lvl"]
+    if not allowed:
+        return await callback.answer("🔒 Недоступно!")
     kb = make_kb([
         [("⚔️ Монстр (1⚡)", f"fight_monster_{d_id}")],
         [("👑 Босс (2⚡)", f"fight_boss_{d_id}")],
@@ -1017,7 +3696,7 @@ async def cb_enter_dungeon(callback: CallbackQuery):
         [("🔙 К подземельям", "dungeons")],
     ])
     text = (f"🏰 <b>{dungeon['name']}</b>\n"
-            f"⚡ {user['energy']} | ❤️ {user['hp']}/{user['max_hp']}\n\nМонстры:\n")
+            f"⚡ {current_energy(user)} | ❤️ {user['hp']}/{user['max_hp']}\n\nМонстры:\n")
     for m in dungeon["monsters"]:
         text += f"  {m['name']} — ❤️{m['hp']} ⚔️{m['atk']}\n"
     text += f"\n👑 Босс: {dungeon['boss']['name']}"
@@ -1026,35 +3705,39 @@ async def cb_enter_dungeon(callback: CallbackQuery):
     await callback.answer()
 
 
-async def do_battle(user_id: int, enemy: dict) -> tuple:
-    user = await get_user(user_id)
-    stats = calc_stats(user)
-    mults = get_buff_multipliers(user)
-    p_hp = user["hp"]
-    e_hp = enemy["hp"]
+def spend_energy(user: dict, cost: int) -> bool:
+    """Списывает энергию на бой (внутри user_action)."""
+    if current_energy(user) < cost:
+        return False
+    regen_energy(user)
+    user["energy"] -= cost
+    return True
+
+
+def do_battle(user: dict, enemy: dict) -> tuple:
+    """
+    Бой и награды в словаре игрока (внутри user_action).
+    Счётчики побед и достижения обновляет вызывающий хендлер.
+    """
+    bonus, (xp_mult, gold_mult, gem_luck) = derived_stats(user)
+    stats = apply_bonus(user, bonus)
+    stats["hp"] = user["hp"]
+    mults = {"xp_mult": xp_mult, "gold_mult": gold_mult, "gem_luck": gem_luck}
+    result = simulate_battle(stats, enemy, with_log=True)
     log = f"⚔️ <b>Бой с {enemy['name']}</b>\n{'━' * 20}\n"
-    turn = 0
-    while p_hp > 0 and e_hp > 0 and turn < 30:
-        turn += 1
-        is_crit = random.randint(1, 100) <= stats["crit"]
-        dmg = max(1, stats["atk"] - random.randint(0, 3))
-        if is_crit:
-            dmg = int(dmg * 2)
+    for side, dmg, is_crit in result.log:
+        if side == "enemy":
+            log += f"{enemy['name']} -{dmg}\n"
+        elif is_crit:
             log += f"🎯 КРИТ! -{dmg}\n"
         else:
             log += f"⚔️ -{dmg}\n"
-        e_hp -= dmg
-        if e_hp <= 0:
-            break
-        e_dmg = max(1, enemy["atk"] - stats["def"] // 2 + random.randint(-2, 2))
-        p_hp -= e_dmg
-        log += f"{enemy['name']} -{e_dmg}\n"
 
-    won = e_hp <= 0
-    p_hp = max(0, p_hp)
+    won = result.won
+    p_hp = max(0, result.player_hp)
 
     if not won and p_hp <= 0:
-        inventory = json.loads(user["inventory"]) if user["inventory"] else {}
+        inventory = user["inventory"]
         if inventory.get("revive_stone", 0) > 0:
             inventory["revive_stone"] -= 1
             if inventory["revive_stone"] <= 0:
@@ -1062,10 +3745,8 @@ async def do_battle(user_id: int, enemy: dict) -> tuple:
             p_hp = user["max_hp"] // 2
             won = True
             log += f"\n💎 <b>Камень воскрешения!</b> HP: {p_hp}\n"
-            await update_user(user_id, inventory=json.dumps(inventory))
 
-    final_hp = p_hp if won else max(1, p_hp)
-    await update_user(user_id, hp=final_hp)
+    user["hp"] = p_hp if won else max(1, p_hp)
 
     if won:
         gold = int(max(0, enemy["gold"] + random.randint(-5, 10)) * mults["gold_mult"])
@@ -1075,34 +3756,27 @@ async def do_battle(user_id: int, enemy: dict) -> tuple:
         if not gems_drop and random.randint(1, 100) <= gem_chance:
             gems_drop = 1
 
-        user = await get_user(user_id)
-        upd = {"gold": user["gold"] + gold, "total_gold_earned": user["total_gold_earned"] + gold}
+        user["gold"] += gold
+        user["total_gold_earned"] += gold
         if gems_drop:
-            upd["gems"] = user["gems"] + gems_drop
-            upd["total_gems_earned"] = user["total_gems_earned"] + gems_drop
-        await update_user(user_id, **upd)
-        level_msg = await add_xp(user_id, xp)
+            user["gems"] += gems_drop
+            user["total_gems_earned"] += gems_drop
+        level_msg = apply_xp(user, xp)
         log += f"\n🏆 <b>Победа!</b>\n💰+{gold} ✨+{xp}"
         if gems_drop:
             log += f" 💎+{gems_drop}"
         log += level_msg
-
-        user = await get_user(user_id)
         log += f"\n❤️ HP: {user['hp']}/{user['max_hp']}"
 
         # Уменьшаем длительность баффов
-        buffs = json.loads(user["buffs"]) if user["buffs"] else []
+        buffs = user["buffs"]
         new_buffs = []
         for b in buffs:
             dur = b["effect"].get("duration", 0)
             if dur > 1:
                 b["effect"]["duration"] = dur - 1
                 new_buffs.append(b)
-        await update_user(user_id, buffs=json.dumps(new_buffs))
-
-        ach_msg = await check_achievements(user_id)
-        if ach_msg:
-            log += ach_msg
+        user["buffs"] = new_buffs
     else:
         log += f"\n💀 <b>Поражение...</b>\n❤️ HP: 1/{user['max_hp']}"
 
@@ -1113,22 +3787,24 @@ async def do_battle(user_id: int, enemy: dict) -> tuple:
 async def cb_fight_monster(callback: CallbackQuery):
     fire_hiviews_callback(callback)
     d_id = int(callback.data.replace("fight_monster_", ""))
-    await regen_energy(callback.from_user.id)
-    user = await get_user(callback.from_user.id)
     dungeon = DUNGEONS.get(d_id)
     if not dungeon:
         return await callback.answer("❌ Подземелье не найдено!")
-    if user["energy"] < 1:
-        return await callback.answer("⚡ Нет энергии!", show_alert=True)
-    if user["hp"] <= 1:
-        return await callback.answer("❤️ Мало HP! Вылечись.", show_alert=True)
-    await update_user(callback.from_user.id, energy=user["energy"] - 1,
-                      last_energy=datetime.now().isoformat())
-    monster = random.choice(dungeon["monsters"])
-    log, won = await do_battle(callback.from_user.id, monster)
-    if won:
-        u = await get_user(callback.from_user.id)
-        await update_user(callback.from_user.id, dungeon_wins=u["dungeon_wins"] + 1)
+    notice = None
+    async with user_action(callback.from_user.id) as user:
+        if current_energy(user) < 1:
+            notice = "⚡ Нет энергии!"
+        elif user["hp"] <= 1:
+            notice = "❤️ Мало HP! Вылечись."
+        else:
+            spend_energy(user, 1)
+            monster = random.choice(dungeon["monsters"])
+            log, won = do_battle(user, monster)
+            if won:
+                user["dungeon_wins"] += 1
+                log += apply_achievements(user, ("dungeon_wins",) + BATTLE_COUNTERS)
+    if notice:
+        return await callback.answer(notice, show_alert=True)
     kb = make_kb([
         [("⚔️ Ещё", f"fight_monster_{d_id}"), ("👑 Босс", f"fight_boss_{d_id}")],
         [("🔙 Подземелья", "dungeons"), ("🏠 Меню", "main_menu")],
@@ -1141,26 +3817,27 @@ async def cb_fight_monster(callback: CallbackQuery):
 async def cb_fight_boss(callback: CallbackQuery):
     fire_hiviews_callback(callback)
     d_id = int(callback.data.replace("fight_boss_", ""))
-    await regen_energy(callback.from_user.id)
-    user = await get_user(callback.from_user.id)
     dungeon = DUNGEONS.get(d_id)
     if not dungeon:
         return await callback.answer("❌ Не найдено!")
-    if user["energy"] < 2:
-        return await callback.answer("⚡ Нужно 2 энергии!", show_alert=True)
-    if user["hp"] <= 5:
-        return await callback.answer("❤️ Мало HP!", show_alert=True)
-    await update_user(callback.from_user.id, energy=user["energy"] - 2,
-                      last_energy=datetime.now().isoformat())
-    log, won = await do_battle(callback.from_user.id, dungeon["boss"])
-    if won:
-        u = await get_user(callback.from_user.id)
-        await update_user(callback.from_user.id, boss_kills=u["boss_kills"] + 1)
-        if random.randint(1, 100) <= 30:
-            u = await get_user(callback.from_user.id)
-            await update_user(callback.from_user.id, gems=u["gems"] + 2,
-                              total_gems_earned=u["total_gems_earned"] + 2)
-            log += "\n💎 <b>+2 гема из босса!</b>"
+    notice = None
+    async with user_action(callback.from_user.id) as user:
+        if current_energy(user) < 2:
+            notice = "⚡ Нужно 2 энергии!"
+        elif user["hp"] <= 5:
+            notice = "❤️ Мало HP!"
+        else:
+            spend_energy(user, 2)
+            log, won = do_battle(user, dungeon["boss"])
+            if won:
+                user["boss_kills"] += 1
+                if random.randint(1, 100) <= 30:
+                    user["gems"] += 2
+                    user["total_gems_earned"] += 2
+                    log += "\n💎 <b>+2 гема из босса!</b>"
+                log += apply_achievements(user, ("boss_kills",) + BATTLE_COUNTERS)
+    if notice:
+        return await callback.answer(notice, show_alert=True)
     kb = make_kb([
         [("⚔️ Монстр", f"fight_monster_{d_id}"), ("👑 Босс", f"fight_boss_{d_id}")],
         [("🔙 Подземелья", "dungeons")],
@@ -1173,22 +3850,24 @@ async def cb_fight_boss(callback: CallbackQuery):
 async def cb_fight_elite(callback: CallbackQuery):
     fire_hiviews_callback(callback)
     d_id = int(callback.data.replace("fight_elite_", ""))
-    await regen_energy(callback.from_user.id)
-    user = await get_user(callback.from_user.id)
-    if user["energy"] < 3:
-        return await callback.answer("⚡ Нужно 3 энергии!", show_alert=True)
-    if user["hp"] <= 5:
-        return await callback.answer("❤️ Мало HP!", show_alert=True)
-    available = [m for m in ELITE_MONSTERS if user["level"] >= m["min_lvl"]]
-    if not available:
-        return await callback.answer("🌟 Нет доступных элитных монстров!", show_alert=True)
-    await update_user(callback.from_user.id, energy=user["energy"] - 3,
-                      last_energy=datetime.now().isoformat())
-    elite = random.choice(available)
-    log, won = await do_battle(callback.from_user.id, elite)
-    if won:
-        u = await get_user(callback.from_user.id)
-        await update_user(callback.from_user.id, elite_kills=u["elite_kills"] + 1)
+    notice = None
+    async with user_action(callback.from_user.id) as user:
+        available = [m for m in ELITE_MONSTERS if user["level"] >= m["min_lvl"]]
+        if current_energy(user) < 3:
+            notice = "⚡ Нужно 3 энергии!"
+        elif user["hp"] <= 5:
+            notice = "❤️ Мало HP!"
+        elif not available:
+            notice = "🌟 Нет доступных элитных монстров!"
+        else:
+            spend_energy(user, 3)
+            elite = random.choice(available)
+            log, won = do_battle(user, elite)
+            if won:
+                user["elite_kills"] += 1
+                log += apply_achievements(user, BATTLE_COUNTERS)
+    if notice:
+        return await callback.answer(notice, show_alert=True)
     kb = make_kb([
         [("⚔️ Монстр", f"fight_monster_{d_id}"), ("🌟 Ещё элитный", f"fight_elite_{d_id}")],
         [("🔙 Подземелья", "dungeons")],
@@ -1216,37 +3895,30 @@ async def cb_pvp(callback: CallbackQuery):
 async def cb_pvp_fight(callback: CallbackQuery):
     fire_hiviews_callback(callback)
     user_id = callback.from_user.id
-    await regen_energy(user_id)
-    user = await get_user(user_id)
-    if user["energy"] < 2:
-        return await callback.answer("⚡ Нужно 2 энергии!", show_alert=True)
-    if user["hp"] <= 5:
-        return await callback.answer("❤️ Мало HP!", show_alert=True)
-    async with aiosqlite.connect(DB_PATH) as db:
-        db.row_factory = aiosqlite.Row
-        async with db.execute(
-            "SELECT * FROM users WHERE user_id != ? AND class != '' AND is_banned = 0 "
-            "AND level BETWEEN ? AND ? ORDER BY RANDOM() LIMIT 1",
-            (user_id, max(1, user["level"] - 3), user["level"] + 3)
-        ) as cur:
-            opp_row = await cur.fetchone()
-    if not opp_row:
-        opponent = {"name": random.choice(["🤖 Голем", "🧑‍🦱 Странник", "🧝 Эльф"]),
-                    "hp": user["max_hp"], "atk": user["atk"] + random.randint(-3, 3),
-                    "gold": 30, "xp": 20}
-    else:
-        o = dict(opp_row)
-        os_stats = calc_stats(o)
-        opponent = {"name": f"{CLASSES[o['class']]['emoji']} {o['username']}",
-                    "hp": o["max_hp"], "atk": os_stats["atk"],
-                    "gold": random.randint(30, 50), "xp": 25}
-    await update_user(user_id, energy=user["energy"] - 2, last_energy=datetime.now().isoformat())
-    log, won = await do_battle(user_id, opponent)
-    u = await get_user(user_id)
-    if won:
-        await update_user(user_id, wins=u["wins"] + 1)
-    else:
-        await update_user(user_id, losses=u["losses"] + 1)
+    notice = None
+    async with user_action(user_id) as user:
+        if current_energy(user) < 2:
+            notice = "⚡ Нужно 2 энергии!"
+        elif user["hp"] <= 5:
+            notice = "❤️ Мало HP!"
+        else:
+            opp = matchmaking.pick(user_id, user["level"])
+            if not opp:
+                opponent = {"name": random.choice(["🤖 Голем", "🧑‍🦱 Странник", "🧝 Эльф"]),
+                            "hp": user["max_hp"], "atk": user["atk"] + random.randint(-3, 3),
+                            "gold": 30, "xp": 20}
+            else:
+                opponent = {"name": opp["name"], "hp": opp["max_hp"], "atk": opp["atk"],
+                            "gold": random.randint(30, 50), "xp": 25}
+            spend_energy(user, 2)
+            log, won = do_battle(user, opponent)
+            if won:
+                user["wins"] += 1
+                log += apply_achievements(user, ("wins",) + BATTLE_COUNTERS)
+            else:
+                user["losses"] += 1
+    if notice:
+        return await callback.answer(notice, show_alert=True)
     kb = make_kb([[("⚔️ Ещё!", "pvp_fight")],
                   [("🔙 Арена", "pvp"), ("🏠 Меню", "main_menu")]])
     await callback.message.edit_text(log, reply_markup=kb)
@@ -1254,18 +3926,20 @@ async def cb_pvp_fight(callback: CallbackQuery):
 
 
 # ===================== МИНИ-ИГРЫ =====================
+GAMES_TEXT = ("🎰 <b>Мини-игры</b>\n\nИспытай удачу!\n\n"
+              "🎲 Кости — угадай больше/меньше\n🎰 Слоты — крути барабан!\n"
+              "🃏 Рулетка — красное/чёрное\n")
+GAMES_KB = build_kb([
+    [("🎲 Кости (10💰)", "game_dice"), ("🎰 Слоты (20💰)", "game_slots")],
+    [("🃏 Рулетка (15💰)", "game_roulette")],
+    [("🔙 Назад", "main_menu")],
+])
+
+
 @router.callback_query(F.data == "games")
 async def cb_games(callback: CallbackQuery):
     fire_hiviews_callback(callback)
-    text = ("🎰 <b>Мини-игры</b>\n\nИспытай удачу!\n\n"
-            "🎲 Кости — угадай больше/меньше\n🎰 Слоты — крути барабан!\n"
-            "🃏 Рулетка — красное/чёрное\n")
-    kb = make_kb([
-        [("🎲 Кости (10💰)", "game_dice"), ("🎰 Слоты (20💰)", "game_slots")],
-        [("🃏 Рулетка (15💰)", "game_roulette")],
-        [("🔙 Назад", "main_menu")],
-    ])
-    await callback.message.edit_text(text, reply_markup=kb)
+    await callback.message.edit_text(GAMES_TEXT, reply_markup=GAMES_KB)
     await callback.answer()
 
 
@@ -1288,22 +3962,23 @@ async def cb_game_dice(callback: CallbackQuery):
 @router.callback_query(F.data.startswith("dice_"))
 async def cb_dice_result(callback: CallbackQuery):
     fire_hiviews_callback(callback)
-    user = await get_user(callback.from_user.id)
-    if user["gold"] < 10:
-        return await callback.answer("💰 Нужно 10 золота!", show_alert=True)
     bet = callback.data.replace("dice_", "")
-    d1, d2 = random.randint(1, 6), random.randint(1, 6)
-    total = d1 + d2
-    won, mult = False, 0
-    if bet == "high" and total > 7:
-        won, mult = True, 2
-    elif bet == "low" and total < 7:
-        won, mult = True, 2
-    elif bet == "seven" and total == 7:
-        won, mult = True, 5
-    winnings = 10 * mult if won else 0
-    new_gold = user["gold"] - 10 + winnings
-    await update_user(callback.from_user.id, gold=new_gold)
+    async with user_action(callback.from_user.id) as user:
+        broke = user["gold"] < 10
+        if not broke:
+            d1, d2 = random.randint(1, 6), random.randint(1, 6)
+            total = d1 + d2
+            won, mult = False, 0
+            if bet == "high" and total > 7:
+                won, mult = True, 2
+            elif bet == "low" and total < 7:
+                won, mult = True, 2
+            elif bet == "seven" and total == 7:
+                won, mult = True, 5
+            winnings = 10 * mult if won else 0
+            new_gold = user["gold"] = user["gold"] - 10 + winnings
+    if broke:
+        return await callback.answer("💰 Нужно 10 золота!", show_alert=True)
     result_text = f"🏆 +{winnings}💰" if won else "💀 -10💰"
     text = f"🎲 {d1} + {d2} = <b>{total}</b>\n\n{result_text}\n💰 {new_gold}"
     kb = make_kb([[("🎲 Ещё", "game_dice")],
@@ -1315,15 +3990,16 @@ async def cb_dice_result(callback: CallbackQuery):
 @router.callback_query(F.data == "game_slots")
 async def cb_game_slots(callback: CallbackQuery):
     fire_hiviews_callback(callback)
-    user = await get_user(callback.from_user.id)
-    if user["gold"] < 20:
+    async with user_action(callback.from_user.id) as user:
+        broke = user["gold"] < 20
+        if not broke:
+            weights = [30, 25, 20, 15, 5, 2, 10, 8]
+            s1, s2, s3 = [random.choices(SLOT_SYMBOLS, weights=weights, k=1)[0] for _ in range(3)]
+            payout = SLOT_PAYOUTS.get((s1, s2, s3), 0)
+            winnings = payout * 20 if payout else (10 if s1 == s2 or s2 == s3 or s1 == s3 else 0)
+            new_gold = user["gold"] = user["gold"] - 20 + winnings
+    if broke:
         return await callback.answer("💰 Нужно 20 золота!", show_alert=True)
-    weights = [30, 25, 20, 15, 5, 2, 10, 8]
-    s1, s2, s3 = [random.choices(SLOT_SYMBOLS, weights=weights, k=1)[0] for _ in range(3)]
-    payout = SLOT_PAYOUTS.get((s1, s2, s3), 0)
-    winnings = payout * 20 if payout else (10 if s1 == s2 or s2 == s3 or s1 == s3 else 0)
-    new_gold = user["gold"] - 20 + winnings
-    await update_user(callback.from_user.id, gold=new_gold)
     jackpot = " 🔥🔥🔥" if payout and payout >= 20 else ""
     result_text = f"🏆 +{winnings}💰{jackpot}" if winnings else "💀 -20💰"
     text = (f"🎰 <b>С Л О Т Ы</b>\n\n╔═══════════╗\n║ {s1} {s2} {s3} ║\n"
@@ -1334,33 +4010,36 @@ async def cb_game_slots(callback: CallbackQuery):
     await callback.answer()
 
 
+ROULETTE_KB = build_kb([
+    [("🔴 Красное (x2)", "roul_red"), ("⚫ Чёрное (x2)", "roul_black")],
+    [("🟢 Зеро (x10)", "roul_green")],
+    [("🔙 Назад", "games")],
+])
+
+
 @router.callback_query(F.data == "game_roulette")
 async def cb_game_roulette(callback: CallbackQuery):
     fire_hiviews_callback(callback)
-    kb = make_kb([
-        [("🔴 Красное (x2)", "roul_red"), ("⚫ Чёрное (x2)", "roul_black")],
-        [("🟢 Зеро (x10)", "roul_green")],
-        [("🔙 Назад", "games")],
-    ])
-    await callback.message.edit_text("🃏 <b>Рулетка</b>\nСтавка: 15💰", reply_markup=kb)
+    await callback.message.edit_text("🃏 <b>Рулетка</b>\nСтавка: 15💰", reply_markup=ROULETTE_KB)
     await callback.answer()
 
 
 @router.callback_query(F.data.startswith("roul_"))
 async def cb_roulette_result(callback: CallbackQuery):
     fire_hiviews_callback(callback)
-    user = await get_user(callback.from_user.id)
-    if user["gold"] < 15:
-        return await callback.answer("💰 Нужно 15 золота!", show_alert=True)
     bet = callback.data.replace("roul_", "")
-    r = random.randint(1, 100)
-    result = "green" if r <= 3 else ("red" if r <= 51 else "black")
     names = {"green": "🟢 ЗЕРО!", "red": "🔴 Красное", "black": "⚫ Чёрное"}
-    won = bet == result
-    mult = {"red": 2, "black": 2, "green": 10}.get(bet, 0) if won else 0
-    winnings = 15 * mult
-    new_gold = user["gold"] - 15 + winnings
-    await update_user(callback.from_user.id, gold=new_gold)
+    async with user_action(callback.from_user.id) as user:
+        broke = user["gold"] < 15
+        if not broke:
+            r = random.randint(1, 100)
+            result = "green" if r <= 3 else ("red" if r <= 51 else "black")
+            won = bet == result
+            mult = {"red": 2, "black": 2, "green": 10}.get(bet, 0) if won else 0
+            winnings = 15 * mult
+            new_gold = user["gold"] = user["gold"] - 15 + winnings
+    if broke:
+        return await callback.answer("💰 Нужно 15 золота!", show_alert=True)
     result_text = f"🏆 +{winnings}💰" if won else "💀 -15💰"
     text = f"🃏 Результат: <b>{names[result]}</b>\n\n{result_text}\n💰 {new_gold}"
     kb = make_kb([[("🃏 Ещё", "game_roulette")],
@@ -1370,11 +4049,9 @@ async def cb_roulette_result(callback: CallbackQuery):
 
 
 # ===================== МАГАЗИН =====================
-@router.callback_query(F.data == "shop")
-async def cb_shop(callback: CallbackQuery):
-    fire_hiviews_callback(callback)
-    user = await get_user(callback.from_user.id)
-    text = f"🛒 <b>Магазин</b>\n💰 {user['gold']} | 💎 {user['gems']}\n\n"
+def build_shop_view() -> tuple:
+    """Список товаров магазина не зависит от игрока — собираем его один раз."""
+    text = ""
     buttons = []
     cats = {"consumable": "🧪 Расходники", "buff": "📜 Свитки", "equipment": "🎽 Экипировка"}
     for cat, name in cats.items():
@@ -1385,7 +4062,24 @@ async def cb_shop(callback: CallbackQuery):
                 text += f"  {item['name']} — {item['price']}💰\n"
                 buttons.append([(f"{item['name']} ({item['price']}💰)", f"buy_{key}")])
     buttons.append([("🔙 Назад", "main_menu")])
-    await callback.message.edit_text(text, reply_markup=make_kb(buttons))
+    return text, build_kb(buttons)
+
+
+def literal(text: str) -> str:
+    """Экранирует фигурные скобки, чтобы готовый текст можно было вклеить в шаблон str.format."""
+    return text.replace("{", "{{").replace("}", "}}")
+
+
+SHOP_BODY, SHOP_KB = build_shop_view()
+SHOP_TEMPLATE = "🛒 <b>Магазин</b>\n💰 {gold} | 💎 {gems}\n\n" + literal(SHOP_BODY)
+
+
+@router.callback_query(F.data == "shop")
+async def cb_shop(callback: CallbackQuery):
+    fire_hiviews_callback(callback)
+    user = await get_user(callback.from_user.id)
+    text = SHOP_TEMPLATE.format(gold=user["gold"], gems=user["gems"])
+    await callback.message.edit_text(text, reply_markup=SHOP_KB)
     await callback.answer()
 
 
@@ -1395,55 +4089,47 @@ async def cb_buy_item(callback: CallbackQuery):
     item_key = callback.data.replace("buy_", "")
     if item_key not in SHOP_ITEMS:
         return await callback.answer("❌ Не найдено")
-    user = await get_user(callback.from_user.id)
     item = SHOP_ITEMS[item_key]
-    if user["gold"] < item["price"]:
-        return await callback.answer("💰 Не хватает!", show_alert=True)
-
-    upd = {"gold": user["gold"] - item["price"]}
-
-    if item["type"] == "consumable":
-        inventory = json.loads(user["inventory"]) if user["inventory"] else {}
-        if "hp" in item["effect"]:
-            new_hp = min(user["hp"] + item["effect"]["hp"], user["max_hp"])
-            upd["hp"] = new_hp
-            await callback.answer(f"❤️ +{item['effect']['hp']} HP!")
-        elif "revive" in item["effect"]:
-            inventory[item_key] = inventory.get(item_key, 0) + 1
-            upd["inventory"] = json.dumps(inventory)
-            await callback.answer("✅ Камень воскрешения в инвентаре!")
+    notice, alert, bought = None, False, False
+    async with user_action(callback.from_user.id) as user:
+        if user["gold"] < item["price"]:
+            notice = "💰 Не хватает!"
         else:
-            inventory[item_key] = inventory.get(item_key, 0) + 1
-            upd["inventory"] = json.dumps(inventory)
-            await callback.answer("✅ Добавлено!")
-    elif item["type"] == "buff":
-        buffs = json.loads(user["buffs"]) if user["buffs"] else []
-        buffs.append({"name": item["name"], "effect": dict(item["effect"])})
-        upd["buffs"] = json.dumps(buffs)
-        await callback.answer("📜 Бафф активирован!")
-    elif item["type"] == "equipment":
-        equipment = json.loads(user["equipment"]) if user["equipment"] else {}
-        old = equipment.get(item["slot"])
-        if old:
-            inventory = json.loads(user.get("inventory") or "{}")
-            inventory[old] = inventory.get(old, 0) + 1
-            upd["inventory"] = json.dumps(inventory)
-        equipment[item["slot"]] = item_key
-        upd["equipment"] = json.dumps(equipment)
-        await callback.answer("🎽 Экипировано!", show_alert=True)
-
-    await update_user(callback.from_user.id, **upd)
+            bought = True
+            user["gold"] -= item["price"]
+            if item["type"] == "consumable":
+                inventory = user["inventory"]
+                if "hp" in item["effect"]:
+                    user["hp"] = min(user["hp"] + item["effect"]["hp"], user["max_hp"])
+                    notice = f"❤️ +{item['effect']['hp']} HP!"
+                elif "revive" in item["effect"]:
+                    inventory[item_key] = inventory.get(item_key, 0) + 1
+                    notice = "✅ Камень воскрешения в инвентаре!"
+                else:
+                    inventory[item_key] = inventory.get(item_key, 0) + 1
+                    notice = "✅ Добавлено!"
+            elif item["type"] == "buff":
+                buffs = user["buffs"]
+                buffs.append(make_buff(item_key))
+                notice = "📜 Бафф активирован!"
+            elif item["type"] == "equipment":
+                equipment = user["equipment"]
+                old = equipment.get(item["slot"])
+                if old:
+                    inventory = user["inventory"]
+                    inventory[old] = inventory.get(old, 0) + 1
+                equipment[item["slot"]] = item_key
+                notice, alert = "🎽 Экипировано!", True
+    if not bought:
+        return await callback.answer(notice, show_alert=True)
+    await callback.answer(notice, show_alert=alert)
     await cb_shop(callback)
 
 
 # ===================== ГЕМ-МАГАЗИН =====================
-@router.callback_query(F.data == "gem_shop")
-async def cb_gem_shop(callback: CallbackQuery):
-    fire_hiviews_callback(callback)
-    user = await get_user(callback.from_user.id)
-    text = f"💎 <b>Гем-магазин</b>\n💎 Кристаллов: {user['gems']}\n\n"
+def build_gem_shop_view() -> tuple:
     buttons = []
-    text += "<b>🎽 Мифическая экипировка:</b>\n"
+    text = "<b>🎽 Мифическая экипировка:</b>\n"
     for key, item in GEM_SHOP_ITEMS.items():
         if item["type"] == "equipment":
             text += f"  {item['name']} — {item['price_gems']}💎\n  <i>{item['desc']}</i>\n"
@@ -1460,7 +4146,19 @@ async def cb_gem_shop(callback: CallbackQuery):
     text += "\n<b>💱 Обмен:</b>\n  💎1 гем = 💰50 золота\n"
     buttons.append([("💱 1💎 → 50💰", "gem_exchange_1"), ("💱 10💎 → 500💰", "gem_exchange_10")])
     buttons.append([("🔙 Назад", "main_menu")])
-    await callback.message.edit_text(text, reply_markup=make_kb(buttons))
+    return text, build_kb(buttons)
+
+
+GEM_SHOP_BODY, GEM_SHOP_KB = build_gem_shop_view()
+GEM_SHOP_TEMPLATE = "💎 <b>Гем-магазин</b>\n💎 Кристаллов: {gems}\n\n" + literal(GEM_SHOP_BODY)
+
+
+@router.callback_query(F.data == "gem_shop")
+async def cb_gem_shop(callback: CallbackQuery):
+    fire_hiviews_callback(callback)
+    user = await get_user(callback.from_user.id)
+    text = GEM_SHOP_TEMPLATE.format(gems=user["gems"])
+    await callback.message.edit_text(text, reply_markup=GEM_SHOP_KB)
     await callback.answer()
 
 
@@ -1470,47 +4168,44 @@ async def cb_gem_buy(callback: CallbackQuery):
     key = callback.data.replace("gbuy_", "")
     if key not in GEM_SHOP_ITEMS:
         return await callback.answer("❌ Не найдено")
-    user = await get_user(callback.from_user.id)
     item = GEM_SHOP_ITEMS[key]
-    if user["gems"] < item["price_gems"]:
-        return await callback.answer("💎 Не хватает гемов!", show_alert=True)
-
-    upd = {"gems": user["gems"] - item["price_gems"]}
-
-    if item["type"] == "equipment":
-        equipment = json.loads(user["equipment"]) if user["equipment"] else {}
-        old = equipment.get(item["slot"])
-        if old:
-            inventory = json.loads(user.get("inventory") or "{}")
-            inventory[old] = inventory.get(old, 0) + 1
-            upd["inventory"] = json.dumps(inventory)
-        equipment[item["slot"]] = key
-        upd["equipment"] = json.dumps(equipment)
-        await callback.answer(f"🎽 {item['name']} экипировано!", show_alert=True)
-    elif item["type"] == "buff":
-        buffs = json.loads(user["buffs"]) if user["buffs"] else []
-        buffs.append({"name": item["name"], "effect": dict(item["effect"])})
-        upd["buffs"] = json.dumps(buffs)
-        await callback.answer(f"📜 {item['name']} активирован!")
-    elif item["type"] == "consumable":
-        eff = item["effect"]
-        if eff.get("full_heal"):
-            upd["hp"] = user["max_hp"]
-        if eff.get("full_energy"):
-            max_e = user["max_energy"] + (VIP_BENEFITS["max_energy_bonus"] if is_vip(user) else 0)
-            upd["energy"] = max_e
-        if eff.get("energy"):
-            max_e = user["max_energy"] + (VIP_BENEFITS["max_energy_bonus"] if is_vip(user) else 0)
-            upd["energy"] = min(user["energy"] + eff["energy"], max_e)
-        if eff.get("respec"):
-            inv = json.loads(user["inventory"]) if user["inventory"] else {}
-            inv["respec_token"] = inv.get("respec_token", 0) + 1
-            upd["inventory"] = json.dumps(inv)
-        if eff.get("max_energy_up"):
-            upd["max_energy"] = user["max_energy"] + eff["max_energy_up"]
-        await callback.answer(f"✅ {item['name']} использован!", show_alert=True)
-
-    await update_user(callback.from_user.id, **upd)
+    notice, alert, bought = None, False, False
+    async with user_action(callback.from_user.id) as user:
+        if user["gems"] < item["price_gems"]:
+            notice = "💎 Не хватает гемов!"
+        else:
+            bought = True
+            user["gems"] -= item["price_gems"]
+            if item["type"] == "equipment":
+                equipment = user["equipment"]
+                old = equipment.get(item["slot"])
+                if old:
+                    inventory = user["inventory"]
+                    inventory[old] = inventory.get(old, 0) + 1
+                equipment[item["slot"]] = key
+                notice, alert = f"🎽 {item['name']} экипировано!", True
+            elif item["type"] == "buff":
+                buffs = user["buffs"]
+                buffs.append(make_buff(key))
+                notice = f"📜 {item['name']} активирован!"
+            elif item["type"] == "consumable":
+                eff = item["effect"]
+                max_e = get_max_energy(user)
+                if eff.get("full_heal"):
+                    user["hp"] = user["max_hp"]
+                if eff.get("full_energy"):
+                    add_energy(user, max_e)
+                if eff.get("energy"):
+                    add_energy(user, eff["energy"])
+                if eff.get("respec"):
+                    inv = user["inventory"]
+                    inv["respec_token"] = inv.get("respec_token", 0) + 1
+                if eff.get("max_energy_up"):
+                    user["max_energy"] += eff["max_energy_up"]
+                notice, alert = f"✅ {item['name']} использован!", True
+    if not bought:
+        return await callback.answer(notice, show_alert=True)
+    await callback.answer(notice, show_alert=alert)
     await cb_gem_shop(callback)
 
 
@@ -1518,67 +4213,74 @@ async def cb_gem_buy(callback: CallbackQuery):
 async def cb_gem_exchange(callback: CallbackQuery):
     fire_hiviews_callback(callback)
     amount = int(callback.data.replace("gem_exchange_", ""))
-    user = await get_user(callback.from_user.id)
-    if user["gems"] < amount:
-        return await callback.answer(f"💎 Нужно {amount} гемов!", show_alert=True)
     gold = amount * 50
-    await update_user(callback.from_user.id, gems=user["gems"] - amount, gold=user["gold"] + gold)
+    async with user_action(callback.from_user.id) as user:
+        ok = user["gems"] >= amount
+        if ok:
+            user["gems"] -= amount
+            user["gold"] += gold
+    if not ok:
+        return await callback.answer(f"💎 Нужно {amount} гемов!", show_alert=True)
     await callback.answer(f"💱 {amount}💎 → {gold}💰", show_alert=True)
     await cb_gem_shop(callback)
 
 
-@router.callback_query(F.data.startswith("chest_"))
-async def cb_open_chest(callback: CallbackQuery):
-    fire_hiviews_callback(callback)
-    key = callback.data.replace("chest_", "")
-    if key not in GEM_CHESTS:
-        return await callback.answer("❌ Не найдено")
-    user = await get_user(callback.from_user.id)
-    chest = GEM_CHESTS[key]
-    if user["gems"] < chest["price_gems"]:
-        return await callback.answer(f"💎 Нужно {chest['price_gems']} гемов!", show_alert=True)
-    await update_user(callback.from_user.id, gems=user["gems"] - chest["price_gems"],
-                      chests_opened=user["chests_opened"] + 1)
-    user = await get_user(callback.from_user.id)
-    rewards = chest["rewards"]
-    weights = [r["weight"] for r in rewards]
-    reward = random.choices(rewards, weights=weights, k=1)[0]
-    text = f"🎁 <b>Открываем {chest['name']}...</b>\n\n"
+def apply_chest_reward(user: dict, reward: dict) -> str:
+    """Выдаёт награду сундука в словарь игрока и возвращает текст."""
     if reward["type"] == "gold":
         amount = random.randint(reward["min"], reward["max"])
-        await update_user(callback.from_user.id, gold=user["gold"] + amount,
-                          total_gold_earned=user["total_gold_earned"] + amount)
-        text += f"💰 <b>+{amount} золота!</b>"
-    elif reward["type"] == "xp":
+        user["gold"] += amount
+        user["total_gold_earned"] += amount
+        return f"💰 <b>+{amount} золота!</b>"
+    if reward["type"] == "xp":
         amount = random.randint(reward["min"], reward["max"])
-        lvl_msg = await add_xp(callback.from_user.id, amount)
-        text += f"✨ <b>+{amount} опыта!</b>{lvl_msg}"
-    elif reward["type"] == "gems":
+        lvl_msg = apply_xp(user, amount)
+        return f"✨ <b>+{amount} опыта!</b>{lvl_msg}"
+    if reward["type"] == "gems":
         amount = random.randint(reward["min"], reward["max"])
-        await update_user(callback.from_user.id, gems=user["gems"] + amount,
-                          total_gems_earned=user["total_gems_earned"] + amount)
-        text += f"💎 <b>+{amount} гемов!</b>"
-    elif reward["type"] == "item":
-        item_key2 = random.choice(reward["items"])
-        item = SHOP_ITEMS.get(item_key2)
+        user["gems"] += amount
+        user["total_gems_earned"] += amount
+        return f"💎 <b>+{amount} гемов!</b>"
+    if reward["type"] == "item":
+        item_key = random.choice(reward["items"])
+        item = SHOP_ITEMS.get(item_key)
         if item:
-            inv = json.loads(user["inventory"]) if user["inventory"] else {}
-            inv[item_key2] = inv.get(item_key2, 0) + 1
-            await update_user(callback.from_user.id, inventory=json.dumps(inv))
-            text += f"📦 <b>{item['name']}!</b>"
+            inv = user["inventory"]
+            inv[item_key] = inv.get(item_key, 0) + 1
+            return f"📦 <b>{item['name']}!</b>"
     elif reward["type"] == "gem_item":
-        item_key2 = random.choice(reward["items"])
-        item = GEM_SHOP_ITEMS.get(item_key2)
+        item_key = random.choice(reward["items"])
+        item = GEM_SHOP_ITEMS.get(item_key)
         if item:
-            equipment = json.loads(user["equipment"]) if user["equipment"] else {}
-            equipment[item["slot"]] = item_key2
-            await update_user(callback.from_user.id, equipment=json.dumps(equipment))
-            text += f"⚡ <b>{item['name']}!</b> 🔥 РЕДКИЙ ДРОП!"
+            equipment = user["equipment"]
+            equipment[item["slot"]] = item_key
+            return f"⚡ <b>{item['name']}!</b> 🔥 РЕДКИЙ ДРОП!"
     elif reward["type"] == "vip_days":
         days = random.randint(reward["min"], reward["max"])
-        vip_end = get_vip_end(user) + timedelta(days=days)
-        await update_user(callback.from_user.id, vip_until=vip_end.isoformat())
-        text += f"👑 <b>VIP на {days} дней!</b>"
+        user["vip_until"] = (get_vip_end(user) + timedelta(days=days)).isoformat()
+        return f"👑 <b>VIP на {days} дней!</b>"
+    return ""
+
+
+@router.callback_query(F.data.startswith("chest_"))
+async def cb_open_chest(callback: CallbackQuery):
+    fire_hiviews_callback(callback)
+    key = callback.data.replace("chest_", "")
+    if key not in GEM_CHESTS:
+        return await callback.answer("❌ Не найдено")
+    chest = GEM_CHESTS[key]
+    async with user_action(callback.from_user.id) as user:
+        ok = user["gems"] >= chest["price_gems"]
+        if ok:
+            user["gems"] -= chest["price_gems"]
+            user["chests_opened"] += 1
+            rewards = chest["rewards"]
+            weights = [r["weight"] for r in rewards]
+            reward = random.choices(rewards, weights=weights, k=1)[0]
+            text = f"🎁 <b>Открываем {chest['name']}...</b>\n\n"
+            text += apply_chest_reward(user, reward)
+    if not ok:
+        return await callback.answer(f"💎 Нужно {chest['price_gems']} гемов!", show_alert=True)
     kb = make_kb([[("🎁 Ещё сундук", f"chest_{key}")], [("🔙 Гем-магазин", "gem_shop")]])
     await callback.message.edit_text(text, reply_markup=kb)
     await callback.answer()
@@ -1589,8 +4291,8 @@ async def cb_open_chest(callback: CallbackQuery):
 async def cb_craft(callback: CallbackQuery):
     fire_hiviews_callback(callback)
     user = await get_user(callback.from_user.id)
-    inventory = json.loads(user["inventory"]) if user["inventory"] else {}
-    equipment = json.loads(user["equipment"]) if user["equipment"] else {}
+    inventory = user["inventory"]
+    equipment = user["equipment"]
     text = f"🔨 <b>Мастерская крафта</b>\n💰 {user['gold']} | 💎 {user['gems']}\n\n"
     buttons = []
     for key, recipe in CRAFT_RECIPES.items():
@@ -1598,14 +4300,13 @@ async def cb_craft(callback: CallbackQuery):
         parts = []
         can_craft = True
         for ing_key, count in recipe["ingredients"].items():
-            item = SHOP_ITEMS.get(ing_key) or GEM_SHOP_ITEMS.get(ing_key)
             have = inventory.get(ing_key, 0)
             for slot, eq_key in equipment.items():
                 if eq_key == ing_key:
                     have += 1
             if have < count:
                 can_craft = False
-            name = item["name"] if item else ing_key
+            name = item_name(ing_key)
             parts.append(f"{name} x{count}")
         if recipe["cost_gold"]:
             parts.append(f"{recipe['cost_gold']}💰")
@@ -1631,13 +4332,23 @@ async def cb_docraft(callback: CallbackQuery):
     key = callback.data.replace("docraft_", "")
     if key not in CRAFT_RECIPES:
         return await callback.answer("❌ Рецепт не найден")
-    user = await get_user(callback.from_user.id)
     recipe = CRAFT_RECIPES[key]
-    inventory = json.loads(user["inventory"]) if user["inventory"] else {}
-    equipment = json.loads(user["equipment"]) if user["equipment"] else {}
+    notice = None
+    async with user_action(callback.from_user.id) as user:
+        notice = craft_item(user, key, recipe)
+    if notice:
+        return await callback.answer(notice, show_alert=True)
+    await callback.answer(f"🔨 Скрафтил {recipe['name']}!", show_alert=True)
+    await cb_craft(callback)
+
+
+def craft_item(user: dict, key: str, recipe: dict) -> Optional[str]:
+    """Крафт в словаре игрока. Возвращает текст ошибки или None при успехе."""
+    inventory = user["inventory"]
+    equipment = user["equipment"]
 
     if user["gold"] < recipe["cost_gold"] or user["gems"] < recipe["cost_gems"]:
-        return await callback.answer("❌ Не хватает ресурсов!", show_alert=True)
+        return "❌ Не хватает ресурсов!"
 
     for ing_key, count in recipe["ingredients"].items():
         have = inventory.get(ing_key, 0)
@@ -1645,7 +4356,7 @@ async def cb_docraft(callback: CallbackQuery):
             if eq_key == ing_key:
                 have += 1
         if have < count:
-            return await callback.answer("❌ Не хватает ингредиентов!", show_alert=True)
+            return "❌ Не хватает ингредиентов!"
 
     for ing_key, count in recipe["ingredients"].items():
         remaining = count
@@ -1661,47 +4372,47 @@ async def cb_docraft(callback: CallbackQuery):
                     del equipment[slot]
                     remaining -= 1
 
-    upd = {"gold": user["gold"] - recipe["cost_gold"],
-           "gems": user["gems"] - recipe["cost_gems"],
-           "inventory": json.dumps(inventory),
-           "crafts_done": user["crafts_done"] + 1}
+    user["gold"] -= recipe["cost_gold"]
+    user["gems"] -= recipe["cost_gems"]
+    user["crafts_done"] += 1
 
     if recipe["result_type"] == "equipment":
         equipment[recipe["slot"]] = key
-        upd["equipment"] = json.dumps(equipment)
     elif recipe["result_type"] == "consumable":
         if "hp" in recipe["effect"]:
-            upd["hp"] = min(user["hp"] + recipe["effect"]["hp"], user["max_hp"])
-        upd["equipment"] = json.dumps(equipment)
-
-    await update_user(callback.from_user.id, **upd)
-    await callback.answer(f"🔨 Скрафтил {recipe['name']}!", show_alert=True)
-    await cb_craft(callback)
+            user["hp"] = min(user["hp"] + recipe["effect"]["hp"], user["max_hp"])
+    return None
 
 
 # ===================== ЭКСПЕДИЦИИ =====================
+def expedition_end(user: dict) -> Optional[datetime]:
+    exp = EXPEDITIONS.get(user.get("expedition") or "")
+    start = parse_ts(user.get("expedition_start") or "")
+    if not exp or start is None:
+        return None
+    duration = exp["duration_min"] * (VIP_BENEFITS["expedition_speed"] if is_vip(user) else 1)
+    return start + timedelta(minutes=duration)
+
+
 @router.callback_query(F.data == "expeditions")
 async def cb_expeditions(callback: CallbackQuery):
     fire_hiviews_callback(callback)
     user = await get_user(callback.from_user.id)
     text = "🎯 <b>Экспедиции</b>\n<i>Отправь героя на задание!</i>\n\n"
-    if user.get("expedition") and user.get("expedition_start"):
-        exp = EXPEDITIONS.get(user["expedition"])
-        if exp:
-            start = datetime.fromisoformat(user["expedition_start"])
-            duration = exp["duration_min"] * (VIP_BENEFITS["expedition_speed"] if is_vip(user) else 1)
-            end = start + timedelta(minutes=duration)
-            now = datetime.now()
-            if now >= end:
-                text += f"✅ <b>{exp['name']}</b> — ЗАВЕРШЕНА!\n"
-                kb = make_kb([[("🎁 Забрать награду!", "exp_collect")],
-                              [("🔙 Назад", "main_menu")]])
-            else:
-                mins = int((end - now).total_seconds() / 60)
-                text += f"⏳ <b>{exp['name']}</b> — в процессе\n⏰ Осталось: {mins} мин.\n"
-                kb = make_kb([[("🔙 Назад", "main_menu")]])
-            await callback.message.edit_text(text, reply_markup=kb)
-            return await callback.answer()
+    end = expedition_end(user)
+    if end:
+        exp = EXPEDITIONS[user["expedition"]]
+        now = datetime.now()
+        if now >= end:
+            text += f"✅ <b>{exp['name']}</b> — ЗАВЕРШЕНА!\n"
+            kb = make_kb([[("🎁 Забрать награду!", "exp_collect")],
+                          [("🔙 Назад", "main_menu")]])
+        else:
+            mins = int((end - now).total_seconds() / 60)
+            text += f"⏳ <b>{exp['name']}</b> — в процессе\n⏰ Осталось: {mins} мин.\n"
+            kb = make_kb([[("🔙 Назад", "main_menu")]])
+        await callback.message.edit_text(text, reply_markup=kb)
+        return await callback.answer()
     buttons = []
     for key, exp in EXPEDITIONS.items():
         min_lvl = exp.get("min_lvl", 1)
@@ -1723,11 +4434,13 @@ async def cb_exp_start(callback: CallbackQuery):
     key = callback.data.replace("exp_start_", "")
     if key not in EXPEDITIONS:
         return await callback.answer("❌ Не найдено")
-    user = await get_user(callback.from_user.id)
-    if user.get("expedition"):
+    async with user_action(callback.from_user.id) as user:
+        busy = bool(user.get("expedition"))
+        if not busy:
+            user["expedition"] = key
+            user["expedition_start"] = datetime.now().isoformat()
+    if busy:
         return await callback.answer("⏳ У тебя уже есть экспедиция!", show_alert=True)
-    await update_user(callback.from_user.id, expedition=key,
-                      expedition_start=datetime.now().isoformat())
     dur = int(EXPEDITIONS[key]["duration_min"] *
               (VIP_BENEFITS["expedition_speed"] if is_vip(user) else 1))
     await callback.answer(f"🎯 Начата! Жди {dur} мин.", show_alert=True)
@@ -1737,23 +4450,23 @@ async def cb_exp_start(callback: CallbackQuery):
 @router.callback_query(F.data == "exp_collect")
 async def cb_exp_collect(callback: CallbackQuery):
     fire_hiviews_callback(callback)
-    user = await get_user(callback.from_user.id)
-    exp = EXPEDITIONS.get(user.get("expedition", ""))
+    async with user_action(callback.from_user.id) as user:
+        exp = EXPEDITIONS.get(user.get("expedition", ""))
+        user["expedition"] = ""
+        user["expedition_start"] = ""
+        if exp:
+            mults = get_buff_multipliers(user)
+            gold = int(random.randint(*exp["gold"]) * mults["gold_mult"])
+            xp = int(random.randint(*exp["xp"]) * mults["xp_mult"])
+            gems = 1 if random.randint(1, 100) <= exp["gem_chance"] else 0
+            user["gold"] += gold
+            user["total_gold_earned"] += gold
+            if gems:
+                user["gems"] += gems
+                user["total_gems_earned"] += gems
+            lvl_msg = apply_xp(user, xp)
     if not exp:
-        await update_user(callback.from_user.id, expedition="", expedition_start="")
         return await callback.answer("❌ Нет экспедиции!")
-    mults = get_buff_multipliers(user)
-    gold = int(random.randint(*exp["gold"]) * mults["gold_mult"])
-    xp = int(random.randint(*exp["xp"]) * mults["xp_mult"])
-    gems = 1 if random.randint(1, 100) <= exp["gem_chance"] else 0
-    upd = {"expedition": "", "expedition_start": "",
-           "gold": user["gold"] + gold,
-           "total_gold_earned": user["total_gold_earned"] + gold}
-    if gems:
-        upd["gems"] = user["gems"] + gems
-        upd["total_gems_earned"] = user["total_gems_earned"] + gems
-    await update_user(callback.from_user.id, **upd)
-    lvl_msg = await add_xp(callback.from_user.id, xp)
     text = f"🎯 <b>{exp['name']} — завершена!</b>\n\n💰+{gold} ✨+{xp}"
     if gems:
         text += f" 💎+{gems}"
@@ -1783,75 +4496,85 @@ async def cb_wheel(callback: CallbackQuery):
     await callback.answer()
 
 
-async def do_spin(callback: CallbackQuery):
-    user = await get_user(callback.from_user.id)
+def apply_spin(user: dict) -> str:
+    """Крутит колесо и выдаёт приз в словарь игрока (внутри user_action)."""
     weights = [s["weight"] for s in WHEEL_SEGMENTS]
     seg = random.choices(WHEEL_SEGMENTS, weights=weights, k=1)[0]
     text = f"🎡 <b>Колесо крутится...</b>\n\n➡️ {seg['color']} <b>{seg['name']}</b>\n\n"
     if seg["type"] == "gold":
-        await update_user(callback.from_user.id, gold=user["gold"] + seg["amount"],
-                          total_gold_earned=user["total_gold_earned"] + seg["amount"])
+        user["gold"] += seg["amount"]
+        user["total_gold_earned"] += seg["amount"]
         text += f"💰 +{seg['amount']}!"
     elif seg["type"] == "gems":
-        await update_user(callback.from_user.id, gems=user["gems"] + seg["amount"],
-                          total_gems_earned=user["total_gems_earned"] + seg["amount"])
+        user["gems"] += seg["amount"]
+        user["total_gems_earned"] += seg["amount"]
         text += f"💎 +{seg['amount']}!"
     elif seg["type"] == "xp":
-        lvl_msg = await add_xp(callback.from_user.id, seg["amount"])
+        lvl_msg = apply_xp(user, seg["amount"])
         text += f"✨ +{seg['amount']}!{lvl_msg}"
     elif seg["type"] == "energy":
-        max_e = user["max_energy"] + (VIP_BENEFITS["max_energy_bonus"] if is_vip(user) else 0)
-        await update_user(callback.from_user.id,
-                          energy=min(user["energy"] + seg["amount"], max_e))
+        add_energy(user, seg["amount"])
         text += f"⚡ +{seg['amount']}!"
     elif seg["type"] == "heal":
-        await update_user(callback.from_user.id, hp=user["max_hp"])
+        user["hp"] = user["max_hp"]
         text += "❤️ Полное исцеление!"
     elif seg["type"] == "nothing":
         text += "💀 Не повезло..."
     elif seg["type"] == "double":
         bg = random.randint(100, 500)
         bge = random.randint(1, 5)
-        await update_user(callback.from_user.id, gold=user["gold"] + bg, gems=user["gems"] + bge,
-                          total_gold_earned=user["total_gold_earned"] + bg,
-                          total_gems_earned=user["total_gems_earned"] + bge)
+        user["gold"] += bg
+        user["gems"] += bge
+        user["total_gold_earned"] += bg
+        user["total_gems_earned"] += bge
         text += f"🌈 ДЖЕКПОТ! +{bg}💰 +{bge}💎!"
+    return text
+
+
+async def send_spin_result(callback: CallbackQuery, text: str):
     kb = make_kb([[("🎡 Ещё", "wheel")], [("🏠 Меню", "main_menu")]])
     await callback.message.edit_text(text, reply_markup=kb)
+    await callback.answer()
 
 
 @router.callback_query(F.data == "spin_free")
 async def cb_spin_free(callback: CallbackQuery):
     fire_hiviews_callback(callback)
-    user = await get_user(callback.from_user.id)
     today = datetime.now().strftime("%Y-%m-%d")
-    if user.get("last_wheel", "") == today:
+    async with user_action(callback.from_user.id) as user:
+        used = user.get("last_wheel", "") == today
+        if not used:
+            user["last_wheel"] = today
+            text = apply_spin(user)
+    if used:
         return await callback.answer("❌ Уже использовано!", show_alert=True)
-    await update_user(callback.from_user.id, last_wheel=today)
-    await do_spin(callback)
-    await callback.answer()
+    await send_spin_result(callback, text)
 
 
 @router.callback_query(F.data == "spin_token")
 async def cb_spin_token(callback: CallbackQuery):
     fire_hiviews_callback(callback)
-    user = await get_user(callback.from_user.id)
-    if user["wheel_spins"] <= 0:
+    async with user_action(callback.from_user.id) as user:
+        ok = user["wheel_spins"] > 0
+        if ok:
+            user["wheel_spins"] -= 1
+            text = apply_spin(user)
+    if not ok:
         return await callback.answer("🎟️ Нет вращений!", show_alert=True)
-    await update_user(callback.from_user.id, wheel_spins=user["wheel_spins"] - 1)
-    await do_spin(callback)
-    await callback.answer()
+    await send_spin_result(callback, text)
 
 
 @router.callback_query(F.data == "spin_gems")
 async def cb_spin_gems(callback: CallbackQuery):
     fire_hiviews_callback(callback)
-    user = await get_user(callback.from_user.id)
-    if user["gems"] < 5:
+    async with user_action(callback.from_user.id) as user:
+        ok = user["gems"] >= 5
+        if ok:
+            user["gems"] -= 5
+            text = apply_spin(user)
+    if not ok:
         return await callback.answer("💎 Нужно 5 гемов!", show_alert=True)
-    await update_user(callback.from_user.id, gems=user["gems"] - 5)
-    await do_spin(callback)
-    await callback.answer()
+    await send_spin_result(callback, text)
 
 
 # ===================== ДОСТИЖЕНИЯ =====================
@@ -1859,7 +4582,7 @@ async def cb_spin_gems(callback: CallbackQuery):
 async def cb_achievements(callback: CallbackQuery):
     fire_hiviews_callback(callback)
     user = await get_user(callback.from_user.id)
-    unlocked = json.loads(user["achievements"]) if user["achievements"] else []
+    unlocked = user["achievements"]
     text = f"🏆 <b>Достижения</b> ({len(unlocked)}/{len(ACHIEVEMENTS)})\n\n"
     for key, ach in ACHIEVEMENTS.items():
         done = key in unlocked
@@ -1878,15 +4601,13 @@ async def cb_achievements(callback: CallbackQuery):
 async def cb_inventory(callback: CallbackQuery):
     fire_hiviews_callback(callback)
     user = await get_user(callback.from_user.id)
-    inventory = json.loads(user["inventory"]) if user["inventory"] else {}
-    equipment = json.loads(user["equipment"]) if user["equipment"] else {}
-    buffs = json.loads(user["buffs"]) if user["buffs"] else []
+    inventory = user["inventory"]
+    equipment = user["equipment"]
+    buffs = user["buffs"]
     text = "📦 <b>Инвентарь</b>\n\n🎽 <b>Экипировка:</b>\n"
     if equipment:
         for slot, item_key in equipment.items():
-            item = (SHOP_ITEMS.get(item_key) or GEM_SHOP_ITEMS.get(item_key)
-                    or CRAFT_RECIPES.get(item_key))
-            text += f"  [{slot}] {item['name'] if item else item_key}\n"
+            text += f"  [{slot}] {item_name(item_key)}\n"
     else:
         text += "  Пусто\n"
     text += "\n🧪 <b>Предметы:</b>\n"
@@ -1910,16 +4631,18 @@ async def cb_inventory(callback: CallbackQuery):
 
 
 # ===================== РЕЙТИНГ =====================
+LEADERBOARD_KB = build_kb([
+    [("📊 По уровню", "top_level"), ("⚔️ По PvP", "top_pvp")],
+    [("💰 По золоту", "top_gold"), ("👑 По боссам", "top_bosses")],
+    [("💎 По гемам", "top_gems"), ("🌟 По элитам", "top_elites")],
+    [("🔙 Назад", "main_menu")],
+])
+
+
 @router.callback_query(F.data == "leaderboard")
 async def cb_leaderboard(callback: CallbackQuery):
     fire_hiviews_callback(callback)
-    kb = make_kb([
-        [("📊 По уровню", "top_level"), ("⚔️ По PvP", "top_pvp")],
-        [("💰 По золоту", "top_gold"), ("👑 По боссам", "top_bosses")],
-        [("💎 По гемам", "top_gems"), ("🌟 По элитам", "top_elites")],
-        [("🔙 Назад", "main_menu")],
-    ])
-    await callback.message.edit_text("🏆 <b>Рейтинг</b>\nВыбери категорию:", reply_markup=kb)
+    await callback.message.edit_text("🏆 <b>Рейтинг</b>\nВыбери категорию:", reply_markup=LEADERBOARD_KB)
     await callback.answer()
 
 
@@ -2044,13 +4767,8 @@ async def cb_donate_buy(callback: CallbackQuery):
             "❌ Ошибка создания счёта. Попробуй позже.\n\n"
             "<i>Убедитесь, что CRYPTO_PAY_TOKEN задан в .env</i>",
             reply_markup=make_kb([[("🔙 Назад", "donate_shop")]]))
-    async with aiosqlite.connect(DB_PATH) as db:
-        await db.execute(
-            "INSERT INTO payments (user_id, invoice_id, item_key, amount_usd, created_at) "
-            "VALUES (?,?,?,?,?)",
-            (user_id, invoice["invoice_id"], item_key, item["price_usd"],
-             datetime.now().isoformat()))
-        await db.commit()
+    await storage.add_payment(user_id, invoice["invoice_id"], item_key, item["price_usd"],
+                              datetime.now().isoformat())
     pay_url = invoice.get("pay_url") or invoice.get("mini_app_invoice_url", "")
     text = (f"💳 <b>Счёт создан!</b>\n\n"
             f"📦 {item['name']}\n💵 ${item['price_usd']}\n\n"
@@ -2068,14 +4786,9 @@ async def cb_check_payment(callback: CallbackQuery):
     fire_hiviews_callback(callback)
     invoice_id = callback.data.replace("check_payment_", "")
     user_id = callback.from_user.id
-    async with aiosqlite.connect(DB_PATH) as db:
-        db.row_factory = aiosqlite.Row
-        async with db.execute("SELECT * FROM payments WHERE invoice_id = ? AND user_id = ?",
-                              (int(invoice_id), user_id)) as cur:
-            payment = await cur.fetchone()
+    payment = await storage.get_payment(user_id, int(invoice_id))
     if not payment:
         return await callback.answer("❌ Не найден")
-    payment = dict(payment)
     if payment["status"] == "paid":
         return await callback.answer("✅ Уже обработан!", show_alert=True)
     invoices = await crypto_get_invoices(invoice_id)
@@ -2083,53 +4796,28 @@ async def cb_check_payment(callback: CallbackQuery):
         return await callback.answer("⏳ Попробуй позже.", show_alert=True)
     inv = invoices[0]
     if inv.get("status") == "paid":
-        item = DONATE_ITEMS.get(payment["item_key"])
-        if item:
-            user = await get_user(user_id)
-            upd = {
-                "gold": user["gold"] + item.get("gold", 0),
-                "gems": user["gems"] + item.get("gems", 0),
-                "total_spent_usd": user["total_spent_usd"] + item["price_usd"],
-            }
-            if item.get("gems"):
-                upd["total_gems_earned"] = user["total_gems_earned"] + item["gems"]
-            if item.get("vip_days"):
-                upd["vip_until"] = (get_vip_end(user) + timedelta(days=item["vip_days"])).isoformat()
-            await update_user(user_id, **upd)
-            async with aiosqlite.connect(DB_PATH) as db:
-                await db.execute("UPDATE payments SET status='paid', paid_at=? WHERE invoice_id=?",
-                                 (datetime.now().isoformat(), int(invoice_id)))
-                await db.commit()
-            rewards = []
-            if item.get("gold"):
-                rewards.append(f"+{item['gold']}💰")
-            if item.get("gems"):
-                rewards.append(f"+{item['gems']}💎")
-            if item.get("vip_days"):
-                rewards.append(f"👑VIP {item['vip_days']}д")
-            text = (f"✅ <b>Оплата получена!</b>\n\n"
-                    f"📦 {item['name']}\n{' '.join(rewards)}\n\nСпасибо! 🐉")
-            kb = make_kb([[("🔙 Меню", "main_menu")]])
-            await callback.message.edit_text(text, reply_markup=kb)
-            for admin_id in ADMIN_IDS:
-                try:
-                    await bot.send_message(
-                        admin_id,
-                        f"💰 <b>Платёж!</b>\n👤 {user['username']} (ID:{user_id})\n"
-                        f"📦 {item['name']} — ${item['price_usd']}")
-                except Exception:
-                    pass
+        item = await credit_payment(payment)
+        if not item:
+            return await callback.answer("✅ Уже обработан!", show_alert=True)
+        kb = make_kb([[("🔙 Меню", "main_menu")]])
+        await callback.message.edit_text(payment_success_text(item), reply_markup=kb)
+        await callback.answer()
+        await notify_admins_payment(user_id, item)
     elif inv.get("status") == "expired":
-        async with aiosqlite.connect(DB_PATH) as db:
-            await db.execute("UPDATE payments SET status='expired' WHERE invoice_id=?",
-                             (int(invoice_id),))
-            await db.commit()
+        await expire_payment(payment)
         await callback.answer("⏰ Истёк. Создай новый.", show_alert=True)
     else:
         await callback.answer("⏳ Ожидание оплаты...", show_alert=True)
 
 
 # ===================== ПРОМОКОДЫ =====================
+PROMO_ERRORS = {
+    "not_found": "❌ Не найден!",
+    "exhausted": "❌ Промокод исчерпан!",
+    "used": "❌ Уже использован!",
+}
+
+
 @router.message(Command("promo"))
 async def cmd_promo(message: Message):
     fire_hiviews_message(message)
@@ -2141,25 +4829,13 @@ async def cmd_promo(message: Message):
     user = await get_user(user_id)
     if not user:
         return await message.answer("Сначала /start")
-    async with aiosqlite.connect(DB_PATH) as db:
-        db.row_factory = aiosqlite.Row
-        async with db.execute("SELECT * FROM promo_codes WHERE code = ?", (code,)) as cur:
-            promo = await cur.fetchone()
-        if not promo:
-            return await message.answer("❌ Не найден!")
-        promo = dict(promo)
-        if promo["used_count"] >= promo["max_uses"]:
-            return await message.answer("❌ Промокод исчерпан!")
-        async with db.execute("SELECT * FROM promo_uses WHERE user_id=? AND code=?",
-                              (user_id, code)) as cur:
-            if await cur.fetchone():
-                return await message.answer("❌ Уже использован!")
-        await db.execute("INSERT INTO promo_uses VALUES (?,?)", (user_id, code))
-        await db.execute("UPDATE promo_codes SET used_count=used_count+1 WHERE code=?", (code,))
-        await db.commit()
-    await update_user(user_id, gold=user["gold"] + promo["gold"],
-                      gems=user["gems"] + promo["gems"],
-                      total_gems_earned=user["total_gems_earned"] + promo["gems"])
+    status, promo = await storage.redeem_promo(code, user_id)
+    if status != "ok":
+        return await message.answer(PROMO_ERRORS[status])
+    async with user_action(user_id, durable=True) as user:
+        user["gold"] += promo["gold"]
+        user["gems"] += promo["gems"]
+        user["total_gems_earned"] += promo["gems"]
     r = []
     if promo["gold"]:
         r.append(f"+{promo['gold']}💰")
@@ -2177,22 +4853,24 @@ async def cmd_admin(message: Message):
     await show_admin_panel(message)
 
 
+ADMIN_PANEL_KB = build_kb([
+    [("📊 Доход по дням", "adm_revenue"), ("👥 Топ донатеров", "adm_top_don")],
+    [("📈 Подробная стата", "adm_stats"), ("🏆 Топ игроков", "adm_top_players")],
+    [("🎫 Промокоды", "adm_promo"), ("📢 Рассылка", "adm_broadcast")],
+    [("💰 Выдать ресурсы", "adm_give"), ("🔨 Бан/Разбан", "adm_ban")],
+    [("🔍 Найти игрока", "adm_find"), ("⚙️ Система", "adm_system")],
+])
+
+
 async def show_admin_panel(target, edit=False):
     total_users = await get_all_users_count()
-    total_revenue = await get_total_revenue()
-    async with aiosqlite.connect(DB_PATH) as db:
-        async with db.execute("SELECT COUNT(*) FROM payments WHERE status='paid'") as c:
-            total_payments = (await c.fetchone())[0]
-        async with db.execute("SELECT COUNT(*) FROM users WHERE created_at >= ?",
-                              ((datetime.now() - timedelta(days=1)).isoformat(),)) as c:
-            new_today = (await c.fetchone())[0]
-        async with db.execute("SELECT COUNT(*) FROM users WHERE class != ''") as c:
-            active = (await c.fetchone())[0]
-        async with db.execute("SELECT COALESCE(AVG(level),0) FROM users WHERE class!=''") as c:
-            avg_lvl = round((await c.fetchone())[0], 1)
-        day_ago = (datetime.now() - timedelta(days=1)).isoformat()
-        async with db.execute("SELECT COUNT(*) FROM users WHERE last_energy >= ?", (day_ago,)) as c:
-            dau = (await c.fetchone())[0]
+    day_ago = (datetime.now() - timedelta(days=1)).isoformat()
+    totals = await storage.payment_totals()
+    total_revenue, total_payments = totals["revenue"], totals["payments"]
+    new_today = await storage.count_users(created_since=day_ago)
+    # Активные, средний уровень и DAU — из того же кэша, что и статистика мира
+    world = await get_global_stats()
+    active, dau, avg_lvl = world["total_players"], world["active_24h"], world["avg_level"]
     arpu = total_revenue / total_payments if total_payments else 0
     text = (
         f"👑 <b>АДМИН-ПАНЕЛЬ</b>\n{'━' * 28}\n\n"
@@ -2204,13 +4882,7 @@ async def show_admin_panel(target, edit=False):
         f"💳 Платежей: <b>{total_payments}</b>\n"
         f"📈 ARPU: <b>${arpu:.2f}</b>\n"
     )
-    kb = make_kb([
-        [("📊 Доход по дням", "adm_revenue"), ("👥 Топ донатеров", "adm_top_don")],
-        [("📈 Подробная стата", "adm_stats"), ("🏆 Топ игроков", "adm_top_players")],
-        [("🎫 Промокоды", "adm_promo"), ("📢 Рассылка", "adm_broadcast")],
-        [("💰 Выдать ресурсы", "adm_give"), ("🔨 Бан/Разбан", "adm_ban")],
-        [("🔍 Найти игрока", "adm_find"), ("⚙️ Система", "adm_system")],
-    ])
+    kb = ADMIN_PANEL_KB
     if edit and hasattr(target, 'edit_text'):
         await target.edit_text(text, reply_markup=kb)
     elif hasattr(target, 'answer'):
@@ -2229,15 +4901,7 @@ async def cb_adm_panel(callback: CallbackQuery):
 async def cb_adm_revenue(callback: CallbackQuery):
     if callback.from_user.id not in ADMIN_IDS:
         return
-    async with aiosqlite.connect(DB_PATH) as db:
-        db.row_factory = aiosqlite.Row
-        async with db.execute(
-            "SELECT date(paid_at) as day, SUM(amount_usd) as total, COUNT(*) as cnt "
-            "FROM payments WHERE status='paid' AND paid_at >= ? "
-            "GROUP BY day ORDER BY day",
-            ((datetime.now() - timedelta(days=7)).isoformat(),)
-        ) as cur:
-            rows = await cur.fetchall()
+    rows = await storage.revenue_by_day((datetime.now() - timedelta(days=7)).isoformat())
     text = "📊 <b>Доход за 7 дней:</b>\n\n"
     total = 0
     for r in rows:
@@ -2256,13 +4920,7 @@ async def cb_adm_revenue(callback: CallbackQuery):
 async def cb_adm_top_don(callback: CallbackQuery):
     if callback.from_user.id not in ADMIN_IDS:
         return
-    async with aiosqlite.connect(DB_PATH) as db:
-        db.row_factory = aiosqlite.Row
-        async with db.execute(
-            "SELECT username, user_id, total_spent_usd FROM users "
-            "WHERE total_spent_usd > 0 ORDER BY total_spent_usd DESC LIMIT 10"
-        ) as cur:
-            top = await cur.fetchall()
+    top = await storage.top_donors(10)
     text = "👥 <b>Топ донатеров:</b>\n\n"
     for i, r in enumerate(top, 1):
         text += f"{i}. {r['username']} (ID:{r['user_id']}) — <b>${r['total_spent_usd']:.2f}</b>\n"
@@ -2278,14 +4936,8 @@ async def cb_adm_stats(callback: CallbackQuery):
     if callback.from_user.id not in ADMIN_IDS:
         return
     stats = await get_global_stats()
-    async with aiosqlite.connect(DB_PATH) as db:
-        async with db.execute("SELECT COALESCE(SUM(total_spent_usd),0) FROM users") as c:
-            revenue = (await c.fetchone())[0]
-        async with db.execute("SELECT COUNT(*) FROM users WHERE total_spent_usd > 0") as c:
-            paying = (await c.fetchone())[0]
-        async with db.execute("SELECT COUNT(*) FROM users WHERE vip_until > ?",
-                              (datetime.now().isoformat(),)) as c:
-            vip_count = (await c.fetchone())[0]
+    donors = await storage.donor_stats(datetime.now().isoformat())
+    revenue, paying, vip_count = donors["revenue"], donors["paying"], donors["vip"]
     arpu = revenue / paying if paying else 0
     text = (
         f"📈 <b>Подробная статистика</b>\n{'━' * 28}\n\n"
@@ -2316,7 +4968,47 @@ async def cb_adm_top_players(callback: CallbackQuery):
     await callback.answer()
 
 
-@router.callback_query(F.data.in_({"adm_promo", "adm_broadcast", "adm_give", "adm_ban", "adm_find"}))
+async def show_broadcasts(message: Message):
+    text = "📢 <b>Рассылка</b>\n\n<code>/broadcast Текст</code>\n"
+    buttons = []
+    jobs = await broadcasts.recent()
+    if jobs:
+        text += "\n<b>Последние:</b>\n"
+    icons = {"running": "⏳", "done": "✅", "cancelled": "⛔"}
+    for job in jobs:
+        status = job["status"] if broadcasts.is_running(job["id"]) or job["status"] != "running" else "paused"
+        done = job["sent"] + job["failed"] + job["blocked"]
+        pct = round(done / job["total"] * 100) if job["total"] else 100
+        text += (f"{icons.get(status, '⏸')} #{job['id']} {min(pct, 100)}% — "
+                 f"✅{job['sent']} ❌{job['failed']} 🚫{job['blocked']} из {job['total']}\n")
+        if status == "running":
+            buttons.append([(f"⛔ Остановить #{job['id']}", f"adm_bc_cancel_{job['id']}")])
+    buttons.append([("🔄 Обновить", "adm_broadcast"), ("🔙 Панель", "adm_panel")])
+    try:
+        await message.edit_text(text, reply_markup=make_kb(buttons))
+    except TelegramBadRequest:
+        pass  # прогресс не изменился с прошлого обновления
+
+
+@router.callback_query(F.data == "adm_broadcast")
+async def cb_adm_broadcast(callback: CallbackQuery):
+    if callback.from_user.id not in ADMIN_IDS:
+        return
+    await show_broadcasts(callback.message)
+    await callback.answer()
+
+
+@router.callback_query(F.data.startswith("adm_bc_cancel_"))
+async def cb_adm_bc_cancel(callback: CallbackQuery):
+    if callback.from_user.id not in ADMIN_IDS:
+        return
+    job_id = int(callback.data.replace("adm_bc_cancel_", ""))
+    stopped = await broadcasts.cancel(job_id)
+    await show_broadcasts(callback.message)
+    await callback.answer(f"⛔ Рассылка #{job_id} остановлена" if stopped else "Уже не идёт")
+
+
+@router.callback_query(F.data.in_({"adm_promo", "adm_give", "adm_ban", "adm_find"}))
 async def cb_adm_text_cmds(callback: CallbackQuery):
     if callback.from_user.id not in ADMIN_IDS:
         return
@@ -2324,24 +5016,20 @@ async def cb_adm_text_cmds(callback: CallbackQuery):
         "adm_promo": ("🎫 <b>Промокоды</b>\n\n"
                       "<code>/addpromo КОД ЗОЛОТО ГЕМЫ МАКС</code>\n"
                       "Пример: <code>/addpromo NEWYEAR 100 10 50</code>"),
-        "adm_broadcast": "📢 <b>Рассылка</b>\n\n<code>/broadcast Текст</code>",
         "adm_give": ("💰 <b>Ресурсы</b>\n\n"
                      "<code>/give USER_ID gold/gems КОЛ-ВО</code>\n"
                      "<code>/givevip USER_ID ДНЕЙ</code>"),
         "adm_ban": "🔨 <b>Бан</b>\n\n<code>/ban USER_ID</code>\n<code>/unban USER_ID</code>",
-        "adm_find": "🔍 <b>Поиск</b>\n\n<code>/find USER_ID</code>",
+        "adm_find": "🔍 <b>Поиск</b>\n\n<code>/find USER_ID</code>\n<code>/itemstats ПРЕДМЕТ</code>",
     }
     text = info[callback.data]
     if callback.data == "adm_promo":
-        async with aiosqlite.connect(DB_PATH) as db:
-            db.row_factory = aiosqlite.Row
-            async with db.execute("SELECT * FROM promo_codes ORDER BY created_at DESC LIMIT 10") as cur:
-                promos = await cur.fetchall()
-            if promos:
-                text += "\n\n<b>Последние:</b>\n"
-                for p in promos:
-                    text += (f"  <code>{p['code']}</code> — {p['gold']}💰 {p['gems']}💎 "
-                             f"({p['used_count']}/{p['max_uses']})\n")
+        promos = await storage.recent_promos(10)
+        if promos:
+            text += "\n\n<b>Последние:</b>\n"
+            for p in promos:
+                text += (f"  <code>{p['code']}</code> — {p['gold']}💰 {p['gems']}💎 "
+                         f"({p['used_count']}/{p['max_uses']})\n")
     kb = make_kb([[("🔙 Панель", "adm_panel")]])
     await callback.message.edit_text(text, reply_markup=kb)
     await callback.answer()
@@ -2351,22 +5039,51 @@ async def cb_adm_text_cmds(callback: CallbackQuery):
 async def cb_adm_system(callback: CallbackQuery):
     if callback.from_user.id not in ADMIN_IDS:
         return
-    db_size = os.path.getsize(DB_PATH) if os.path.exists(DB_PATH) else 0
     hiviews_status = "✅ Ключ задан" if HIVIEWS_API_KEY else "❌ Не настроен"
+    hv = hiviews.stats()
     crypto_status = "✅" if CRYPTO_PAY_TOKEN else "❌"
     text = (
         f"⚙️ <b>Система</b>\n\n"
         f"🐍 Python: {sys.version.split()[0]}\n"
-        f"🗄️ БД: {db_size / 1024:.1f} KB\n"
+        f"🗄️ БД: {storage.describe()}\n"
         f"📅 {datetime.now().strftime('%Y-%m-%d %H:%M:%S')}\n"
         f"📢 HiViews: {hiviews_status}\n"
-        f"🔑 Crypto Pay: {crypto_status}\n"
+        f"   ✉️ {hv['sent']} | 🔗 {hv['coalesced']} | 🗑 {hv['dropped']} | ❌ {hv['failed']} "
+        f"| в очереди {hv['queued']}\n"
+        f"🔑 Crypto Pay: {crypto_status} (сверка: запросов {payment_reconciler.api_calls}, "
+        f"зачислено {payment_reconciler.credited}, истекло {payment_reconciler.expired})\n"
+        f"⏰ Таймеры: {timers.pending} | сработало {timers.fired} | ✉️ {timers.sent} "
+        f"| 🗑 {timers.dropped} | в очереди {timers.queue_size}\n"
+        f"🚦 Антифлуд: отклонено нажатий {throttle.throttled}\n"
+        f"🐢 Медленных апдейтов: {update_profile.slow}\n"
     )
-    kb = make_kb([[("🔙 Панель", "adm_panel")]])
+    kb = make_kb([[("🐢 Тяжёлые хендлеры", "adm_profile")], [("🔙 Панель", "adm_panel")]])
     await callback.message.edit_text(text, reply_markup=kb)
     await callback.answer()
 
 
+@router.callback_query(F.data == "adm_profile")
+async def cb_adm_profile(callback: CallbackQuery):
+    if callback.from_user.id not in ADMIN_IDS:
+        return
+    text = f"🐢 <b>Тяжёлые хендлеры за час</b> (топ-{PROFILE_TOP_N} по времени)\n\n"
+    rows = update_profile.top()
+    if not rows:
+        text += "Пока нет данных."
+    for name, count, seconds, statements, rows_read, commits, worst in rows:
+        text += (f"<code>{name}</code> ×{count}\n"
+                 f"   ⏱ {seconds:.2f}с (ср. {seconds / count * 1000:.0f}мс, макс {worst * 1000:.0f}мс)\n"
+                 f"   🗄 SQL {statements / count:.1f}/апдейт | строк {rows_read / count:.1f} "
+                 f"| коммитов {commits / count:.1f}\n")
+    text += f"\nПороги лога: {SLOW_UPDATE_MS:.0f}мс или {SLOW_UPDATE_STATEMENTS} SQL"
+    kb = make_kb([[("🔄 Обновить", "adm_profile")], [("🔙 Система", "adm_system")]])
+    try:
+        await callback.message.edit_text(text, reply_markup=kb)
+    except TelegramBadRequest:
+        pass  # статистика не изменилась с прошлого обновления
+    await callback.answer()
+
+
 # Текстовые админ-команды
 @router.message(Command("addpromo"))
 async def cmd_addpromo(message: Message):
@@ -2380,10 +5097,7 @@ async def cmd_addpromo(message: Message):
         code, gold, gems, mx = args[1].upper(), int(args[2]), int(args[3]), int(args[4])
     except ValueError:
         return await message.answer("❌ Неверные параметры. Используй числа.")
-    async with aiosqlite.connect(DB_PATH) as db:
-        await db.execute("INSERT OR REPLACE INTO promo_codes VALUES (?,?,?,?,0,?)",
-                         (code, gold, gems, mx, datetime.now().isoformat()))
-        await db.commit()
+    await storage.add_promo(code, gold, gems, mx, datetime.now().isoformat())
     await message.answer(f"✅ <b>{code}</b>: {gold}💰 {gems}💎 (макс:{mx})")
 
 
@@ -2399,16 +5113,15 @@ async def cmd_give(message: Message):
         tid, cur_type, amt = int(args[1]), args[2], int(args[3])
     except ValueError:
         return await message.answer("❌ Неверные параметры.")
-    user = await get_user(tid)
+    if cur_type not in ("gold", "gems"):
+        return await message.answer("gold или gems")
+    async with user_action(tid) as user:
+        if user:
+            user[cur_type] += amt
+            if cur_type == "gems":
+                user["total_gems_earned"] += amt
     if not user:
         return await message.answer("❌ Не найден")
-    if cur_type == "gold":
-        await update_user(tid, gold=user["gold"] + amt)
-    elif cur_type == "gems":
-        await update_user(tid, gems=user["gems"] + amt,
-                          total_gems_earned=user["total_gems_earned"] + amt)
-    else:
-        return await message.answer("gold или gems")
     await message.answer(f"✅ +{amt} {cur_type} → {user['username']}")
     try:
         await bot.send_message(tid, f"🎁 +{amt} {'💰' if cur_type == 'gold' else '💎'}!")
@@ -2428,11 +5141,11 @@ async def cmd_givevip(message: Message):
         tid, days = int(args[1]), int(args[2])
     except ValueError:
         return await message.answer("❌ Неверные параметры.")
-    user = await get_user(tid)
+    async with user_action(tid) as user:
+        if user:
+            user["vip_until"] = (get_vip_end(user) + timedelta(days=days)).isoformat()
     if not user:
         return await message.answer("❌ Не найден")
-    vip_end = get_vip_end(user) + timedelta(days=days)
-    await update_user(tid, vip_until=vip_end.isoformat())
     await message.answer(f"✅ VIP {days}д → {user['username']}")
     try:
         await bot.send_message(tid, f"👑 VIP на {days} дней!")
@@ -2449,10 +5162,15 @@ async def cmd_ban(message: Message):
     if len(args) < 2:
         return await message.answer("/ban USER_ID")
     try:
-        await update_user(int(args[1]), is_banned=1)
-        await message.answer(f"🔨 Забанен: {args[1]}")
+        tid = int(args[1])
     except ValueError:
-        await message.answer("❌ Неверный ID")
+        return await message.answer("❌ Неверный ID")
+    async with user_action(tid) as user:
+        if user:
+            user["is_banned"] = 1
+    if not user:
+        return await message.answer("❌ Не найден")
+    await message.answer(f"🔨 Забанен: {tid}")
 
 
 @router.message(Command("unban"))
@@ -2464,10 +5182,15 @@ async def cmd_unban(message: Message):
     if len(args) < 2:
         return await message.answer("/unban USER_ID")
     try:
-        await update_user(int(args[1]), is_banned=0)
-        await message.answer(f"✅ Разбанен: {args[1]}")
+        tid = int(args[1])
     except ValueError:
-        await message.answer("❌ Неверный ID")
+        return await message.answer("❌ Неверный ID")
+    async with user_action(tid) as user:
+        if user:
+            user["is_banned"] = 0
+    if not user:
+        return await message.answer("❌ Не найден")
+    await message.answer(f"✅ Разбанен: {tid}")
 
 
 @router.message(Command("find"))
@@ -2492,7 +5215,7 @@ async def cmd_find(message: Message):
         f"ID: <code>{user['user_id']}</code>\n"
         f"Ур.{user['level']} XP:{user['xp']}/{user['xp_needed']}\n"
         f"HP:{user['hp']}/{user['max_hp']} ⚔️{user['atk']} 🛡️{user['def']} 🎯{user['crit']}%\n"
-        f"💰{user['gold']} 💎{user['gems']} ⚡{user['energy']}/{user['max_energy']}\n"
+        f"💰{user['gold']} 💎{user['gems']} ⚡{current_energy(user)}/{get_max_energy(user)}\n"
         f"PvP:{user['wins']}W/{user['losses']}L "
         f"Данжи:{user['dungeon_wins']} Боссы:{user['boss_kills']}\n"
         f"Заработано: {user['total_gold_earned']}💰 {user['total_gems_earned']}💎\n"
@@ -2502,6 +5225,148 @@ async def cmd_find(message: Message):
     await message.answer(text)
 
 
+@router.message(Command("itemstats"))
+async def cmd_itemstats(message: Message):
+    if message.from_user.id not in ADMIN_IDS:
+        return
+    fire_hiviews_message(message)
+    args = message.text.split()
+    if len(args) < 2:
+        return await message.answer("/itemstats ПРЕДМЕТ")
+    key = args[1]
+    item = ITEM_CATALOG.get(key)
+    if not item:
+        return await message.answer("❌ Нет такого предмета")
+    stats = await get_item_stats(key)
+    await message.answer(
+        f"📦 <b>{item.name}</b> (<code>{key}</code>)\n"
+        f"Владельцев: {stats['owners']}\n"
+        f"В инвентарях: {stats['in_inventory']}\n"
+        f"Экипировано: {stats['equipped']}")
+
+
+class BroadcastManager:
+    """
+    Рассылки как фоновые задачи. Получатели читаются пачками по user_id
+    (keyset: user_id > cursor), отправка идёт параллельно под общим
+    TokenBucket на BROADCAST_RATE сообщений/с, TelegramRetryAfter
+    приостанавливает весь поток. После каждой пачки курсор и счётчики
+    пишутся в broadcasts — после перезапуска рассылка продолжается с места
+    остановки (последняя пачка может уйти повторно). Заблокировавшие бота
+    помечаются bot_blocked и следующими рассылками пропускаются.
+    """
+
+    def __init__(self, rate: float = BROADCAST_RATE, chunk: int = BROADCAST_CHUNK,
+                 concurrency: int = BROADCAST_CONCURRENCY):
+        self.bucket = TokenBucket(rate)
+        self.chunk = max(1, chunk)
+        self.concurrency = max(1, concurrency)
+        self._tasks: dict = {}
+        self._jobs: dict = {}
+
+    async def create(self, text: str, admin_id: int) -> dict:
+        total = await storage.count_recipients()
+        job = await storage.create_broadcast(text, total, admin_id, datetime.now().isoformat())
+        self._start(job)
+        return job
+
+    def _start(self, job: dict):
+        self._jobs[job["id"]] = job
+        self._tasks[job["id"]] = asyncio.create_task(self._run(job))
+
+    async def resume(self):
+        """Продолжает рассылки, прерванные остановкой или падением бота."""
+        for job in await storage.running_broadcasts():
+            if job["id"] not in self._tasks:
+                logger.info(f"[Broadcast] Продолжаю рассылку #{job['id']} с user_id > {job['cursor']}")
+                self._start(job)
+
+    async def _send(self, job: dict, uid: int) -> str:
+        for _ in range(5):
+            await self.bucket.acquire()
+            try:
+                await bot.send_message(uid, f"📢 <b>Объявление</b>\n\n{job['text']}")
+                return "sent"
+            except TelegramRetryAfter as e:
+                self.bucket.pause(e.retry_after)
+            except TelegramForbiddenError:
+                return "blocked"
+            except Exception as e:
+                logger.debug(f"[Broadcast] #{job['id']} user={uid}: {e}")
+                return "failed"
+        return "failed"
+
+    async def _run(self, job: dict):
+        sem = asyncio.Semaphore(self.concurrency)
+
+        async def send(uid: int) -> str:
+            async with sem:
+                result = await self._send(job, uid)
+            job[result] += 1  # живой прогресс для админки
+            return result
+
+        try:
+            while True:
+                ids = await storage.broadcast_recipients(job["cursor"], self.chunk)
+                if not ids:
+                    break
+                results = await asyncio.gather(*(send(uid) for uid in ids))
+                blocked = [uid for uid, res in zip(ids, results) if res == "blocked"]
+                job["cursor"] = ids[-1]
+                # Отметки bot_blocked — через кэш, чтобы узнали таймеры и матчмейкинг;
+                # они идемпотентны, поэтому сбрасываем их в БД до курсора
+                for uid in blocked:
+                    await mark_bot_blocked(uid)
+                if blocked:
+                    await user_cache.flush(blocked)
+                await storage.save_broadcast(job)
+            await self._finish(job, "done")
+            try:
+                await bot.send_message(
+                    job["created_by"],
+                    f"📢 Рассылка #{job['id']} завершена: ✅{job['sent']} ❌{job['failed']} 🚫{job['blocked']}")
+            except Exception:
+                pass
+        except asyncio.CancelledError:
+            raise
+        except Exception as e:
+            logger.error(f"[Broadcast] Рассылка #{job['id']} прервана: {e}")
+        finally:
+            self._tasks.pop(job["id"], None)
+
+    async def _finish(self, job: dict, status: str):
+        job["status"] = status
+        await storage.finish_broadcast(job["id"], status, datetime.now().isoformat())
+
+    async def cancel(self, job_id: int) -> bool:
+        task = self._tasks.pop(job_id, None)
+        if task is None:
+            return False
+        task.cancel()
+        await asyncio.gather(task, return_exceptions=True)
+        await self._finish(self._jobs[job_id], "cancelled")
+        return True
+
+    async def recent(self, limit: int = 5) -> list:
+        """Последние рассылки; у идущих — живые счётчики из памяти."""
+        rows = await storage.recent_broadcasts(limit)
+        return [self._jobs[r["id"]] if r["id"] in self._tasks else r for r in rows]
+
+    def is_running(self, job_id: int) -> bool:
+        return job_id in self._tasks
+
+    async def stop(self):
+        """Останавливает задачи; статус остаётся running, курсор — в БД."""
+        tasks = list(self._tasks.values())
+        for task in tasks:
+            task.cancel()
+        await asyncio.gather(*tasks, return_exceptions=True)
+        self._tasks.clear()
+
+
+broadcasts = BroadcastManager()
+
+
 @router.message(Command("broadcast"))
 async def cmd_broadcast(message: Message):
     if message.from_user.id not in ADMIN_IDS:
@@ -2510,18 +5375,184 @@ async def cmd_broadcast(message: Message):
     text = message.text.replace("/broadcast ", "", 1)
     if not text or text == "/broadcast":
         return await message.answer("/broadcast ТЕКСТ")
-    async with aiosqlite.connect(DB_PATH) as db:
-        async with db.execute("SELECT user_id FROM users WHERE is_banned = 0") as cur:
-            users = await cur.fetchall()
-    sent, failed = 0, 0
-    for (uid,) in users:
-        try:
-            await bot.send_message(uid, f"📢 <b>Объявление</b>\n\n{text}")
-            sent += 1
-            await asyncio.sleep(0.05)
-        except Exception:
-            failed += 1
-    await message.answer(f"📢 ✅{sent} ❌{failed}")
+    job = await broadcasts.create(text, message.from_user.id)
+    kb = make_kb([[("📢 Прогресс", "adm_broadcast")]])
+    await message.answer(f"📢 Рассылка #{job['id']} запущена: {job['total']} получателей.",
+                         reply_markup=kb)
+
+
+# ===================== ТАЙМЕРЫ СОБЫТИЙ =====================
+class TimerScheduler:
+    """
+    Таймеры событий игроков в одной куче (heapq): конец экспедиции, полная
+    энергия, окончание VIP. Вставка — O(log n); перенос таймера кладёт в кучу
+    новую запись, а старая считается устаревшей (не совпадает с _due) и
+    отбрасывается при извлечении. Куча строится одним запросом к БД при
+    старте и дальше обновляется подпиской на UserCache — периодических
+    сканов таблицы нет. Перед уведомлением состояние игрока перепроверяется,
+    отправка идёт отдельной задачей под TokenBucket на NOTIFY_RATE.
+    Баффы тратятся боями, а не временем — их окончание видно в самом бою.
+    """
+
+    KINDS = ("expedition", "energy", "vip")
+    WATCHED = frozenset(("class", "expedition", "expedition_start", "energy", "last_energy",
+                         "max_energy", "vip_until", "is_banned", "bot_blocked"))
+
+    def __init__(self, rate: float = NOTIFY_RATE, queue_size: int = NOTIFY_QUEUE_SIZE):
+        self.bucket = TokenBucket(rate)
+        self._heap: list = []     # (timestamp, user_id, kind)
+        self._due: dict = {}      # (user_id, kind) -> актуальный timestamp
+        self._wakeup = asyncio.Event()
+        self._queue: asyncio.Queue = asyncio.Queue(maxsize=max(1, queue_size))
+        self._tasks: list = []
+        self.fired = 0
+        self.sent = 0
+        self.dropped = 0
+
+    @staticmethod
+    def timers_for(user: dict) -> dict:
+        if not user.get("class") or user.get("is_banned") or user.get("bot_blocked"):
+            return {}
+        timers = {"expedition": expedition_end(user), "energy": energy_full_at(user)}
+        if is_vip(user):
+            timers["vip"] = parse_ts(user["vip_until"])
+        return timers
+
+    def _set(self, uid: int, kind: str, when: Optional[datetime]) -> bool:
+        key = (uid, kind)
+        if when is None:
+            self._due.pop(key, None)
+            return False
+        ts = when.timestamp()
+        if self._due.get(key) == ts:
+            return False
+        self._due[key] = ts
+        heapq.heappush(self._heap, (ts, uid, kind))
+        return True
+
+    def refresh(self, user: dict):
+        timers = self.timers_for(user)
+        earliest = self._heap[0][0] if self._heap else None
+        for kind in self.KINDS:
+            self._set(user["user_id"], kind, timers.get(kind))
+        if self._heap and (earliest is None or self._heap[0][0] < earliest):
+            self._wakeup.set()
+        # Устаревших записей стало заметно больше живых — пересобираем кучу
+        if len(self._heap) > 2 * len(self._due) + 1000:
+            self._heap = [(ts, uid, kind) for (uid, kind), ts in self._due.items()]
+            heapq.heapify(self._heap)
+
+    def observe(self, user: dict, fields):
+        if not self.WATCHED.isdisjoint(fields):
+            self.refresh(user)
+
+    async def seed(self, storage: Storage):
+        rows = await storage.timer_candidates(datetime.now().isoformat())
+        self._heap.clear()
+        self._due.clear()
+        for row in rows:
+            for kind, when in self.timers_for(row).items():
+                if when is not None:
+                    self._due[(row["user_id"], kind)] = when.timestamp()
+        self._heap = [(ts, uid, kind) for (uid, kind), ts in self._due.items()]
+        heapq.heapify(self._heap)
+        logger.info(f"⏰ Таймеров событий: {len(self._heap)}")
+
+    @property
+    def pending(self) -> int:
+        return len(self._due)
+
+    @property
+    def queue_size(self) -> int:
+        return self._queue.qsize()
+
+    def start(self):
+        if not self._tasks:
+            self._tasks = [asyncio.create_task(self._run()), asyncio.create_task(self._notifier())]
+
+    async def stop(self):
+        for task in self._tasks:
+            task.cancel()
+        await asyncio.gather(*self._tasks, return_exceptions=True)
+        self._tasks = []
+
+    async def _run(self):
+        while True:
+            now = time.time()
+            while self._heap and self._heap[0][0] <= now:
+                ts, uid, kind = heapq.heappop(self._heap)
+                if self._due.get((uid, kind)) != ts:
+                    continue
+                del self._due[(uid, kind)]
+                self.fired += 1
+                try:
+                    self._queue.put_nowait((uid, kind))
+                except asyncio.QueueFull:
+                    self.dropped += 1
+            self._wakeup.clear()
+            timeout = self._heap[0][0] - now if self._heap else None
+            try:
+                await asyncio.wait_for(self._wakeup.wait(), timeout)
+            except asyncio.TimeoutError:
+                pass
+
+    async def _notifier(self):
+        while True:
+            uid, kind = await self._queue.get()
+            try:
+                await self._handle(uid, kind)
+            except Exception as e:
+                logger.error(f"[Timers] {kind} user={uid}: {e}")
+
+    async def _handle(self, uid: int, kind: str):
+        user = await get_user(uid)
+        if not user or not user["class"] or user["is_banned"] or user.get("bot_blocked"):
+            return
+        # Игрок мог успеть всё изменить — сверяемся с текущим состоянием
+        when = self.timers_for(user).get(kind)
+        if when is not None and when > datetime.now():
+            self.refresh(user)
+            return
+        if kind == "expedition":
+            if when is None:
+                return
+            exp = EXPEDITIONS[user["expedition"]]
+            text = f"🎯 Экспедиция <b>{exp['name']}</b> завершена!"
+            kb = make_kb([[("🎁 Забрать награду!", "exp_collect")]])
+        elif kind == "energy":
+            if current_energy(user) < get_max_energy(user):
+                return
+            text = "⚡ Энергия полностью восстановлена — подземелья ждут!"
+            kb = make_kb([[("🗺️ Подземелья", "dungeons")]])
+        else:
+            if is_vip(user) or not user.get("vip_until"):
+                return
+            # Без VIP энергия копится медленнее — переносим её таймер
+            self.refresh(user)
+            text = "👑 VIP-статус закончился. Продлить можно в донат-магазине."
+            kb = make_kb([[("💳 Донат-магазин", "donate_shop")]])
+        if kind in NOTIFY_EVENTS:
+            await self._send(uid, text, kb)
+
+    async def _send(self, uid: int, text: str, kb: InlineKeyboardMarkup):
+        for _ in range(3):
+            await self.bucket.acquire()
+            try:
+                await bot.send_message(uid, text, reply_markup=kb)
+                self.sent += 1
+                return
+            except TelegramRetryAfter as e:
+                self.bucket.pause(e.retry_after)
+            except TelegramForbiddenError:
+                await mark_bot_blocked(uid)
+                return
+            except Exception as e:
+                logger.debug(f"[Timers] Уведомление user={uid}: {e}")
+                return
+
+
+timers = TimerScheduler()
+user_cache.add_listener(timers.observe)
 
 
 # Обработка неизвестных сообщений
@@ -2536,18 +5567,101 @@ async def fallback_handler(message: Message):
 
 
 # ======================== ЗАПУСК ========================
+async def start_services():
+    """Открывает соединения с БД и запускает фоновые службы бота."""
+    await metrics_server.start()
+    await storage.start()
+    await load_item_ids()
+    await leaderboards.seed()
+    await matchmaking.seed(storage)
+    await timers.seed(storage)
+    user_cache.start()
+    hiviews.start()
+    payment_reconciler.start()
+    timers.start()
+    await broadcasts.resume()
+
+
+async def stop_services():
+    """Останавливает фоновые службы и закрывает соединения с БД."""
+    await broadcasts.stop()
+    await timers.stop()
+    await payment_reconciler.stop()
+    await hiviews.stop()
+    await close_http_session()
+    await user_cache.stop()
+    await storage.close()
+    await metrics_server.stop()
+
+
+# ===================== WEBHOOK =====================
+_webhook_tasks: set = set()
+_webhook_rejected = 0
+
+
+async def handle_webhook(request: web.Request) -> web.Response:
+    """
+    Проверяет секрет, ставит апдейт в обработку и сразу отвечает Telegram.
+    В обработке не больше WEBHOOK_MAX_UPDATES апдейтов: лишние получают 503,
+    и Telegram доставит их повторно, когда бот разгребёт очередь.
+    """
+    global _webhook_rejected
+    token = request.headers.get("X-Telegram-Bot-Api-Secret-Token", "")
+    if not hmac.compare_digest(token, WEBHOOK_SECRET):
+        return web.Response(status=401)
+    if len(_webhook_tasks) >= WEBHOOK_MAX_UPDATES:
+        _webhook_rejected += 1
+        return web.Response(status=503)
+    try:
+        update = Update.model_validate(await request.json(), context={"bot": bot})
+    except Exception as e:
+        logger.warning(f"[Webhook] Некорректный апдейт: {e}")
+        return web.Response(status=400)
+    task = asyncio.create_task(dp.feed_update(bot, update))
+    _webhook_tasks.add(task)
+    task.add_done_callback(_webhook_tasks.discard)
+    return web.Response()
+
+
+async def run_webhook():
+    if not WEBHOOK_URL:
+        raise RuntimeError("BOT_MODE=webhook требует WEBHOOK_URL")
+    app = web.Application()
+    app.router.add_post(WEBHOOK_PATH, handle_webhook)
+    runner = web.AppRunner(app, access_log=None)
+    await runner.setup()
+    await web.TCPSite(runner, WEBHOOK_HOST, WEBHOOK_PORT).start()
+    try:
+        await bot.set_webhook(f"{WEBHOOK_URL}{WEBHOOK_PATH}", secret_token=WEBHOOK_SECRET,
+                              drop_pending_updates=True,
+                              allowed_updates=dp.resolve_used_update_types())
+        logger.info(f"🌐 Webhook: {WEBHOOK_URL}{WEBHOOK_PATH} (слушаю {WEBHOOK_HOST}:{WEBHOOK_PORT})")
+        await asyncio.Event().wait()
+    finally:
+        await runner.cleanup()
+        # Доделываем уже принятые апдейты, прежде чем гасить службы
+        if _webhook_tasks:
+            await asyncio.gather(*list(_webhook_tasks), return_exceptions=True)
+
+
 async def main():
     logger.info("🐉 Dungeon Master Bot v3.0 запускается...")
-    await init_db()
-    await bot.delete_webhook(drop_pending_updates=True)
-
-    if HIVIEWS_API_KEY:
-        logger.info(f"📢 HiViews: активирован (прямые вызовы из хендлеров)")
-    else:
-        logger.info("📢 HiViews: не настроен (HIVIEWS_API_KEY не задан)")
+    try:
+        await start_services()
+        if HIVIEWS_API_KEY:
+            logger.info(f"📢 HiViews: активирован (очередь {HIVIEWS_QUEUE_SIZE}, "
+                        f"воркеров {HIVIEWS_WORKERS})")
+        else:
+            logger.info("📢 HiViews: не настроен (HIVIEWS_API_KEY не задан)")
 
-    logger.info("✅ База готова. 🚀 Бот запущен!")
-    await dp.start_polling(bot)
+        logger.info("✅ База готова. 🚀 Бот запущен!")
+        if BOT_MODE == "webhook":
+            await run_webhook()
+        else:
+            await bot.delete_webhook(drop_pending_updates=True)
+            await dp.start_polling(bot)
+    finally:
+        await stop_services()
 
 
 if __name__ == "__main__":
@@ -0,0 +1,389 @@
+"""
+🐉 DUNGEON MASTER BOT — локальный фейковый Telegram Bot API.
+
+Небольшой aiohttp-сервер с теми методами Bot API, которыми пользуется бот:
+getMe, getUpdates, setWebhook/deleteWebhook, sendMessage, editMessageText,
+answerCallbackQuery (остальные методы отвечают true и попадают в счётчик).
+Сам генерирует трафик виртуальных игроков: каждый проходит сценарий
+нажатий и ждёт ответа бота (sendMessage/editMessageText в свой чат или
+answerCallbackQuery на свой callback) перед следующим шагом.
+
+Позволяет мерить весь стек, включая HTTP-сессию aiogram, без сети:
+задержка ответов (--latency/--jitter), случайные 429 с retry_after
+(--rate-limit), время «на подумать» между нажатиями (--think).
+
+Запуск:
+    python fake_telegram.py --port 8081 --users 200 --loops 10
+    TELEGRAM_API_URL=http://127.0.0.1:8081 DB_PATH=/tmp/bench.db python bot.py
+
+Для webhook-режима бота дополнительно:
+    BOT_MODE=webhook WEBHOOK_URL=http://127.0.0.1:8080
+Сервер начинает слать трафик при первом getUpdates или setWebhook.
+Сводка — в конце прогона и по GET /stats.
+"""
+
+import argparse
+import asyncio
+import itertools
+import json
+import logging
+import random
+import time
+from collections import Counter, deque
+from typing import Optional
+
+import aiohttp
+from aiohttp import web
+
+logging.basicConfig(level=logging.INFO, format="%(asctime)s [%(levelname)s] %(message)s")
+logger = logging.getLogger("fake_telegram")
+
+# ======================== СЦЕНАРИЙ ПО УМОЛЧАНИЮ ========================
+# Строки с "/" — текстовые сообщения, остальное — callback_data.
+DEFAULT_SCRIPT = {
+    "onboarding": ["/start", "class_warrior"],
+    "loop": ["profile", "dungeons", "enter_dungeon_1", "fight_monster_1", "fight_monster_1",
+             "heal", "shop", "buy_hp_potion", "wheel", "spin_free", "pvp", "pvp_fight",
+             "games", "game_dice", "dice_high", "leaderboard", "top_level", "daily", "main_menu"],
+}
+RATE_LIMITED_METHODS = frozenset({"sendmessage", "editmessagetext", "answercallbackquery"})
+FIRST_UID = 2_000_000_000
+
+
+def percentile(values: list, q: float) -> float:
+    if not values:
+        return 0.0
+    values = sorted(values)
+    k = (len(values) - 1) * q
+    lo = int(k)
+    hi = min(lo + 1, len(values) - 1)
+    return values[lo] + (values[hi] - values[lo]) * (k - lo)
+
+
+class FakeTelegram:
+    def __init__(self, args, script: dict):
+        self.args = args
+        self.script = script
+        self.rng = random.Random(args.seed)
+        self.bot_id = 0
+        # неподтверждённые апдейты: getUpdates отдаёт их, пока бот не пришлёт offset дальше
+        self._pending: deque = deque()
+        self._max_delivered = 0
+        self._new = asyncio.Event()
+        self._update_ids = itertools.count(1)
+        self._message_ids = itertools.count(1)
+        self._callback_ids = itertools.count(1)
+        # ожидание ответа: uid -> Event, callback_query_id -> uid, uid -> последнее сообщение бота
+        self._waiting: dict[int, asyncio.Event] = {}
+        self._callbacks: dict[str, int] = {}
+        self._last_message: dict[int, int] = {}
+        # webhook
+        self.webhook_url = ""
+        self.webhook_secret = ""
+        self._webhook_task: Optional[asyncio.Task] = None
+        self._http: Optional[aiohttp.ClientSession] = None
+        # статистика
+        self.calls: Counter = Counter()
+        self.latencies: list[float] = []
+        self.delivered = 0
+        self.timeouts = 0
+        self.timeout_steps: Counter = Counter()
+        self.rate_limited = 0
+        self.webhook_errors = 0
+        self.webhook_retries = 0
+        self.started_at = 0.0
+        self.finished_at = 0.0
+        self._traffic: Optional[asyncio.Task] = None
+        self.done = asyncio.Event()
+
+    # ----- построение апдейтов -----
+    def _user(self, uid: int) -> dict:
+        return {"id": uid, "is_bot": False, "first_name": f"Fake{uid % 100000}", "language_code": "ru"}
+
+    def _bot_user(self) -> dict:
+        return {"id": self.bot_id, "is_bot": True, "first_name": "Dungeon Master", "username": "fake_dm_bot"}
+
+    def _chat(self, uid: int) -> dict:
+        return {"id": uid, "type": "private", "first_name": f"Fake{uid % 100000}"}
+
+    def build_update(self, uid: int, step: str) -> dict:
+        update = {"update_id": next(self._update_ids)}
+        now = int(time.time())
+        if step.startswith("/"):
+            update["message"] = {"message_id": next(self._message_ids), "date": now,
+                                 "chat": self._chat(uid), "from": self._user(uid), "text": step}
+        else:
+            callback_id = str(next(self._callback_ids))
+            self._callbacks[callback_id] = uid
+            shown = {"message_id": self._last_message.get(uid, 1), "date": now,
+                     "chat": self._chat(uid), "from": self._bot_user(), "text": "…"}
+            update["callback_query"] = {"id": callback_id, "from": self._user(uid), "message": shown,
+                                        "chat_instance": str(uid), "data": step}
+        return update
+
+    def enqueue(self, update: dict):
+        self._pending.append(update)
+        self._new.set()
+
+    # ----- виртуальные игроки -----
+    async def run_user(self, uid: int, delay: float):
+        await asyncio.sleep(delay)
+        steps = self.script["onboarding"] + self.script["loop"] * self.args.loops
+        for step in steps:
+            replied = self._waiting[uid] = asyncio.Event()
+            started = time.perf_counter()
+            self.enqueue(self.build_update(uid, step))
+            try:
+                await asyncio.wait_for(replied.wait(), self.args.step_timeout)
+                self.latencies.append(time.perf_counter() - started)
+            except asyncio.TimeoutError:
+                self.timeouts += 1
+                self.timeout_steps[step] += 1
+            finally:
+                self._waiting.pop(uid, None)
+            if self.args.think:
+                await asyncio.sleep(self.rng.uniform(0, 2 * self.args.think / 1000))
+
+    async def run_traffic(self):
+        logger.info(f"🚀 Трафик: {self.args.users} игроков × "
+                    f"{len(self.script['onboarding']) + len(self.script['loop']) * self.args.loops} шагов")
+        self.started_at = time.perf_counter()
+        ramp = self.args.ramp / max(self.args.users, 1)
+        await asyncio.gather(*(self.run_user(FIRST_UID + i, i * ramp) for i in range(self.args.users)))
+        self.finished_at = time.perf_counter()
+        logger.info("🏁 Трафик завершён\n" + json.dumps(self.stats(), ensure_ascii=False, indent=2))
+        self.done.set()
+
+    def start_traffic(self):
+        if self._traffic is None:
+            self._traffic = asyncio.create_task(self.run_traffic())
+
+    def replied(self, uid: Optional[int]):
+        event = self._waiting.get(uid)
+        if event is not None:
+            event.set()
+
+    # ----- доставка апдейтов -----
+    async def get_updates(self, offset: int, limit: int, timeout: float) -> list:
+        while self._pending and self._pending[0]["update_id"] < offset:
+            self._pending.popleft()
+        if not self._pending and timeout > 0:
+            self._new.clear()
+            try:
+                await asyncio.wait_for(self._new.wait(), timeout)
+            except asyncio.TimeoutError:
+                pass
+        batch = list(itertools.islice(self._pending, limit))
+        if batch and batch[-1]["update_id"] > self._max_delivered:
+            self.delivered += sum(1 for u in batch if u["update_id"] > self._max_delivered)
+            self._max_delivered = batch[-1]["update_id"]
+        return batch
+
+    async def take_updates(self, limit: int, timeout: float) -> list:
+        """Для webhook: апдейт считается доставленным сразу при отправке."""
+        if not self._pending and timeout > 0:
+            self._new.clear()
+            try:
+                await asyncio.wait_for(self._new.wait(), timeout)
+            except asyncio.TimeoutError:
+                pass
+        batch = [self._pending.popleft() for _ in range(min(limit, len(self._pending)))]
+        self.delivered += len(batch)
+        return batch
+
+    async def _webhook_loop(self, max_connections: int):
+        sem = asyncio.Semaphore(max_connections)
+        headers = {"X-Telegram-Bot-Api-Secret-Token": self.webhook_secret} if self.webhook_secret else {}
+
+        async def post(update: dict):
+            try:
+                async with self._http.post(self.webhook_url, json=update, headers=headers) as resp:
+                    if resp.status >= 500:
+                        # Как настоящий Telegram: бот перегружен — апдейт уйдёт повторно чуть позже
+                        self.webhook_retries += 1
+                        await asyncio.sleep(0.1)
+                        self.delivered -= 1
+                        self._pending.appendleft(update)
+                        self._new.set()
+                    elif resp.status != 200:
+                        self.webhook_errors += 1
+            except aiohttp.ClientError:
+                self.webhook_errors += 1
+            finally:
+                sem.release()
+
+        while True:
+            for update in await self.take_updates(100, 1.0):
+                await sem.acquire()
+                asyncio.create_task(post(update))
+
+    # ----- Bot API -----
+    def ok(self, result) -> web.Response:
+        return web.json_response({"ok": True, "result": result})
+
+    def error(self, code: int, description: str, **parameters) -> web.Response:
+        body = {"ok": False, "error_code": code, "description": description}
+        if parameters:
+            body["parameters"] = parameters
+        return web.json_response(body, status=code)
+
+    async def handle(self, request: web.Request) -> web.Response:
+        token, method = request.match_info["token"], request.match_info["method"]
+        name = method.lower()
+        self.calls[method] += 1
+        if not self.bot_id:
+            self.bot_id = int(token.split(":")[0]) if token.split(":")[0].isdigit() else 1
+        if request.content_type == "application/json":
+            params = await request.json()
+        else:
+            params = dict(await request.post())
+        if name != "getupdates" and (self.args.latency or self.args.jitter):
+            await asyncio.sleep((self.args.latency + self.rng.uniform(0, self.args.jitter)) / 1000)
+        if name in RATE_LIMITED_METHODS and self.rng.random() < self.args.rate_limit:
+            self.rate_limited += 1
+            return self.error(429, f"Too Many Requests: retry after {self.args.retry_after}",
+                              retry_after=self.args.retry_after)
+
+        if name == "getme":
+            return self.ok(self._bot_user())
+        if name == "getupdates":
+            if self.webhook_url:
+                return self.error(409, "Conflict: can't use getUpdates method while webhook is active")
+            self.start_traffic()
+            updates = await self.get_updates(int(params.get("offset") or 0), int(params.get("limit") or 100),
+                                             float(params.get("timeout") or 0))
+            return self.ok(updates)
+        if name == "setwebhook":
+            await self.set_webhook(params)
+            return self.ok(True)
+        if name == "deletewebhook":
+            await self.delete_webhook()
+            return self.ok(True)
+        if name in ("sendmessage", "editmessagetext"):
+            chat_id = int(params.get("chat_id") or 0)
+            message_id = int(params.get("message_id") or 0) or next(self._message_ids)
+            self._last_message[chat_id] = message_id
+            self.replied(chat_id)
+            message = {"message_id": message_id, "date": int(time.time()), "chat": self._chat(chat_id),
+                       "from": self._bot_user(), "text": params.get("text", "")}
+            if name == "editmessagetext":
+                message["edit_date"] = int(time.time())
+            return self.ok(message)
+        if name == "answercallbackquery":
+            self.replied(self._callbacks.pop(str(params.get("callback_query_id")), None))
+            return self.ok(True)
+        self.calls["(прочие)"] += 1
+        return self.ok(True)
+
+    async def set_webhook(self, params: dict):
+        await self.delete_webhook()
+        self.webhook_url = params.get("url", "")
+        self.webhook_secret = params.get("secret_token", "")
+        if self.webhook_url:
+            logger.info(f"🌐 Webhook: {self.webhook_url}")
+            self._webhook_task = asyncio.create_task(
+                self._webhook_loop(int(params.get("max_connections") or 40)))
+            self.start_traffic()
+
+    async def delete_webhook(self):
+        self.webhook_url = ""
+        if self._webhook_task:
+            self._webhook_task.cancel()
+            self._webhook_task = None
+
+    # ----- сводка -----
+    def stats(self) -> dict:
+        end = self.finished_at or time.perf_counter()
+        elapsed = end - self.started_at if self.started_at else 0.0
+        return {
+            "users": self.args.users,
+            "delivered": self.delivered,
+            "replied": len(self.latencies),
+            "timeouts": self.timeouts,
+            "timeout_steps": dict(self.timeout_steps.most_common(10)),
+            "rate_limited": self.rate_limited,
+            "webhook_errors": self.webhook_errors,
+            "webhook_retries": self.webhook_retries,
+            "seconds": round(elapsed, 3),
+            "updates_per_sec": round(len(self.latencies) / elapsed, 1) if elapsed else 0.0,
+            "reply_ms": {q: round(percentile(self.latencies, p) * 1000, 2)
+                         for q, p in (("p50", .5), ("p95", .95), ("p99", .99))},
+            "calls": dict(self.calls.most_common()),
+        }
+
+    async def handle_stats(self, request: web.Request) -> web.Response:
+        return web.json_response(self.stats())
+
+    def app(self) -> web.Application:
+        app = web.Application(client_max_size=16 * 1024 * 1024)
+        app.router.add_get("/stats", self.handle_stats)
+        app.router.add_route("*", "/bot{token}/{method}", self.handle)
+
+        async def on_startup(_app):
+            self._http = aiohttp.ClientSession()
+
+        async def on_cleanup(_app):
+            await self.delete_webhook()
+            if self._traffic:
+                self._traffic.cancel()
+            await self._http.close()
+
+        app.on_startup.append(on_startup)
+        app.on_cleanup.append(on_cleanup)
+        return app
+
+
+def load_script(path: Optional[str]) -> dict:
+    if not path:
+        return DEFAULT_SCRIPT
+    with open(path, encoding="utf-8") as f:
+        data = json.load(f)
+    if isinstance(data, list):
+        return {"onboarding": [], "loop": data}
+    return {"onboarding": list(data.get("onboarding", [])), "loop": list(data.get("loop", []))}
+
+
+def parse_args(argv=None):
+    p = argparse.ArgumentParser(description="Локальный фейковый Telegram Bot API со сценарным трафиком")
+    p.add_argument("--host", default="127.0.0.1")
+    p.add_argument("--port", type=int, default=8081)
+    p.add_argument("--users", type=int, default=100, help="виртуальных игроков")
+    p.add_argument("--loops", type=int, default=5, help="повторов основного сценария на игрока")
+    p.add_argument("--script", help='JSON: {"onboarding": [...], "loop": [...]} или просто список шагов')
+    p.add_argument("--latency", type=float, default=0.0, help="задержка ответа Bot API, мс")
+    p.add_argument("--jitter", type=float, default=0.0, help="случайная добавка к задержке, до N мс")
+    p.add_argument("--rate-limit", type=float, default=0.0, help="доля ответов 429 на send/edit/answer")
+    p.add_argument("--retry-after", type=int, default=1, help="retry_after в ответах 429, сек")
+    p.add_argument("--think", type=float, default=0.0, help="средняя пауза игрока между нажатиями, мс")
+    p.add_argument("--ramp", type=float, default=0.0, help="за сколько секунд подключить всех игроков")
+    p.add_argument("--step-timeout", type=float, default=30.0, help="сколько ждать ответа на шаг, сек")
+    p.add_argument("--seed", type=int, default=42)
+    p.add_argument("--exit-when-done", action="store_true", help="остановиться после прогона")
+    p.add_argument("--json", help="сохранить итоговую сводку в JSON")
+    return p.parse_args(argv)
+
+
+async def serve(args):
+    fake = FakeTelegram(args, load_script(args.script))
+    runner = web.AppRunner(fake.app(), access_log=None)
+    await runner.setup()
+    await web.TCPSite(runner, args.host, args.port).start()
+    logger.info(f"🤖 Фейковый Bot API: http://{args.host}:{args.port} "
+                f"(TELEGRAM_API_URL=http://{args.host}:{args.port})")
+    try:
+        if args.exit_when_done:
+            await fake.done.wait()
+        else:
+            await asyncio.Event().wait()
+    finally:
+        if args.json:
+            with open(args.json, "w", encoding="utf-8") as f:
+                json.dump(fake.stats(), f, ensure_ascii=False, indent=2)
+        await runner.cleanup()
+
+
+if __name__ == "__main__":
+    try:
+        asyncio.run(serve(parse_args()))
+    except KeyboardInterrupt:
+        pass
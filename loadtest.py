@@ -0,0 +1,357 @@
+"""
+🐉 DUNGEON MASTER BOT — синтетическая нагрузка без Telegram.
+
+Генерирует апдейты тысяч виртуальных игроков (старт, выбор класса, бои,
+магазин, колесо, PvP, донат с проверкой оплаты) и скармливает их в
+dp.feed_update параллельно. Сессия бота подменена заглушкой, которая
+только записывает исходящие вызовы Bot API; Crypto Pay поднимается
+локально на случайном порту; база — во временном каталоге.
+
+Отчёт: апдейты в секунду, p50/p95/p99 времени обработки (всего и по
+действиям), SQL-операторы и коммиты на апдейт, вызовы Bot API.
+
+Запуск:
+    python loadtest.py --users 2000 --concurrency 200 --rounds 20
+    python loadtest.py --storage memory   # потолок игровой логики без SQLite
+"""
+
+import argparse
+import asyncio
+import itertools
+import json
+import logging
+import os
+import random
+import socket
+import sys
+import tempfile
+import time
+from collections import Counter, defaultdict
+from datetime import datetime
+from typing import Optional
+
+# ======================== ОКРУЖЕНИЕ ДО ИМПОРТА БОТА ========================
+# bot.py читает настройки при импорте, поэтому всё подменяем заранее.
+# DB_PATH — всегда временный (или явно заданный --db), чтобы не задеть боевую базу.
+_crypto_sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+_crypto_sock.bind(("127.0.0.1", 0))
+_tmp_dir = tempfile.mkdtemp(prefix="dmbot-load-")
+os.environ["DB_PATH"] = os.path.join(_tmp_dir, "load.db")
+os.environ["CRYPTO_PAY_API"] = f"http://127.0.0.1:{_crypto_sock.getsockname()[1]}"
+os.environ["CRYPTO_PAY_TOKEN"] = "loadtest"
+os.environ["HIVIEWS_API_KEY"] = ""
+os.environ.setdefault("BOT_TOKEN", "123456789:LOADTEST")
+os.environ.setdefault("ADMIN_IDS", "1")
+os.environ.setdefault("METRICS_PORT", "0")
+os.environ.setdefault("SLOW_UPDATE_MS", "2000")
+
+from aiohttp import web  # noqa: E402
+from aiogram import BaseMiddleware  # noqa: E402
+from aiogram.client.session.base import BaseSession  # noqa: E402
+from aiogram.methods import GetMe, SendMessage, EditMessageText  # noqa: E402
+from aiogram.types import Update, Message, CallbackQuery, Chat, User  # noqa: E402
+
+# ======================== СЦЕНАРИИ ========================
+# Вес сценария -> последовательность нажатий. Каждый виртуальный игрок
+# кликает последовательно (ждёт ответ бота), как живой человек.
+SCENARIOS = {
+    "fight": (30, ["dungeons", "enter_dungeon_1", "fight_monster_1", "fight_monster_1", "fight_boss_1"]),
+    "energy": (8, ["gem_shop", "gbuy_energy_refill"]),
+    "heal": (10, ["profile", "heal"]),
+    "shop": (10, ["shop", "buy_hp_potion"]),
+    "wheel": (8, ["wheel", "spin_free"]),
+    "pvp": (12, ["pvp", "pvp_fight"]),
+    "games": (8, ["games", "game_dice", "dice_high"]),
+    "daily": (5, ["daily"]),
+    "top": (6, ["leaderboard", "top_level"]),
+    "payment": (3, ["donate_shop", "donate_buy_gold_100", "check_payment"]),
+}
+FIRST_UID = 1_000_000_000
+
+
+def percentile(values: list, q: float) -> float:
+    if not values:
+        return 0.0
+    values = sorted(values)
+    k = (len(values) - 1) * q
+    lo = int(k)
+    hi = min(lo + 1, len(values) - 1)
+    return values[lo] + (values[hi] - values[lo]) * (k - lo)
+
+
+# ======================== ЗАГЛУШКИ ВНЕШНИХ API ========================
+class RecordingSession(BaseSession):
+    """Сессия Bot API без сети: считает вызовы и помнит последнюю клавиатуру в каждом чате."""
+
+    def __init__(self, latency: float = 0.0):
+        super().__init__()
+        self.latency = latency
+        self.calls: Counter = Counter()
+        self.buttons: dict[int, list[str]] = {}
+        self._message_ids = itertools.count(1)
+
+    async def close(self):
+        pass
+
+    async def stream_content(self, *args, **kwargs):
+        yield b""
+
+    async def make_request(self, bot, method, timeout=None):
+        self.calls[type(method).__name__] += 1
+        if self.latency:
+            await asyncio.sleep(self.latency)
+        if isinstance(method, GetMe):
+            return User(id=int(bot.id), is_bot=True, first_name="Dungeon Master", username="loadtest_bot")
+        if isinstance(method, (SendMessage, EditMessageText)):
+            chat_id = int(method.chat_id or 0)
+            markup = getattr(method, "reply_markup", None)
+            if markup is not None and hasattr(markup, "inline_keyboard"):
+                self.buttons[chat_id] = [b.callback_data for row in markup.inline_keyboard
+                                         for b in row if b.callback_data]
+            return Message(message_id=next(self._message_ids), date=datetime.now(),
+                           chat=Chat(id=chat_id, type="private"), text=method.text)
+        return True
+
+
+class FakeCryptoPay:
+    """createInvoice/getInvoices в духе Crypto Pay API; счёт считается оплаченным сразу."""
+
+    def __init__(self, sock: socket.socket):
+        self.sock = sock
+        self.invoices: dict[int, dict] = {}
+        self._ids = itertools.count(1)
+        self._runner: Optional[web.AppRunner] = None
+
+    async def create_invoice(self, request: web.Request) -> web.Response:
+        invoice_id = next(self._ids)
+        invoice = {"invoice_id": invoice_id, "status": "paid",
+                   "amount": request.query.get("amount"), "payload": request.query.get("payload"),
+                   "pay_url": f"https://t.me/CryptoBot?start=IV{invoice_id}"}
+        self.invoices[invoice_id] = invoice
+        return web.json_response({"ok": True, "result": invoice})
+
+    async def get_invoices(self, request: web.Request) -> web.Response:
+        ids = [int(i) for i in request.query.get("invoice_ids", "").split(",") if i.strip().isdigit()]
+        items = [self.invoices[i] for i in ids if i in self.invoices]
+        return web.json_response({"ok": True, "result": {"items": items}})
+
+    async def start(self):
+        app = web.Application()
+        app.router.add_get("/createInvoice", self.create_invoice)
+        app.router.add_get("/getInvoices", self.get_invoices)
+        self._runner = web.AppRunner(app, access_log=None)
+        await self._runner.setup()
+        await web.SockSite(self._runner, self.sock).start()
+
+    async def stop(self):
+        if self._runner:
+            await self._runner.cleanup()
+
+
+# ======================== СБОР СТАТИСТИКИ ========================
+class StatsCollector(BaseMiddleware):
+    """
+    Внешний middleware, зарегистрированный после MetricsMiddleware: к моменту
+    выхода из хендлера счётчики апдейта ещё лежат в bot._update_stats.
+    """
+
+    def __init__(self, update_stats):
+        self.update_stats = update_stats
+        self.by_update: dict[int, tuple] = {}
+
+    async def __call__(self, handler, event: Update, data: dict):
+        try:
+            return await handler(event, data)
+        finally:
+            stats = self.update_stats.get()
+            if stats is not None:
+                self.by_update[event.update_id] = (stats.statements, stats.commits)
+
+
+class LoadTest:
+    def __init__(self, bot_module, args):
+        self.B = bot_module
+        self.args = args
+        self.rng = random.Random(args.seed)
+        self.session = RecordingSession(args.api_latency / 1000)
+        self.collector = StatsCollector(bot_module._update_stats)
+        self.admin_id = bot_module.ADMIN_IDS[0] if bot_module.ADMIN_IDS else None
+        self._update_ids = itertools.count(1)
+        self._callback_ids = itertools.count(1)
+        # действие -> [(секунды, операторов, коммитов)]
+        self.samples: dict[str, list] = defaultdict(list)
+        self.errors: Counter = Counter()
+        self.phases: list[tuple] = []
+
+    # ----- построение апдейтов -----
+    def message(self, uid: int, text: str) -> Update:
+        return Update(update_id=next(self._update_ids), message=Message(
+            message_id=1, date=datetime.now(), text=text,
+            chat=Chat(id=uid, type="private"),
+            from_user=User(id=uid, is_bot=False, first_name=f"Bot{uid % 100000}", language_code="ru")))
+
+    def callback(self, uid: int, data: str) -> Update:
+        shown = Message(message_id=1, date=datetime.now(), text="…", chat=Chat(id=uid, type="private"),
+                        from_user=User(id=self.B.bot.id, is_bot=True, first_name="Dungeon Master"))
+        return Update(update_id=next(self._update_ids), callback_query=CallbackQuery(
+            id=str(next(self._callback_ids)), chat_instance=str(uid), data=data, message=shown,
+            from_user=User(id=uid, is_bot=False, first_name=f"Bot{uid % 100000}", language_code="ru")))
+
+    async def feed(self, action: str, update: Update):
+        started = time.perf_counter()
+        try:
+            await self.B.dp.feed_update(self.B.bot, update)
+        except Exception as e:
+            self.errors[f"{action}: {type(e).__name__}"] += 1
+        elapsed = time.perf_counter() - started
+        statements, commits = self.collector.by_update.pop(update.update_id, (0, 0))
+        self.samples[action].append((elapsed, statements, commits))
+
+    # ----- поведение игрока -----
+    async def onboard(self, uid: int):
+        referrer = uid - 1 if uid > FIRST_UID and self.rng.random() < self.args.referrals else None
+        await self.feed("/start", self.message(uid, f"/start {referrer}" if referrer else "/start"))
+        await self.feed("class_", self.callback(uid, f"class_{self.rng.choice(list(self.B.CLASSES))}"))
+        if self.admin_id is not None and self.args.grant_gems:
+            await self.feed("/give", self.message(self.admin_id, f"/give {uid} gems {self.args.grant_gems}"))
+
+    async def play(self, uid: int):
+        names = list(SCENARIOS)
+        weights = [SCENARIOS[n][0] for n in names]
+        for _ in range(self.args.rounds):
+            for data in SCENARIOS[self.rng.choices(names, weights)[0]][1]:
+                if data == "check_payment":
+                    data = next((b for b in self.session.buttons.get(uid, ())
+                                 if b.startswith("check_payment_")), None)
+                    if data is None:
+                        continue
+                    action = "check_payment_"
+                else:
+                    action = data
+                await self.feed(action, self.callback(uid, data))
+
+    async def run_phase(self, name: str, fn, uids: range):
+        sem = asyncio.Semaphore(self.args.concurrency)
+        before = sum(len(v) for v in self.samples.values())
+
+        async def one(uid: int):
+            async with sem:
+                await fn(uid)
+
+        started = time.perf_counter()
+        await asyncio.gather(*(one(uid) for uid in uids))
+        elapsed = time.perf_counter() - started
+        self.phases.append((name, sum(len(v) for v in self.samples.values()) - before, elapsed))
+
+    async def run(self):
+        fake_pay = FakeCryptoPay(_crypto_sock)
+        await fake_pay.start()
+        self.B.bot.session = self.session
+        self.B.dp.update.outer_middleware(self.collector)
+        await self.B.start_services()
+        db_before = sum(self.B.M_DB_QUERIES._values.values())
+        uids = range(FIRST_UID, FIRST_UID + self.args.users)
+        try:
+            await self.run_phase("onboarding", self.onboard, uids)
+            await self.run_phase("gameplay", self.play, uids)
+        finally:
+            await self.B.stop_services()
+            await fake_pay.stop()
+        self.db_calls = sum(self.B.M_DB_QUERIES._values.values()) - db_before
+        self.invoices = len(fake_pay.invoices)
+
+    # ----- отчёт -----
+    def report(self) -> dict:
+        all_samples = [s for v in self.samples.values() for s in v]
+        latencies = [s[0] for s in all_samples]
+        total = len(all_samples)
+        return {
+            "users": self.args.users,
+            "storage": self.args.storage,
+            "concurrency": self.args.concurrency,
+            "updates": total,
+            "phases": [{"name": n, "updates": c, "seconds": round(t, 3), "updates_per_sec": round(c / t, 1)}
+                       for n, c, t in self.phases],
+            "latency_ms": {q: round(percentile(latencies, p) * 1000, 2)
+                           for q, p in (("p50", .5), ("p95", .95), ("p99", .99))},
+            "statements_per_update": round(sum(s[1] for s in all_samples) / max(total, 1), 2),
+            "commits_per_update": round(sum(s[2] for s in all_samples) / max(total, 1), 2),
+            "db_calls_total": self.db_calls,
+            "invoices": self.invoices,
+            "bot_api_calls": dict(self.session.calls.most_common()),
+            "errors": dict(self.errors),
+            "actions": {
+                action: {"count": len(v),
+                         "p50_ms": round(percentile([s[0] for s in v], .5) * 1000, 2),
+                         "p95_ms": round(percentile([s[0] for s in v], .95) * 1000, 2),
+                         "p99_ms": round(percentile([s[0] for s in v], .99) * 1000, 2),
+                         "statements": round(sum(s[1] for s in v) / len(v), 2),
+                         "commits": round(sum(s[2] for s in v) / len(v), 2)}
+                for action, v in sorted(self.samples.items(), key=lambda kv: -sum(s[0] for s in kv[1]))
+            },
+        }
+
+
+def print_report(r: dict):
+    print(f"\n🐉 Нагрузка: {r['users']} игроков, параллельно {r['concurrency']}, апдейтов {r['updates']} "
+          f"(хранилище: {r['storage']})")
+    for p in r["phases"]:
+        print(f"  {p['name']:<11} {p['updates']:>8} апд. за {p['seconds']:>7.2f}с → {p['updates_per_sec']:>8.1f} апд/с")
+    lat = r["latency_ms"]
+    print(f"  Задержка: p50 {lat['p50']:.2f}мс | p95 {lat['p95']:.2f}мс | p99 {lat['p99']:.2f}мс")
+    print(f"  SQL на апдейт: {r['statements_per_update']} | коммитов на апдейт: {r['commits_per_update']} "
+          f"| обращений к БД всего (с фоновыми): {r['db_calls_total']}")
+    print(f"  Bot API: {r['bot_api_calls']}")
+    print(f"  Счетов Crypto Pay: {r['invoices']}")
+    if r["errors"]:
+        print(f"  ❌ Ошибки: {r['errors']}")
+    print(f"\n  {'действие':<22}{'кол-во':>8}{'p50мс':>9}{'p95мс':>9}{'p99мс':>9}{'SQL':>7}{'коммит':>8}")
+    for action, a in r["actions"].items():
+        print(f"  {action:<22}{a['count']:>8}{a['p50_ms']:>9.2f}{a['p95_ms']:>9.2f}{a['p99_ms']:>9.2f}"
+              f"{a['statements']:>7.2f}{a['commits']:>8.2f}")
+
+
+def parse_args(argv=None):
+    p = argparse.ArgumentParser(description="Синтетическая нагрузка на Dispatcher без Telegram")
+    p.add_argument("--users", type=int, default=1000, help="виртуальных игроков")
+    p.add_argument("--concurrency", type=int, default=200, help="игроков, кликающих одновременно")
+    p.add_argument("--rounds", type=int, default=20, help="сценариев на игрока после регистрации")
+    p.add_argument("--seed", type=int, default=42)
+    p.add_argument("--api-latency", type=float, default=0.0, help="задержка заглушки Bot API, мс")
+    p.add_argument("--grant-gems", type=int, default=200, help="гемов каждому игроку через /give (0 — не выдавать)")
+    p.add_argument("--referrals", type=float, default=0.3, help="доля игроков, пришедших по рефке")
+    p.add_argument("--throttle", action="store_true", help="не отключать антифлуд кнопок")
+    p.add_argument("--db", help="путь к базе вместо временной (файл будет изменён!)")
+    p.add_argument("--storage", choices=("sqlite", "memory"), default="sqlite",
+                   help="хранилище бота (memory — без БД, для сравнения с SQLite)")
+    p.add_argument("--json", help="сохранить отчёт в JSON")
+    p.add_argument("--verbose", action="store_true", help="логи бота на уровне INFO")
+    return p.parse_args(argv)
+
+
+def main():
+    args = parse_args()
+    if args.db:
+        os.environ["DB_PATH"] = args.db
+    os.environ["STORAGE"] = args.storage
+    if not args.throttle:
+        # Виртуальные игроки кликают без пауз — антифлуд срезал бы большую часть нагрузки
+        os.environ["THROTTLE_LIMITS"] = ""
+        os.environ["THROTTLE_RATE"] = os.environ["THROTTLE_BURST"] = "1000000"
+    sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+    import bot as B
+    if not args.verbose:
+        logging.getLogger().setLevel(logging.WARNING)
+    test = LoadTest(B, args)
+    asyncio.run(test.run())
+    report = test.report()
+    print_report(report)
+    if args.json:
+        with open(args.json, "w", encoding="utf-8") as f:
+            json.dump(report, f, ensure_ascii=False, indent=2)
+    if args.storage == "sqlite":
+        print(f"\n🗄️ База прогона: {os.environ['DB_PATH']}")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,204 @@
+"""
+🐉 DUNGEON MASTER BOT — перешардирование базы (офлайн).
+
+Перекладывает данные игроков (таблицы bot.SHARDED_TABLES) из текущей
+раскладки в новую: игрок попадает в шард user_id % N. Текущее число
+шардов берётся из settings основной базы, новое записывается туда же —
+после этого бот стартует только с DB_SHARDS=N.
+
+Бот на время перешардирования должен быть остановлен. Новые файлы
+заполняются целиком и проверяются по числу строк; только потом
+меняется настройка в основной базе. Старые файлы шардов остаются
+на диске (или удаляются с --delete-old).
+
+Запуск:
+    python reshard.py --to 4             # DB_PATH из .env/окружения
+    python reshard.py --to 1 --db /data/dungeon_master.db
+"""
+
+import argparse
+import asyncio
+import os
+import sqlite3
+import sys
+import time
+from collections import defaultdict
+
+# bot.py проверяет токен при импорте; сеть и метрики здесь не нужны
+os.environ.setdefault("BOT_TOKEN", "0:reshard")
+os.environ["METRICS_PORT"] = "0"
+
+
+def current_layout(main_path: str) -> int:
+    conn = sqlite3.connect(main_path)
+    try:
+        row = conn.execute("SELECT value FROM settings WHERE key = 'shards'").fetchone()
+    except sqlite3.OperationalError:
+        row = None
+    finally:
+        conn.close()
+    return int(row[0]) if row else 1
+
+
+async def migrate(B, paths: list):
+    """Приводит схему всех файлов к текущей версии бота (новые файлы создаются с нуля)."""
+    for path in paths:
+        db = B.Database(path, readers=1)
+        await db.start()
+        try:
+            await B.run_migrations(db)
+        finally:
+            await db.close()
+
+
+def table_columns(conn: sqlite3.Connection, table: str) -> list:
+    cols = [row[1] for row in conn.execute(f'PRAGMA table_info("{table}")')]
+    # id платежей — AUTOINCREMENT своего файла; при слиянии шардов они бы совпали
+    return [c for c in cols if not (table == "payments" and c == "id")]
+
+
+def count_rows(paths: list, tables) -> dict:
+    totals = defaultdict(int)
+    for path in paths:
+        conn = sqlite3.connect(path)
+        try:
+            for table in tables:
+                totals[table] += conn.execute(f'SELECT COUNT(*) FROM "{table}"').fetchone()[0]
+        finally:
+            conn.close()
+    return dict(totals)
+
+
+def copy_players(tables, src_paths: list, dst_paths: list, batch: int) -> dict:
+    count = len(dst_paths)
+    dst = [sqlite3.connect(p, isolation_level=None) for p in dst_paths]
+    copied = defaultdict(int)
+    try:
+        for conn in dst:
+            conn.execute("PRAGMA synchronous = OFF")
+            conn.execute("BEGIN")
+        for src_path in src_paths:
+            src = sqlite3.connect(src_path)
+            try:
+                for table in tables:
+                    cols = table_columns(src, table)
+                    names = ", ".join(f'"{c}"' for c in cols)
+                    insert = f'INSERT INTO "{table}" ({names}) VALUES ({", ".join("?" * len(cols))})'
+                    uid = cols.index("user_id")
+                    order = " ORDER BY id" if table == "payments" else ""
+                    cur = src.execute(f'SELECT {names} FROM "{table}"{order}')
+                    while True:
+                        rows = cur.fetchmany(batch)
+                        if not rows:
+                            break
+                        buckets = defaultdict(list)
+                        for row in rows:
+                            buckets[row[uid] % count].append(row)
+                        for i, part in buckets.items():
+                            dst[i].executemany(insert, part)
+                        copied[table] += len(rows)
+            finally:
+                src.close()
+        for conn in dst:
+            conn.execute("COMMIT")
+    except BaseException:
+        for conn in dst:
+            if conn.in_transaction:
+                conn.execute("ROLLBACK")
+        raise
+    finally:
+        for conn in dst:
+            conn.close()
+    return dict(copied)
+
+
+def finish(main_path: str, tables, new_count: int, clear_main: bool):
+    """Новая раскладка в settings и (если игроки уходили из основной базы) её очистка — одной транзакцией."""
+    conn = sqlite3.connect(main_path, isolation_level=None)
+    try:
+        conn.execute("BEGIN")
+        conn.execute("INSERT OR REPLACE INTO settings (key, value) VALUES ('shards', ?)", (str(new_count),))
+        if clear_main:
+            for table in tables:
+                conn.execute(f'DELETE FROM "{table}"')
+        conn.execute("COMMIT")
+    except BaseException:
+        if conn.in_transaction:
+            conn.execute("ROLLBACK")
+        raise
+    finally:
+        conn.close()
+
+
+def parse_args(argv=None):
+    p = argparse.ArgumentParser(description="Перешардирование базы Dungeon Master (бот должен быть остановлен)")
+    p.add_argument("--to", type=int, required=True, help="новое число шардов (1 — один файл)")
+    p.add_argument("--db", help="основная база (по умолчанию DB_PATH бота)")
+    p.add_argument("--batch", type=int, default=5000, help="строк за одну пачку копирования")
+    p.add_argument("--force", action="store_true", help="перезаписать уже существующие файлы новых шардов")
+    p.add_argument("--delete-old", action="store_true", help="удалить старые файлы шардов после переноса")
+    return p.parse_args(argv)
+
+
+def main():
+    args = parse_args()
+    if args.db:
+        os.environ["DB_PATH"] = args.db
+    sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+    import bot as B
+
+    main_path = B.DB_PATH
+    if not os.path.exists(main_path):
+        sys.exit(f"❌ Нет базы {main_path}")
+    new_count = max(1, args.to)
+    old_count = current_layout(main_path)
+    if old_count == new_count:
+        sys.exit(f"✅ База уже разбита на {old_count} шард(ов) — делать нечего")
+    src_paths = [B.shard_path(main_path, i, old_count) for i in range(old_count)]
+    dst_paths = [B.shard_path(main_path, i, new_count) for i in range(new_count)]
+    missing = [p for p in src_paths if not os.path.exists(p)]
+    if missing:
+        sys.exit(f"❌ Не найдены файлы шардов: {', '.join(missing)}")
+    if new_count > 1:
+        existing = [p for p in dst_paths if os.path.exists(p)]
+        if existing and not args.force:
+            sys.exit(f"❌ Файлы новых шардов уже есть (--force, чтобы перезаписать): {', '.join(existing)}")
+        for path in existing:
+            for suffix in ("", "-wal", "-shm"):
+                if os.path.exists(path + suffix):
+                    os.remove(path + suffix)
+
+    print(f"🗄️ {main_path}: {old_count} → {new_count} шард(ов)")
+    started = time.perf_counter()
+    # Схема основной базы, старых и новых шардов — как у текущей версии бота
+    asyncio.run(migrate(B, list(dict.fromkeys([main_path] + src_paths + dst_paths))))
+    tables = B.SHARDED_TABLES
+    if new_count == 1 and any(count_rows([main_path], tables).values()):
+        sys.exit("❌ В основной базе уже есть данные игроков — сливать шарды в неё небезопасно")
+
+    before = count_rows(src_paths, tables)
+    copied = copy_players(tables, src_paths, dst_paths, args.batch)
+    after = count_rows(dst_paths, tables)
+    for table in tables:
+        print(f"  {table:<18} {before.get(table, 0):>10} → {after.get(table, 0):>10}")
+    if before != after or any(copied.get(t, 0) != before.get(t, 0) for t in tables):
+        sys.exit("❌ Число строк не совпало — раскладка не изменена, новые файлы можно удалить")
+
+    finish(main_path, tables, new_count, clear_main=old_count == 1)
+    print(f"✅ Готово за {time.perf_counter() - started:.1f}с. Запускай бота с DB_SHARDS={new_count}")
+    old_files = [p for p in src_paths if p != main_path]
+    if old_files:
+        if args.delete_old:
+            for path in old_files:
+                for suffix in ("", "-wal", "-shm"):
+                    if os.path.exists(path + suffix):
+                        os.remove(path + suffix)
+            print(f"🗑 Удалены старые шарды: {len(old_files)}")
+        else:
+            print("ℹ️ Старые файлы шардов больше не используются и могут быть удалены:")
+            for path in old_files:
+                print(f"   {path}")
+
+
+if __name__ == "__main__":
+    main()
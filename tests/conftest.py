@@ -0,0 +1,60 @@
+"""
+Общие фикстуры тестов. bot.py читает окружение при импорте, поэтому
+переменные задаются до него; сеть, метрики и Crypto Pay выключены.
+Async-тесты гоняются через asyncio.run (pytest-asyncio не нужен).
+"""
+
+import asyncio
+import os
+import sys
+import tempfile
+from contextlib import asynccontextmanager
+
+import pytest
+
+os.environ.setdefault("BOT_TOKEN", "123456:TESTTOKEN")
+os.environ.setdefault("DB_PATH", os.path.join(tempfile.mkdtemp(prefix="dmbot-test-"), "bot.db"))
+os.environ["METRICS_PORT"] = "0"
+os.environ["CRYPTO_PAY_TOKEN"] = ""
+os.environ["HIVIEWS_API_KEY"] = ""
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+import bot as B  # noqa: E402
+
+
+def run(coro):
+    return asyncio.run(coro)
+
+
+@pytest.fixture(params=["memory", "sqlite", "sqlite-3-shards"])
+def make_storage(request, tmp_path):
+    """Фабрика свежего хранилища: одни и те же тесты идут по всем реализациям Storage."""
+    def factory():
+        if request.param == "memory":
+            return B.MemoryStorage()
+        count = 3 if request.param == "sqlite-3-shards" else 1
+        return B.SQLiteStorage(B.ShardSet(B.Database(str(tmp_path / "bot.db"), readers=2), count))
+    return factory
+
+
+@pytest.fixture
+def game(make_storage, monkeypatch):
+    """
+    async with game() as (storage, cache): — запущенное хранилище, подставленное
+    в bot.storage, и свой UserCache без фонового сброса и без подписчиков.
+    """
+    @asynccontextmanager
+    async def start(**cache_kwargs):
+        storage = make_storage()
+        await storage.start()
+        cache = B.UserCache(storage, flush_interval_ms=60_000, **cache_kwargs)
+        monkeypatch.setattr(B, "storage", storage)
+        monkeypatch.setattr(B, "user_cache", cache)
+        monkeypatch.setattr(B, "_user_locks", B.KeyedLocks())
+        await B.load_item_ids()
+        try:
+            yield storage, cache
+        finally:
+            await cache.flush()
+            await storage.close()
+    return start
@@ -0,0 +1,43 @@
+"""Достижения: проверка по изменившимся счётчикам и разовый проход миграцией."""
+
+from conftest import B, run
+
+
+def test_apply_achievements_checks_only_changed_counters():
+    user = {"achievements": ["first_blood"], "gold": 0, "gems": 0, "total_gems_earned": 0,
+            "dungeon_wins": 10, "wins": 1}
+    msg = B.apply_achievements(user, ("dungeon_wins",))
+    assert user["achievements"] == ["first_blood", "hunter_10"]
+    assert "Охотник" in msg and (user["gold"], user["gems"]) == (50, 2)
+    assert B.apply_achievements(user, ("dungeon_wins",)) == ""
+    B.apply_achievements(user, ("wins",))
+    assert "pvp_1" in user["achievements"]
+
+
+def test_migration_unlocks_thresholds_passed_earlier(tmp_path):
+    async def scenario():
+        def make():
+            return B.SQLiteStorage(B.ShardSet(B.Database(str(tmp_path / "bot.db"), readers=1), 2))
+
+        storage = make()
+        await storage.start()
+        for uid in (1, 2, 3):
+            await storage.create_user(uid, "p", "2026-01-01")
+        await storage.save_users({1: {"dungeon_wins": 12, "level": 5, "achievements": ["first_blood"]}},
+                                 {1: {"achievements": []}}, {1: {"achievements": ["first_blood"]}})
+        await storage.save_users({2: {"wins": 1}}, {}, {})
+        # База до миграции 6: пороги пройдены, но достижения не выданы
+        for db in storage.db.all:
+            await db.execute("DELETE FROM schema_version WHERE version = 6")
+        await storage.close()
+
+        for _ in range(2):  # на повторном старте миграция уже записана и не начисляет второй раз
+            storage = make()
+            await storage.start()
+            first, second, third = [await storage.load_user(uid) for uid in (1, 2, 3)]
+            await storage.close()
+            assert sorted(first["achievements"]) == ["first_blood", "hunter_10", "lvl_5"]
+            assert (first["gold"], first["gems"], first["total_gems_earned"]) == (50 + 50 + 30, 4, 4)
+            assert second["achievements"] == ["pvp_1"] and second["gold"] == 80
+            assert third["achievements"] == [] and third["gold"] == 50
+    run(scenario())
@@ -0,0 +1,71 @@
+"""Зачисление платежей: идемпотентность и согласованность с кэшем игроков."""
+
+import asyncio
+
+from conftest import B, run
+
+
+async def paid_invoice(storage, uid, invoice_id, item_key):
+    item = B.DONATE_ITEMS[item_key]
+    await storage.add_payment(uid, invoice_id, item_key, item["price_usd"], "2026-01-01T00:00:00")
+    return await storage.get_payment(uid, invoice_id)
+
+
+def test_credit_payment_is_idempotent(game):
+    async def scenario():
+        async with game() as (storage, cache):
+            await storage.create_user(1, "p", "2026-01-01")
+            payment = await paid_invoice(storage, 1, 10, "gems_10")
+            results = await asyncio.gather(*(B.credit_payment(payment) for _ in range(5)))
+            assert sum(1 for r in results if r) == 1
+            assert await B.credit_payment(payment) is None
+            for user in (await B.get_user(1), await storage.load_user(1)):
+                assert (user["gems"], user["total_gems_earned"], user["total_spent_usd"]) == (10, 10, 1.0)
+            assert await storage.payment_totals() == {"payments": 1, "revenue": 1.0}
+    run(scenario())
+
+
+def test_credit_notifies_listeners(game):
+    async def scenario():
+        async with game() as (storage, cache):
+            await storage.create_user(1, "p", "2026-01-01")
+            seen = []
+            cache.add_listener(lambda user, fields: seen.append(set(fields)))
+            payment = await paid_invoice(storage, 1, 11, "vip_7")
+            assert await B.credit_payment(payment)
+            assert seen[-1] >= {"gold", "gems", "total_gems_earned", "total_spent_usd", "vip_until"}
+            assert B.is_vip(await B.get_user(1))
+    run(scenario())
+
+
+def test_reward_survives_concurrent_cache_write(game):
+    async def scenario():
+        async with game() as (storage, cache):
+            await storage.create_user(1, "p", "2026-01-01")
+            async with B.user_action(1) as user:
+                user["gold"] += 5  # грязное изменение до зачисления
+            original = storage.mark_paid
+
+            async def mark_paid(*args):
+                # Пока платёж пишется, запись игрока становится грязной по другому полю
+                await cache.update(1, {"bot_blocked": 1})
+                return await original(*args)
+
+            storage.mark_paid = mark_paid
+            assert await B.credit_payment(await paid_invoice(storage, 1, 12, "gold_100"))
+            async with B.user_action(1, durable=True) as user:
+                user["gold"] += 1
+            for user in (await B.get_user(1), await storage.load_user(1)):
+                assert (user["gold"], user["total_spent_usd"], user["bot_blocked"]) == (156, 0.5, 1)
+    run(scenario())
+
+
+def test_expired_payment_is_not_credited(game):
+    async def scenario():
+        async with game() as (storage, _):
+            await storage.create_user(1, "p", "2026-01-01")
+            payment = await paid_invoice(storage, 1, 13, "gold_500")
+            assert await B.expire_payment(payment)
+            assert await B.credit_payment(payment) is None
+            assert (await B.get_user(1))["gold"] == 50
+    run(scenario())
@@ -0,0 +1,186 @@
+"""Контракт Storage: одни и те же сценарии для MemoryStorage и SQLiteStorage (1 и 3 шарда)."""
+
+from conftest import B, run
+
+
+async def add_player(storage, uid, name="p", created_at="2026-01-01T00:00:00", **fields):
+    await storage.create_user(uid, name, created_at)
+    if fields:
+        await storage.save_users({uid: fields}, {}, {})
+
+
+def test_create_user_defaults_and_idempotent(game):
+    async def scenario():
+        async with game() as (storage, _):
+            await storage.create_user(5, "hero", "2026-01-01T00:00:00")
+            await storage.create_user(5, "other", "2026-02-01T00:00:00")
+            user = await storage.load_user(5)
+            assert user["username"] == "hero"
+            assert (user["level"], user["gold"], user["energy"], user["class"]) == (1, 50, 10, "")
+            assert user["last_energy"] == user["created_at"] == "2026-01-01T00:00:00"
+            assert user["inventory"] == {} and user["buffs"] == [] and user["achievements"] == []
+            assert await storage.load_user(6) is None
+    run(scenario())
+
+
+def test_cache_round_trip_of_fields_and_collections(game):
+    async def scenario():
+        async with game() as (storage, cache):
+            for uid in (1, 2, 3, 4):
+                await storage.create_user(uid, f"p{uid}", "2026-01-01T00:00:00")
+            buffs = [B.make_buff("atk_scroll", 3)]
+            for uid in (1, 2, 3, 4):
+                await cache.update(uid, {
+                    "gold": 100 + uid, "inventory": {"hp_potion": uid},
+                    "equipment": {"weapon": "iron_sword"}, "buffs": buffs,
+                    "achievements": ["first_blood"],
+                })
+            await cache.flush()
+            await cache.update(2, {"inventory": {}, "equipment": {}, "buffs": [], "achievements": []})
+            await cache.flush()
+            for uid in (1, 3, 4):
+                user = await storage.load_user(uid)
+                assert user["gold"] == 100 + uid
+                assert user["inventory"] == {"hp_potion": uid}
+                assert user["equipment"] == {"weapon": "iron_sword"}
+                assert user["buffs"] == buffs
+                assert user["achievements"] == ["first_blood"]
+            emptied = await storage.load_user(2)
+            assert emptied["gold"] == 102
+            assert (emptied["inventory"], emptied["equipment"], emptied["buffs"], emptied["achievements"]) \
+                == ({}, {}, [], [])
+    run(scenario())
+
+
+def test_top_users_order_and_filters(game):
+    async def scenario():
+        async with game() as (storage, _):
+            await add_player(storage, 1, **{"class": "warrior", "level": 5, "xp": 10})
+            await add_player(storage, 2, **{"class": "mage", "level": 5, "xp": 30})
+            await add_player(storage, 3, **{"class": "mage", "level": 9, "xp": 0})
+            await add_player(storage, 4, **{"class": "mage", "level": 50, "is_banned": 1})
+            await add_player(storage, 5, level=99)  # класс не выбран
+            await add_player(storage, 6, **{"class": "warrior", "level": 5, "xp": 10})
+            rows = await storage.top_users("level", 10, ("user_id", "level", "xp"))
+            assert [r["user_id"] for r in rows] == [3, 2, 1, 6]
+            assert set(rows[0]) == {"user_id", "level", "xp"}
+            assert [r["user_id"] for r in await storage.top_users("level", 2)] == [3, 2]
+    run(scenario())
+
+
+def test_payments(game):
+    async def scenario():
+        async with game() as (storage, _):
+            await add_player(storage, 7, gold=10)
+            await storage.add_payment(7, 900, "gold_100", 0.5, "2026-01-02T00:00:00")
+            await storage.add_payment(7, 901, "gems_10", 1.0, "2026-01-01T00:00:00")
+            assert [p["invoice_id"] for p in await storage.pending_payments()] == [901, 900]
+            payment = await storage.get_payment(7, 900)
+            assert payment["status"] == "pending" and payment["amount_usd"] == 0.5
+            assert await storage.get_payment(8, 900) is None
+
+            saved = await storage.mark_paid(payment, "2026-01-03T10:00:00",
+                                            {"gold": 100, "total_spent_usd": 0.5}, {"vip_until": "x"})
+            assert saved == {"gold": 110, "total_spent_usd": 0.5, "vip_until": "x"}
+            assert await storage.mark_paid(payment, "2026-01-03T11:00:00", {"gold": 100}, {}) is None
+            assert (await storage.load_user(7))["gold"] == 110
+            assert (await storage.get_payment(7, 900))["status"] == "paid"
+
+            assert not await storage.expire_payment(payment)
+            assert await storage.expire_payment(await storage.get_payment(7, 901))
+            assert await storage.pending_payments() == []
+            assert await storage.payment_totals() == {"payments": 1, "revenue": 0.5}
+            assert await storage.revenue_by_day("2026-01-01") == [{"day": "2026-01-03", "total": 0.5, "cnt": 1}]
+            assert await storage.revenue_by_day("2026-02-01") == []
+    run(scenario())
+
+
+def test_promo_codes(game):
+    async def scenario():
+        async with game() as (storage, _):
+            await storage.add_promo("A", 10, 1, 2, "2026-01-01")
+            await storage.add_promo("B", 0, 5, 1, "2026-01-02")
+            assert (await storage.redeem_promo("A", 1))[0] == "ok"
+            assert (await storage.redeem_promo("A", 1))[0] == "used"
+            status, promo = await storage.redeem_promo("A", 2)
+            assert status == "ok" and promo["gold"] == 10 and promo["gems"] == 1
+            assert (await storage.redeem_promo("A", 3))[0] == "exhausted"
+            assert await storage.redeem_promo("C", 1) == ("not_found", None)
+            recent = await storage.recent_promos(10)
+            assert [p["code"] for p in recent] == ["B", "A"]
+            assert recent[1]["used_count"] == 2
+    run(scenario())
+
+
+def test_broadcasts_and_recipients(game):
+    async def scenario():
+        async with game() as (storage, _):
+            for uid in range(1, 8):
+                await add_player(storage, uid)
+            await storage.save_users({2: {"is_banned": 1}}, {}, {})
+            await storage.save_users({5: {"bot_blocked": 1}}, {}, {})
+            assert await storage.count_recipients() == 5
+            assert await storage.broadcast_recipients(0, 3) == [1, 3, 4]
+            assert await storage.broadcast_recipients(4, 3) == [6, 7]
+            assert await storage.broadcast_recipients(7, 3) == []
+
+            job = await storage.create_broadcast("hi", 5, 1, "2026-01-01")
+            assert (job["status"], job["cursor"], job["sent"]) == ("running", 0, 0)
+            job.update(cursor=4, sent=3, failed=1, blocked=0)
+            await storage.save_broadcast(job)
+            [running] = await storage.running_broadcasts()
+            assert (running["id"], running["cursor"], running["sent"], running["failed"]) == (job["id"], 4, 3, 1)
+            second = await storage.create_broadcast("again", 5, 1, "2026-01-02")
+            await storage.finish_broadcast(job["id"], "done", "2026-01-03")
+            assert [b["id"] for b in await storage.running_broadcasts()] == [second["id"]]
+            recent = await storage.recent_broadcasts(5)
+            assert [b["id"] for b in recent] == [second["id"], job["id"]]
+            assert recent[1]["status"] == "done" and recent[1]["finished_at"] == "2026-01-03"
+    run(scenario())
+
+
+def test_aggregates(game):
+    async def scenario():
+        async with game() as (storage, cache):
+            await add_player(storage, 1, created_at="2026-01-01", **{
+                "class": "warrior", "level": 4, "wins": 2, "dungeon_wins": 5, "last_energy": "2026-03-01",
+                "total_spent_usd": 3.0, "vip_until": "2099-01-01"})
+            await add_player(storage, 2, created_at="2026-02-01", **{
+                "class": "mage", "level": 8, "boss_kills": 1, "last_energy": "2025-01-01",
+                "total_spent_usd": 7.5})
+            await add_player(storage, 3, created_at="2026-02-02", dungeon_wins=1, last_energy="2026-03-02")
+            await cache.update(1, {"inventory": {"hp_potion": 3}, "equipment": {"weapon": "iron_sword"}})
+            await cache.update(2, {"inventory": {"hp_potion": 2}})
+            await cache.flush()
+
+            assert await storage.count_users() == 3
+            assert await storage.count_users(created_since="2026-02-01") == 2
+            stats = await storage.world_stats("2026-02-15")
+            assert (stats["total_players"], stats["level_sum"], stats["max_level"]) == (2, 12, 8)
+            assert (stats["total_fights"], stats["total_pvp"], stats["total_bosses"]) == (6, 2, 1)
+            assert stats["active_24h"] == 2
+            assert (stats["class_warrior"], stats["class_mage"]) == (1, 1)
+            assert [d["user_id"] for d in await storage.top_donors(10)] == [2, 1]
+            assert await storage.donor_stats("2026-06-01") == {"revenue": 10.5, "paying": 2, "vip": 1}
+            item_id = B.ITEM_IDS["hp_potion"]
+            assert await storage.item_stats(item_id) == {"owners": 2, "in_inventory": 5, "equipped": 0}
+            sword = await storage.item_stats(B.ITEM_IDS["iron_sword"])
+            assert sword == {"owners": 0, "in_inventory": 0, "equipped": 1}
+    run(scenario())
+
+
+def test_pvp_and_timer_candidates(game):
+    async def scenario():
+        async with game() as (storage, cache):
+            await add_player(storage, 1, **{"class": "warrior", "energy": 3})
+            await add_player(storage, 2, **{"class": "mage", "is_banned": 1, "energy": 3})
+            await add_player(storage, 3, **{"class": "mage", "bot_blocked": 1, "energy": 3})
+            await add_player(storage, 4, **{"class": "mage"})  # энергия полная — таймеров нет
+            await cache.update(1, {"equipment": {"weapon": "iron_sword"}})
+            await cache.flush()
+            pvp = {r["user_id"]: r for r in await storage.pvp_candidates()}
+            assert set(pvp) == {1, 3, 4}
+            assert pvp[1]["equipment"] == {"weapon": "iron_sword"}
+            timers = await storage.timer_candidates("2026-01-01T00:00:00")
+            assert [r["user_id"] for r in timers] == [1]
+    run(scenario())
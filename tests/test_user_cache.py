@@ -0,0 +1,121 @@
+"""UserCache: write-behind сброс, закрепление записей на время записи, refresh."""
+
+import asyncio
+
+import pytest
+
+from conftest import run
+
+
+def slow_save(storage, delay=0.05, fail=False):
+    """Подменяет save_users: запись висит delay секунд и (если fail) падает."""
+    original = storage.save_users
+
+    async def save_users(batch, old, new):
+        await asyncio.sleep(delay)
+        if fail:
+            raise RuntimeError("disk full")
+        await original(batch, old, new)
+
+    storage.save_users = save_users
+    return original
+
+
+def test_flush_writes_only_dirty_fields(game):
+    async def scenario():
+        async with game() as (storage, cache):
+            await storage.create_user(1, "a", "2026-01-01")
+            await cache.update(1, {"gold": 70})
+            assert cache.dirty_count == 1
+            assert (await storage.load_user(1))["gold"] == 50  # ещё не сброшено
+            await cache.flush()
+            assert cache.dirty_count == 0
+            assert (await storage.load_user(1))["gold"] == 70
+            assert await cache.get(999) is None
+    run(scenario())
+
+
+def test_entry_is_pinned_while_flush_in_flight(game):
+    async def scenario():
+        async with game(max_size=1, ttl=0) as (storage, cache):
+            for uid in (1, 2, 3):
+                await storage.create_user(uid, "p", "2026-01-01")
+            await cache.update(1, {"gold": 999})
+            slow_save(storage, delay=0.1)
+            flush = asyncio.create_task(cache.flush())
+            await asyncio.sleep(0.02)
+            # Запись уже не грязная, но в хранилище её ещё нет: вытеснение и TTL её не трогают
+            await cache.get(2)
+            await cache.get(3)
+            cache._expire()
+            assert 1 in cache._items
+            assert (await cache.get(1))["gold"] == 999
+            await flush
+            assert (await storage.load_user(1))["gold"] == 999
+    run(scenario())
+
+
+def test_failed_flush_keeps_fields_dirty(game):
+    async def scenario():
+        async with game(max_size=1) as (storage, cache):
+            await storage.create_user(1, "p", "2026-01-01")
+            await storage.create_user(2, "p", "2026-01-01")
+            await cache.update(1, {"gold": 123, "inventory": {"hp_potion": 2}})
+            original = slow_save(storage, fail=True)
+            flush = asyncio.create_task(cache.flush())
+            await asyncio.sleep(0.01)
+            await cache.get(2)
+            with pytest.raises(RuntimeError):
+                await flush
+            assert cache._items[1].dirty == {"gold", "inventory"}
+            assert not cache._flushing
+            storage.save_users = original
+            await cache.flush()
+            user = await storage.load_user(1)
+            assert user["gold"] == 123 and user["inventory"] == {"hp_potion": 2}
+    run(scenario())
+
+
+def test_cancelled_flush_keeps_fields_dirty(game):
+    async def scenario():
+        async with game() as (storage, cache):
+            await storage.create_user(1, "p", "2026-01-01")
+            await cache.update(1, {"gold": 5})
+            original = slow_save(storage, delay=1)
+            flush = asyncio.create_task(cache.flush())
+            await asyncio.sleep(0.01)
+            flush.cancel()
+            with pytest.raises(asyncio.CancelledError):
+                await flush
+            assert cache._items[1].dirty == {"gold"}
+            storage.save_users = original
+            await cache.flush()
+            assert (await storage.load_user(1))["gold"] == 5
+    run(scenario())
+
+
+def test_eviction_keeps_dirty_entries(game):
+    async def scenario():
+        async with game(max_size=2) as (storage, cache):
+            for uid in (1, 2, 3, 4):
+                await storage.create_user(uid, "p", "2026-01-01")
+            await cache.update(1, {"gold": 1})
+            for uid in (2, 3, 4):
+                await cache.get(uid)
+            assert 1 in cache._items and len(cache) == 2
+    run(scenario())
+
+
+def test_refresh_replaces_fields_and_notifies(game):
+    async def scenario():
+        async with game() as (storage, cache):
+            await storage.create_user(1, "p", "2026-01-01")
+            seen = []
+            cache.add_listener(lambda user, fields: seen.append((user["gold"], set(fields))))
+            await cache.update(1, {"gold": 60, "bot_blocked": 1})
+            await cache.refresh(1, {"gold": 160, "total_spent_usd": 0.5})
+            assert seen[-1] == (160, {"gold", "total_spent_usd"})
+            assert cache._items[1].dirty == {"bot_blocked"}
+            user = await cache.get(1)
+            assert (user["gold"], user["total_spent_usd"], user["bot_blocked"]) == (160, 0.5, 1)
+    run(scenario())
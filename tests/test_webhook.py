@@ -0,0 +1,28 @@
+"""Webhook: проверка секрета и ограничение числа апдейтов в обработке."""
+
+import asyncio
+
+from aiohttp.test_utils import make_mocked_request
+
+from conftest import B, run
+
+
+def post(secret: str):
+    return make_mocked_request("POST", B.WEBHOOK_PATH,
+                               headers={"X-Telegram-Bot-Api-Secret-Token": secret})
+
+
+def test_wrong_secret_is_rejected():
+    assert run(B.handle_webhook(post("wrong"))).status == 401
+
+
+def test_overloaded_webhook_answers_503(monkeypatch):
+    async def scenario():
+        busy = asyncio.get_running_loop().create_future()
+        monkeypatch.setattr(B, "WEBHOOK_MAX_UPDATES", 1)
+        monkeypatch.setattr(B, "_webhook_tasks", {busy})
+        monkeypatch.setattr(B, "_webhook_rejected", 0)
+        response = await B.handle_webhook(post(B.WEBHOOK_SECRET))
+        assert response.status == 503 and B._webhook_rejected == 1
+        busy.cancel()
+    run(scenario())